@@ -0,0 +1,489 @@
+import argparse
+import io
+import json
+import os
+import random
+import resource
+import sys
+import tempfile
+import threading
+import time
+import tracemalloc
+
+import wrapt
+
+# Generates map-node graphs on demand, so that very large graphs can be
+# benchmarked without holding every object in memory. Node n lives at store
+# index n.
+class SyntheticGraphStore:
+  SHAPES = ('chain', 'tree')
+
+  def __init__(self, shape, node_count, fanout=4):
+    if shape not in self.SHAPES:
+      raise ValueError("Unknown graph shape '{0}'".format(shape))
+    self.__shape = shape
+    self.__node_count = node_count
+    self.__fanout = fanout
+
+  def getStoreIndex(self, node):
+    return node
+
+  def getChildNodes(self, node):
+    if self.__shape == 'chain':
+      first_child, child_count = node + 1, 1
+    else:
+      first_child, child_count = node * self.__fanout + 1, self.__fanout
+    return range(first_child,
+        min(first_child + child_count, self.__node_count))
+
+  def getObject(self, index):
+    node = index
+    fields = dict(('c{0}'.format(i), self.getStoreIndex(child))
+        for i, child in enumerate(self.getChildNodes(node)))
+    return ('map', wrapt.WraptRefMap('node', fields))
+
+
+# Generates single-root graphs of other shapes on demand:
+#
+# - 'wide': a root map with node_count - 1 int fields.
+# - 'array': a root array of node_count - 1 ints.
+# - 'blobs': a root array of node_count - 1 blobs of 1 to 4 KiB.
+# - 'chain' and 'tree': as SyntheticGraphStore.
+class ShapeStore:
+  SHAPES = ('wide', 'array', 'blobs', 'chain', 'tree')
+
+  def __init__(self, shape, node_count):
+    if shape not in self.SHAPES:
+      raise ValueError("Unknown graph shape '{0}'".format(shape))
+    self.__shape = shape
+    self.__node_count = node_count
+    self.__graph_store = None
+    if shape in SyntheticGraphStore.SHAPES:
+      self.__graph_store = SyntheticGraphStore(shape, node_count)
+
+  def getObject(self, index):
+    if self.__graph_store is not None:
+      return self.__graph_store.getObject(index)
+    if index == 0:
+      children = range(1, self.__node_count)
+      if self.__shape == 'wide':
+        return ('map', wrapt.WraptRefMap('root',
+            dict(('field{0}'.format(i), i) for i in children)))
+      return ('array', wrapt.WraptRefArray(children))
+    if self.__shape == 'blobs':
+      return ('blob', bytes(1024 * (1 + index % 4)))
+    return ('int', index)
+
+
+# Generates a table on demand: a root array of row_count maps with the same
+# tag and 'id', 'score' and 'name' fields, holding an int, a float and a
+# string.
+class TableStore:
+  FIELDS = ('id', 'score', 'name')
+
+  def __init__(self, row_count):
+    self.__row_count = row_count
+
+  def getObject(self, index):
+    if index == 0:
+      return ('array', wrapt.WraptRefArray(range(1, self.__row_count + 1)))
+    if index <= self.__row_count:
+      first_value = self.__row_count + 1 + len(self.FIELDS) * (index - 1)
+      return ('map', wrapt.WraptRefMap('row', dict(
+          (field, first_value + i) for i, field in enumerate(self.FIELDS))))
+    row, field_number = divmod(
+        index - self.__row_count - 1, len(self.FIELDS))
+    if field_number == 0:
+      return ('int', row)
+    elif field_number == 1:
+      return ('float', row / 2.0)
+    return ('string', 'row {0}'.format(row))
+
+
+# Records which pages of the file each read touches.
+class PageCountingBinaryFile:
+  PAGE_SIZE = 4096
+
+  def __init__(self, delegate):
+    self.__delegate = delegate
+    self.__pages = set()
+
+  def readBytes(self, offset, length):
+    first_page = offset // self.PAGE_SIZE
+    last_page = (offset + max(length, 1) - 1) // self.PAGE_SIZE
+    self.__pages.update(range(first_page, last_page + 1))
+    return self.__delegate.readBytes(offset, length)
+
+  def getLength(self):
+    return self.__delegate.getLength()
+
+  def getPageCount(self):
+    return len(self.__pages)
+
+  def resetPages(self):
+    self.__pages = set()
+
+
+# Random root-to-leaf walks over a tree store, biased towards low-numbered
+# children, as a stand-in for a workload with a hot subset of paths.
+def randomWalks(store, walk_count, rng):
+  walks = []
+  for _ in range(walk_count):
+    node = 0
+    walk = [store.getStoreIndex(node)]
+    children = store.getChildNodes(node)
+    while children:
+      weights = [2 ** -i for i in range(len(children))]
+      node = rng.choices(children, weights)[0]
+      walk.append(store.getStoreIndex(node))
+      children = store.getChildNodes(node)
+    walks.append(walk)
+  return walks
+
+
+def peakMemoryKb():
+  return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+
+
+# Allocates each SyntheticGraphStore shape in each order. peak_rss_kb is the
+# process's high-water mark so far, so after the first configuration it also
+# covers the earlier ones.
+def benchmarkAllocation(node_count):
+  results = []
+  for shape in SyntheticGraphStore.SHAPES:
+    for order in ('dfs', 'bfs', 'clustered'):
+      store = SyntheticGraphStore(shape, node_count)
+      start = time.perf_counter()
+      allocator = wrapt.IndexAllocator(store, order=order)
+      allocator.allocate()
+      elapsed = time.perf_counter() - start
+      results.append({
+        'benchmark': 'allocate',
+        'shape': shape,
+        'order': order,
+        'nodes': node_count,
+        'seconds': elapsed,
+        'nodes_per_second': node_count / elapsed,
+        'peak_rss_kb': peakMemoryKb(),
+      })
+  return results
+
+
+# Writes a tree with each layout, then replays random walks against the
+# written file, counting the distinct pages each cold walk touches.
+def benchmarkLayout(node_count, walk_count=1000):
+  store = SyntheticGraphStore('tree', node_count)
+  rng = random.Random(0)
+  training_trace = [index
+      for walk in randomWalks(store, walk_count, rng) for index in walk]
+  walks = randomWalks(store, walk_count, rng)
+
+  results = []
+  for order in wrapt.IndexAllocator.ORDERS:
+    access_trace = training_trace if order == 'trace' else None
+    processor = wrapt.WraptOutputProcessor(store, order, access_trace)
+    output = io.BytesIO()
+    start = time.perf_counter()
+    index_map = processor.writeFile(output)
+    write_seconds = time.perf_counter() - start
+
+    binfile = PageCountingBinaryFile(
+        wrapt.ByteArrayBinaryFile(output.getvalue()))
+    low_level_file = wrapt.WraptLowLevelFile(binfile)
+    low_level_file.initialize()
+    total_pages = 0
+    start = time.perf_counter()
+    for walk in walks:
+      binfile.resetPages()
+      for store_index in walk:
+        low_level_file.getObject(index_map[store_index])
+      total_pages += binfile.getPageCount()
+    walk_seconds = time.perf_counter() - start
+
+    results.append({
+      'benchmark': 'layout',
+      'order': order,
+      'nodes': node_count,
+      'walks': walk_count,
+      'write_seconds': write_seconds,
+      'pages_per_walk': total_pages / walk_count,
+      'walk_seconds': walk_seconds,
+    })
+  return results
+
+
+# Reads random objects from a tree file on disk with 1 to 32 threads sharing
+# one uncached reader, comparing the locked file object, pread and mmap
+# binary files by total read throughput.
+def benchmarkThreadScaling(node_count, reads_per_thread=2000):
+  store = SyntheticGraphStore('tree', node_count)
+  binfile_types = [('fileobj', wrapt.FileObjectBinaryFile),
+      ('mmap', wrapt.MmapBinaryFile)]
+  if hasattr(os, 'pread'):
+    binfile_types.insert(1, ('pread', wrapt.PreadBinaryFile))
+
+  results = []
+  with tempfile.TemporaryFile() as fileobj:
+    index_map = wrapt.WraptOutputProcessor(store).writeFile(fileobj)
+    fileobj.flush()
+    file_size = fileobj.seek(0, io.SEEK_END)
+    indexes = [index_map[i] for i in range(node_count)]
+    for binfile_name, binfile_type in binfile_types:
+      binfile = binfile_type(fileobj)
+      low_level_file = wrapt.WraptLowLevelFile(binfile)
+      low_level_file.initialize()
+      for thread_count in (1, 2, 4, 8, 16, 32):
+        def readRandom(seed):
+          rng = random.Random(seed)
+          for _ in range(reads_per_thread):
+            low_level_file.getObject(rng.choice(indexes))
+
+        threads = [threading.Thread(target=readRandom, args=(seed,))
+            for seed in range(thread_count)]
+        start = time.perf_counter()
+        for thread in threads:
+          thread.start()
+        for thread in threads:
+          thread.join()
+        elapsed = time.perf_counter() - start
+        results.append({
+          'benchmark': 'threads',
+          'binfile': binfile_name,
+          'threads': thread_count,
+          'nodes': node_count,
+          'file_bytes': file_size,
+          'reads': thread_count * reads_per_thread,
+          'seconds': elapsed,
+          'reads_per_second': thread_count * reads_per_thread / elapsed,
+        })
+      if hasattr(binfile, 'close'):
+        binfile.close()
+  return results
+
+
+# Walks every node of a tree file through WraptHandles, keeping each handle
+# alive as a large traversal would. The timed walk runs untraced; a second
+# walk under tracemalloc measures the memory held per handle.
+def benchmarkHandles(node_count):
+  store = SyntheticGraphStore('tree', node_count)
+  output = io.BytesIO()
+  wrapt.WraptOutputProcessor(store).writeFile(output)
+  low_level_file = wrapt.WraptLowLevelFile(
+      wrapt.ByteArrayBinaryFile(output.getvalue()))
+  low_level_file.initialize()
+  wrapt_file = wrapt.WraptFile(
+      wrapt.WraptObjectStore(wrapt.WraptObjectFile(low_level_file)),
+      wrapt.WraptHandleFactory())
+
+  def walk():
+    handles = [wrapt_file.getRootHandle()]
+    position = 0
+    while position < len(handles):
+      handles.extend(handle
+          for _, handle in handles[position].asMap().getEntries())
+      position += 1
+    return handles
+
+  start = time.perf_counter()
+  handle_count = len(walk())
+  walk_seconds = time.perf_counter() - start
+
+  tracemalloc.start()
+  handles = walk()
+  traced_bytes, _ = tracemalloc.get_traced_memory()
+  tracemalloc.stop()
+  del handles
+
+  return [{
+    'benchmark': 'handles',
+    'nodes': node_count,
+    'handles': handle_count,
+    'walk_seconds': walk_seconds,
+    'handles_per_second': handle_count / walk_seconds,
+    'bytes_per_handle': traced_bytes / handle_count,
+    'peak_rss_kb': peakMemoryKb(),
+  }]
+
+
+# Compares reading every row of a TableStore table through handles with
+# reading the same fields as columns with WraptLazyArray.getColumns.
+def benchmarkColumns(node_count):
+  output = io.BytesIO()
+  wrapt.WraptOutputProcessor(TableStore(node_count)).writeFile(output)
+  results = []
+  for method in ('handles', 'columns'):
+    low_level_file = wrapt.WraptLowLevelFile(
+        wrapt.ByteArrayBinaryFile(output.getvalue()))
+    low_level_file.initialize()
+    wrapt_file = wrapt.WraptFile(
+        wrapt.WraptObjectStore(wrapt.WraptObjectFile(low_level_file)),
+        wrapt.WraptHandleFactory())
+    start = time.perf_counter()
+    rows = wrapt_file.getRootHandle().asArray()
+    if method == 'handles':
+      ids, scores, names = [], [], []
+      for row in rows:
+        row_map = row.asMap()
+        ids.append(row_map['id'].asInt())
+        scores.append(row_map['score'].asFloat())
+        names.append(row_map['name'].asString())
+    else:
+      columns = rows.getColumns(TableStore.FIELDS)
+    read_seconds = time.perf_counter() - start
+    results.append({
+      'benchmark': 'columns',
+      'method': method,
+      'rows': node_count,
+      'read_seconds': read_seconds,
+      'rows_per_second': node_count / read_seconds,
+    })
+  return results
+
+
+def latencyStats(latencies):
+  latencies = sorted(latencies)
+  return {
+    'count': len(latencies),
+    'mean_us': 1e6 * sum(latencies) / len(latencies),
+    'p50_us': 1e6 * latencies[len(latencies) // 2],
+    'p99_us': 1e6 * latencies[min(len(latencies) - 1,
+        len(latencies) * 99 // 100)],
+  }
+
+
+def openWraptFile(fileobj, cache_entries=None):
+  if hasattr(os, 'pread'):
+    binfile = wrapt.PreadBinaryFile(fileobj)
+  else:
+    binfile = wrapt.FileObjectBinaryFile(fileobj)
+  low_level_file = wrapt.WraptLowLevelFile(binfile)
+  low_level_file.initialize()
+  object_file = wrapt.WraptObjectFile(low_level_file)
+  if cache_entries is not None:
+    object_file = wrapt.WraptCachedObjectFile(
+        object_file, max_entries=cache_entries)
+  store = wrapt.WraptObjectStore(object_file)
+  return object_file, store, wrapt.WraptFile(
+      store, wrapt.WraptHandleFactory())
+
+
+# Reads every object reachable from the root through handles.
+def traverse(wrapt_file):
+  handles = [wrapt_file.getRootHandle()]
+  visited = 0
+  while handles:
+    handle = handles.pop()
+    visited += 1
+    wrapt_map = handle.asMap()
+    if wrapt_map is not None:
+      handles.extend(value for _, value in wrapt_map.getEntries())
+      continue
+    wrapt_array = handle.asArray()
+    if wrapt_array is not None:
+      handles.extend(wrapt_array)
+      continue
+    handle.asInt()
+  return visited
+
+
+def timeAccesses(factory, store, indexes):
+  latencies = []
+  for index in indexes:
+    start = time.perf_counter()
+    factory.createHandle(store, index).asInt()
+    latencies.append(time.perf_counter() - start)
+  return latencies
+
+
+# Runs the read and write path measurements for every ShapeStore shape at
+# three scales up to node_count: write throughput, open time, handle access
+# latency in sequential and random order, full traversal, and the hit rate
+# of a WraptCachedObjectFile holding a tenth of the objects under a skewed
+# random workload.
+def benchmarkSuite(node_count, access_count=10000):
+  scales = sorted(set(scale for scale in
+      (node_count // 100, node_count // 10, node_count) if scale >= 2))
+  rng = random.Random(0)
+  results = []
+  for shape in ShapeStore.SHAPES:
+    for scale in scales:
+      store = ShapeStore(shape, scale)
+      with tempfile.TemporaryFile() as fileobj:
+        start = time.perf_counter()
+        index_map = wrapt.WraptOutputProcessor(store).writeFile(fileobj)
+        write_seconds = time.perf_counter() - start
+        fileobj.flush()
+        file_size = fileobj.seek(0, io.SEEK_END)
+
+        start = time.perf_counter()
+        _, file_store, wrapt_file = openWraptFile(fileobj)
+        wrapt_file.getRootHandle().asMap()
+        open_seconds = time.perf_counter() - start
+
+        factory = wrapt.WraptHandleFactory()
+        leaf_indexes = [index_map[i] for i in range(1, scale)]
+        sequential = leaf_indexes[:access_count]
+        random_indexes = [rng.choice(leaf_indexes)
+            for _ in range(min(access_count, len(leaf_indexes)))]
+        sequential_latencies = timeAccesses(factory, file_store, sequential)
+        random_latencies = timeAccesses(factory, file_store, random_indexes)
+
+        start = time.perf_counter()
+        visited = traverse(wrapt_file)
+        traverse_seconds = time.perf_counter() - start
+
+        cached_file, cached_store, _ = openWraptFile(
+            fileobj, cache_entries=max(1, scale // 10))
+        skewed_indexes = [leaf_indexes[min(len(leaf_indexes) - 1,
+            int(rng.expovariate(10.0 / len(leaf_indexes))))]
+            for _ in range(access_count)]
+        timeAccesses(factory, cached_store, skewed_indexes)
+        cache_stats = cached_file.getCacheStats()
+
+      results.append({
+        'benchmark': 'suite',
+        'shape': shape,
+        'nodes': scale,
+        'file_bytes': file_size,
+        'write_seconds': write_seconds,
+        'write_objects_per_second': scale / write_seconds,
+        'open_seconds': open_seconds,
+        'sequential_access': latencyStats(sequential_latencies),
+        'random_access': latencyStats(random_latencies),
+        'traverse_seconds': traverse_seconds,
+        'traverse_objects_per_second': visited / traverse_seconds,
+        'cache_hit_rate': cache_stats['hits'] /
+            max(1, cache_stats['hits'] + cache_stats['misses']),
+        'peak_rss_kb': peakMemoryKb(),
+      })
+  return results
+
+
+BENCHMARKS = {
+  'allocate': benchmarkAllocation,
+  'columns': benchmarkColumns,
+  'handles': benchmarkHandles,
+  'layout': benchmarkLayout,
+  'suite': benchmarkSuite,
+  'threads': benchmarkThreadScaling,
+}
+
+
+def main(argv):
+  parser = argparse.ArgumentParser(description='Wrapt benchmarks')
+  parser.add_argument('benchmark', choices=sorted(BENCHMARKS))
+  parser.add_argument('--nodes', type=int, default=1000000)
+  parser.add_argument('--output',
+      help='Also write the results to this JSON file')
+  args = parser.parse_args(argv)
+  results = BENCHMARKS[args.benchmark](args.nodes)
+  json.dump(results, sys.stdout, indent=2)
+  sys.stdout.write('\n')
+  if args.output is not None:
+    with open(args.output, 'w') as output:
+      json.dump(results, output, indent=2)
+      output.write('\n')
+
+
+if __name__ == '__main__':
+  main(sys.argv[1:])
@@ -1,4 +1,11 @@
+import asyncio
+import concurrent.futures
 import unittest
+import io
+import os
+import struct
+import tempfile
+import threading
 import wrapt
 
 class SimpleObjectCell:
@@ -177,6 +184,30 @@ class CreateLiveWraptFileTest(unittest.TestCase):
     with self.assertRaises(TypeError):
       m.items()[0] = 5
 
+class CreateLiveWraptArrayTest(unittest.TestCase):
+  def setUp(self):
+    self.__file = wrapt.WraptFile(InMemoryObjectStore(),
+        wrapt.WraptHandleFactory())
+
+  def test_setRootToArray(self):
+    root = self.__file.getRootHandle()
+    builder = root.createArray()
+    for value in [3, 4]:
+      element = self.__file.createHandle()
+      element.createInt(value)
+      builder.add(element)
+    builder.build()
+
+    wrapt_array = root.asArray()
+    self.assertEqual(len(wrapt_array), 2)
+    self.assertEqual(wrapt_array.getElement(1).asInt(), 4)
+    self.assertEqual([element.asInt() for element in wrapt_array.getElements()],
+        [3, 4])
+    self.assertIs(root.asMap(), None)
+
+    with self.assertRaises(ValueError):
+      builder.build()
+
 class InMemoryObjectWriter:
   def __init__(self):
     self.__objects = []
@@ -213,14 +244,14 @@ class WraptOutputProcessorTest(unittest.TestCase):
   def test_storeSimple3(self):
     self.assertSimpleStore('float', 2.0)
 
-  def createMapValue(self, tag, hash_data_index, refmap):
-    return wrapt.WraptRefMap(tag, hash_data_index, refmap)
+  def createMapValue(self, tag, refmap):
+    return wrapt.WraptRefMap(tag, refmap)
 
   def test_storeMap1(self):
-    mapValue = self.createMapValue('obj', 1, {'hello': 2})
+    mapValue = self.createMapValue('obj', {'hello': 1})
     intValue = 12
 
-    self.__store._setData(('map', mapValue), ('null', None), ('int', intValue))
+    self.__store._setData(('map', mapValue), ('int', intValue))
     writer = InMemoryObjectWriter()
     self.__processor.write(writer)
     objects = writer.toList()
@@ -232,7 +263,1381 @@ class WraptOutputProcessorTest(unittest.TestCase):
     tag_index = value.getTagIndex()
     self.assertEqual(objects[tag_index], ('string', 'obj'))
     hash_data_index = value.getHashDataIndex()
-    self.assertEqual(objects[hash_data_index], ('null', None))
+    self.assertEqual(objects[hash_data_index],
+        ('blob', wrapt.buildFieldHashTable(['hello'])))
     ((key_index, value_index),) = value.getMappings()
     self.assertEqual(objects[key_index], ('string', 'hello'))
     self.assertEqual(objects[value_index], ('int', intValue))
+
+def buildLowLevelFileData(objects, ranges=None):
+  if ranges is None:
+    ranges = [(0, 0, len(objects))]
+  index_data = []
+  object_data = []
+  data_size = 0
+  for typecode, data in objects:
+    if 0 < len(data) < 1 << 15:
+      size_bits = len(data) << 48
+    else:
+      size_bits = 0
+      data = struct.pack('!Q', len(data)) + data
+    data += b'\0' * (wrapt.alignOffset(len(data)) - len(data))
+    index_data.append(struct.pack('!Q', size_bits | data_size | typecode))
+    object_data.append(data)
+    data_size += len(data)
+  metaindex_data = b''.join(struct.pack('!III', *r) for r in ranges)
+  index_header = struct.pack('!II', len(ranges), len(objects))
+  index_offset = wrapt.alignOffset(24 + 8 + len(metaindex_data))
+  padding = b'\0' * (index_offset - 24 - 8 - len(metaindex_data))
+  header = struct.pack('!8sQQ', b'WraptDat', 0,
+      index_offset + 8 * len(objects))
+  return (header + index_header + metaindex_data + padding +
+      b''.join(index_data) + b''.join(object_data))
+
+class MmapBinaryFileTest(unittest.TestCase):
+  def setUp(self):
+    self.__tempfile = tempfile.TemporaryFile()
+    self.__tempfile.write(buildLowLevelFileData([
+      (wrapt.WraptLowLevelFile.INT_TYPE, struct.pack('!q', -3)),
+      (wrapt.WraptLowLevelFile.STRING_TYPE,
+          wrapt.encodeObjectData('string', 'wraptstr')),
+      (wrapt.WraptLowLevelFile.BLOB_TYPE,
+          wrapt.encodeObjectData('blob', b'\x01\x02\x03'))]))
+    self.__tempfile.flush()
+    self.__binfile = wrapt.MmapBinaryFile(self.__tempfile)
+
+  def tearDown(self):
+    self.__binfile.close()
+    self.__tempfile.close()
+
+  def test_readBytes(self):
+    self.assertEqual(self.__binfile.getLength(), 48 + 24 + 24)
+    self.assertEqual(bytes(self.__binfile.readBytes(0, 8)), b'WraptDat')
+
+  def test_readPastEndFails(self):
+    with self.assertRaises(wrapt.WraptFileIOError):
+      self.__binfile.readBytes(self.__binfile.getLength() - 4, 8)
+
+  def test_readObjects(self):
+    low_level_file = wrapt.WraptLowLevelFile(self.__binfile)
+    low_level_file.initialize()
+    object_file = wrapt.WraptObjectFile(low_level_file)
+
+    self.assertEqual(object_file.getObjectCount(), 3)
+    self.assertEqual(object_file.getObject(0), ('int', -3))
+    self.assertEqual(object_file.getObject(1), ('string', 'wraptstr'))
+    type_id, blob = object_file.getObject(2)
+    self.assertEqual(type_id, 'blob')
+    self.assertIsInstance(blob, memoryview)
+    self.assertEqual(bytes(blob), b'\x01\x02\x03')
+    blob.release()
+
+  def test_concurrentReads(self):
+    low_level_file = wrapt.WraptLowLevelFile(self.__binfile)
+    low_level_file.initialize()
+    object_file = wrapt.WraptObjectFile(low_level_file)
+    results = []
+
+    def readAll():
+      for _ in range(100):
+        results.append(object_file.getObject(1))
+
+    threads = [threading.Thread(target=readAll) for _ in range(4)]
+    for thread in threads:
+      thread.start()
+    for thread in threads:
+      thread.join()
+
+    self.assertEqual(results, [('string', 'wraptstr')] * 400)
+
+  def test_closeWithLiveSlices(self):
+    view = self.__binfile.readBytes(0, 8)
+    self.__binfile.close()
+    self.assertEqual(bytes(view), b'WraptDat')
+    view.release()
+
+  def test_emptyFileFails(self):
+    with tempfile.TemporaryFile() as empty_file:
+      with self.assertRaises(wrapt.WraptFileFormatException):
+        wrapt.MmapBinaryFile(empty_file)
+
+@unittest.skipUnless(hasattr(os, 'pread'), 'os.pread is not available')
+class PreadBinaryFileTest(unittest.TestCase):
+  def setUp(self):
+    self.__tempfile = tempfile.TemporaryFile()
+    self.__tempfile.write(writeStoreData(
+        ('array', wrapt.WraptRefArray([1, 2])), ('string', 'pread'),
+        ('blob', b'\x00' * 100)))
+    self.__tempfile.flush()
+    self.__binfile = wrapt.PreadBinaryFile(self.__tempfile)
+
+  def tearDown(self):
+    self.__tempfile.close()
+
+  def test_readBytes(self):
+    self.assertEqual(self.__binfile.readBytes(0, 8), b'WraptDat')
+    with self.assertRaises(wrapt.WraptFileIOError):
+      self.__binfile.readBytes(self.__binfile.getLength() - 4, 8)
+
+  def test_concurrentReads(self):
+    object_file = createObjectFile(self.__binfile)
+    results = []
+
+    def readAll():
+      for _ in range(100):
+        results.append(object_file.getObjects([1, 2]))
+
+    threads = [threading.Thread(target=readAll) for _ in range(8)]
+    for thread in threads:
+      thread.start()
+    for thread in threads:
+      thread.join()
+
+    self.assertEqual(results,
+        [[('string', 'pread'), ('blob', b'\x00' * 100)]] * 800)
+
+class CountingBinaryFile:
+  def __init__(self, delegate):
+    self.__delegate = delegate
+    self.read_count = 0
+
+  def readBytes(self, offset, length):
+    self.read_count += 1
+    return self.__delegate.readBytes(offset, length)
+
+  def getLength(self):
+    return self.__delegate.getLength()
+
+def createObjectFile(binfile):
+  low_level_file = wrapt.WraptLowLevelFile(binfile)
+  low_level_file.initialize()
+  return wrapt.WraptObjectFile(low_level_file)
+
+class BatchedFetchTest(unittest.TestCase):
+  def setUp(self):
+    self.__binfile = CountingBinaryFile(wrapt.ByteArrayBinaryFile(
+        buildLowLevelFileData([(wrapt.WraptLowLevelFile.INT_TYPE,
+            struct.pack('!q', i)) for i in range(100)])))
+    self.__object_file = createObjectFile(self.__binfile)
+    self.__binfile.read_count = 0
+
+  def test_getObjectsMatchesGetObject(self):
+    indexes = [99, 3, 50, 3, 0]
+    self.assertEqual(self.__object_file.getObjects(indexes),
+        [self.__object_file.getObject(index) for index in indexes])
+
+  def test_getObjectsCoalescesReads(self):
+    objects = self.__object_file.getObjects(range(100))
+    self.assertEqual(objects, [('int', i) for i in range(100)])
+    self.assertEqual(self.__binfile.read_count, 2)
+
+  def test_getObjectsCoalescesStridedReads(self):
+    objects = self.__object_file.getObjects(range(0, 100, 7))
+    self.assertEqual(objects, [('int', i) for i in range(0, 100, 7)])
+    self.assertEqual(self.__binfile.read_count, 2)
+
+  def test_getObjectsOutOfBounds(self):
+    with self.assertRaises(wrapt.WraptIndexOutOfBoundsException):
+      self.__object_file.getObjects([1, 100])
+
+  def test_cachedGetObjectsOnlyFetchesMisses(self):
+    cached_file = wrapt.WraptCachedObjectFile(self.__object_file)
+    cached_file.getObject(5)
+    self.__binfile.read_count = 0
+    self.assertEqual(cached_file.getObjects([5]), [('int', 5)])
+    self.assertEqual(self.__binfile.read_count, 0)
+    self.assertEqual(cached_file.getObjects([4, 5, 6]),
+        [('int', 4), ('int', 5), ('int', 6)])
+
+  def test_storeGetObjectsUsesOverrides(self):
+    store = wrapt.WraptObjectStore(
+        wrapt.WraptCachedObjectFile(self.__object_file))
+    store.setObject(2, 'string', 'override')
+    self.assertEqual(store.getObjects([1, 2, 3]),
+        [('int', 1), ('string', 'override'), ('int', 3)])
+
+class CountingObjectFile:
+  def __init__(self, objects):
+    self.__objects = objects
+    self.fetch_count = 0
+
+  def getObject(self, index):
+    self.fetch_count += 1
+    return self.__objects[index]
+
+  def getObjects(self, indexes):
+    return [self.getObject(index) for index in indexes]
+
+  def getObjectCount(self):
+    return len(self.__objects)
+
+class WraptCachedObjectFileTest(unittest.TestCase):
+  def setUp(self):
+    self.__delegate = CountingObjectFile(
+        [('int', i) for i in range(10)] + [('blob', b'x' * 10000)])
+
+  def test_unboundedCacheKeepsEverything(self):
+    cached_file = wrapt.WraptCachedObjectFile(self.__delegate)
+    for _ in range(2):
+      for i in range(10):
+        self.assertEqual(cached_file.getObject(i), ('int', i))
+    self.assertEqual(self.__delegate.fetch_count, 10)
+    stats = cached_file.getCacheStats()
+    self.assertEqual((stats['hits'], stats['misses'], stats['evictions']),
+        (10, 10, 0))
+
+  def test_entryLimitEvictsLeastRecentlyUsed(self):
+    cached_file = wrapt.WraptCachedObjectFile(self.__delegate, max_entries=2)
+    cached_file.getObject(0)
+    cached_file.getObject(1)
+    cached_file.getObject(0)
+    cached_file.getObject(2)
+    self.__delegate.fetch_count = 0
+
+    cached_file.getObject(0)
+    self.assertEqual(self.__delegate.fetch_count, 0)
+    cached_file.getObject(1)
+    self.assertEqual(self.__delegate.fetch_count, 1)
+    self.assertEqual(cached_file.getCacheStats()['evictions'], 2)
+
+  def test_byteLimit(self):
+    cached_file = wrapt.WraptCachedObjectFile(
+        self.__delegate, max_bytes=320, max_object_bytes=64)
+    for i in range(10):
+      cached_file.getObject(i)
+    stats = cached_file.getCacheStats()
+    self.assertEqual(stats['entries'], 5)
+    self.assertLessEqual(stats['bytes'], 320)
+
+  def test_largeObjectsDoNotEvictHotSet(self):
+    cached_file = wrapt.WraptCachedObjectFile(
+        self.__delegate, max_bytes=20000, max_object_bytes=1000)
+    cached_file.getObjects(range(10))
+    self.assertEqual(cached_file.getObject(10), ('blob', b'x' * 10000))
+    stats = cached_file.getCacheStats()
+    self.assertEqual((stats['entries'], stats['evictions']), (10, 0))
+
+class WraptIndexTableTest(unittest.TestCase):
+  def setUp(self):
+    self.__binfile = CountingBinaryFile(wrapt.ByteArrayBinaryFile(
+        buildLowLevelFileData([
+          (wrapt.WraptLowLevelFile.INT_TYPE, struct.pack('!q', 1)),
+          (wrapt.WraptLowLevelFile.STRING_TYPE,
+              wrapt.encodeObjectData('string', 'sixteen bytes!!!')),
+          (wrapt.WraptLowLevelFile.INT_TYPE, struct.pack('!q', 2)),
+          (wrapt.WraptLowLevelFile.BLOB_TYPE,
+              wrapt.encodeObjectData('blob', b'abc'))])))
+
+  def createLowLevelFile(self, preload_index):
+    low_level_file = wrapt.WraptLowLevelFile(
+        self.__binfile, preload_index=preload_index)
+    low_level_file.initialize()
+    return low_level_file
+
+  def test_bulkDecode(self):
+    low_level_file = self.createLowLevelFile(False)
+    self.assertEqual(low_level_file.countObjectsByType(),
+        {'int': 2, 'string': 1, 'blob': 1})
+    self.assertEqual(list(low_level_file.getObjectSizes()), [8, 16, 8, 3])
+    self.assertTrue(low_level_file.isIndexOrdered())
+
+  def test_loadWindow(self):
+    table = self.createLowLevelFile(False).loadIndexTable(1, 2)
+    self.assertEqual(table.getEntryCount(), 2)
+    self.assertEqual(list(table.getOffsets()), [8, 24])
+    self.assertEqual(list(table.getSizes()), [16, 8])
+    self.assertEqual(list(table.getTypeCodes()),
+        [wrapt.WraptLowLevelFile.STRING_TYPE, wrapt.WraptLowLevelFile.INT_TYPE])
+    self.assertEqual(table.getEntry(2), 8 << 48 | 24)
+
+  def test_loadWindowOutOfBounds(self):
+    with self.assertRaises(wrapt.WraptIndexOutOfBoundsException):
+      self.createLowLevelFile(False).loadIndexTable(3, 2)
+
+  def test_preloadedIndexSkipsIndexReads(self):
+    object_file = wrapt.WraptObjectFile(self.createLowLevelFile(True))
+    self.__binfile.read_count = 0
+    self.assertEqual(object_file.getObject(1), ('string', 'sixteen bytes!!!'))
+    self.assertEqual(object_file.getObjects([0, 2]), [('int', 1), ('int', 2)])
+    self.assertEqual(self.__binfile.read_count, 2)
+
+class WraptMetaIndexTest(unittest.TestCase):
+  def setUp(self):
+    self.__meta_index = wrapt.WraptMetaIndex(
+        [(10, 2, 5), (0, 0, 2), (20, 7, 1)])
+
+  def test_findPhysicalIndex(self):
+    self.assertEqual(self.__meta_index.findPhysicalIndex(0), 0)
+    self.assertEqual(self.__meta_index.findPhysicalIndex(1), 1)
+    self.assertEqual(self.__meta_index.findPhysicalIndex(12), 4)
+    self.assertEqual(self.__meta_index.findPhysicalIndex(20), 7)
+
+  def test_holes(self):
+    for index in [2, 9, 15, 19, 21]:
+      self.assertIs(self.__meta_index.findPhysicalIndex(index), None)
+    self.assertEqual(self.__meta_index.getObjectCount(), 21)
+
+  def test_overlappingRangesFail(self):
+    with self.assertRaises(wrapt.WraptFileFormatException):
+      wrapt.WraptMetaIndex([(0, 0, 5), (4, 5, 2)])
+
+class MetaIndexedFileTest(unittest.TestCase):
+  def setUp(self):
+    binfile = wrapt.ByteArrayBinaryFile(buildLowLevelFileData(
+        [(wrapt.WraptLowLevelFile.INT_TYPE, struct.pack('!q', i))
+            for i in range(4)],
+        ranges=[(3, 0, 1), (100, 1, 3)]))
+    self.__low_level_file = wrapt.WraptLowLevelFile(binfile)
+    self.__low_level_file.initialize()
+    self.__object_file = wrapt.WraptObjectFile(self.__low_level_file)
+
+  def test_virtualLookup(self):
+    self.assertEqual(self.__object_file.getObject(3), ('int', 0))
+    self.assertEqual(self.__object_file.getObject(101), ('int', 2))
+    self.assertEqual(self.__object_file.getObjects([102, 3]),
+        [('int', 3), ('int', 0)])
+    self.assertEqual(self.__object_file.getObjectCount(), 103)
+
+  def test_holeIsOutOfBounds(self):
+    self.assertFalse(self.__low_level_file.hasObject(4))
+    with self.assertRaises(wrapt.WraptIndexOutOfBoundsException):
+      self.__object_file.getObject(4)
+
+def createIntFile(values, ranges):
+  return createObjectFile(wrapt.ByteArrayBinaryFile(buildLowLevelFileData(
+      [(wrapt.WraptLowLevelFile.INT_TYPE, struct.pack('!q', value))
+          for value in values],
+      ranges=ranges)))
+
+class WraptLayeredObjectFileTest(unittest.TestCase):
+  def setUp(self):
+    self.__base = createIntFile([0, 1, 2, 3], [(0, 0, 4)])
+    self.__overlay = createIntFile([11, 14, 15], [(1, 0, 1), (4, 1, 2)])
+    self.__top = createIntFile([22, 24], [(2, 0, 1), (4, 1, 1)])
+
+  def test_singleOverlay(self):
+    layered_file = wrapt.WraptLayeredObjectFile([self.__base, self.__overlay])
+    self.assertEqual(layered_file.getObjectCount(), 6)
+    self.assertEqual([layered_file.getObject(i)[1] for i in range(6)],
+        [0, 11, 2, 3, 14, 15])
+
+  def test_stackedOverlays(self):
+    layered_file = wrapt.WraptLayeredObjectFile(
+        [self.__base, self.__overlay, self.__top])
+    self.assertEqual([layered_file.getObject(i)[1] for i in range(6)],
+        [0, 11, 22, 3, 24, 15])
+    self.assertEqual(layered_file.getObjects([5, 2, 0, 2]),
+        [('int', 15), ('int', 22), ('int', 0), ('int', 22)])
+
+  def test_holes(self):
+    layered_file = wrapt.WraptLayeredObjectFile([self.__overlay])
+    self.assertFalse(layered_file.hasObject(0))
+    self.assertTrue(layered_file.hasObject(1))
+    with self.assertRaises(wrapt.WraptIndexOutOfBoundsException):
+      layered_file.getObject(3)
+
+class WraptFileWriterTest(unittest.TestCase):
+  def setUp(self):
+    self.__store = InMemoryObjectStore()
+    self.__processor = wrapt.WraptOutputProcessor(self.__store)
+
+  def writeAndRead(self):
+    output = io.BytesIO()
+    self.__processor.writeFile(output)
+    return createObjectFile(wrapt.ByteArrayBinaryFile(output.getvalue()))
+
+  def test_writeScalar(self):
+    self.__store._setData(('float', 2.5))
+    object_file = self.writeAndRead()
+    self.assertEqual(object_file.getObjectCount(), 1)
+    self.assertEqual(object_file.getObject(0), ('float', 2.5))
+
+  def test_writeMapContents(self):
+    refmap = wrapt.WraptRefMap('obj',
+        {'hello': 2, 'blob': 3, 'flag': 4, 'nothing': 1})
+    self.__store._setData(('map', refmap), ('null', None), ('string', 'world'),
+        ('blob', b'\x00\xff'), ('boolean', True))
+    object_file = self.writeAndRead()
+
+    self.assertEqual(object_file.getObjectCount(), 6)
+    objects = [object_file.getObject(i) for i in range(1, 6)]
+    for expected in [('string', 'world'), ('null', None),
+        ('blob', b'\x00\xff'), ('boolean', True)]:
+      self.assertIn(expected, objects)
+
+  def test_indexFlushedInChunks(self):
+    output = io.BytesIO()
+    writer = wrapt.WraptFileWriter(output, 10000)
+    for i in range(10000):
+      writer.appendObject('int', i)
+    writer.finish()
+    object_file = createObjectFile(wrapt.ByteArrayBinaryFile(output.getvalue()))
+    self.assertEqual(object_file.getObjects([0, 4095, 4096, 9999]),
+        [('int', 0), ('int', 4095), ('int', 4096), ('int', 9999)])
+
+  def test_objectCountMismatchFails(self):
+    writer = wrapt.WraptFileWriter(io.BytesIO(), 2)
+    writer.appendObject('int', 1)
+    with self.assertRaises(ValueError):
+      writer.finish()
+
+class IndexAllocatorTest(unittest.TestCase):
+  def setUp(self):
+    self.__store = InMemoryObjectStore()
+
+  def setTreeData(self):
+    self.__store._setData(
+        ('map', wrapt.WraptRefMap('root', {'a': 2, 'b': 3, 'z': 1})),
+        ('null', None),
+        ('map', wrapt.WraptRefMap('node', {'c': 4})),
+        ('int', 3),
+        ('int', 4))
+
+  def test_depthFirstOrder(self):
+    self.setTreeData()
+    allocator = wrapt.IndexAllocator(self.__store)
+    index_map = allocator.allocate()
+    self.assertEqual(list(allocator.getAllocationOrder()), [0, 2, 4, 3, 1])
+    self.assertEqual(list(index_map), [0, 12, 6, 11, 10])
+    self.assertEqual(allocator.getObjectCount(), 13)
+
+  def test_breadthFirstOrder(self):
+    self.setTreeData()
+    allocator = wrapt.IndexAllocator(self.__store, order='bfs')
+    allocator.allocate()
+    self.assertEqual(list(allocator.getAllocationOrder()), [0, 2, 3, 1, 4])
+
+  def test_unknownOrderFails(self):
+    with self.assertRaises(ValueError):
+      wrapt.IndexAllocator(self.__store, order='random')
+
+  def test_deepChain(self):
+    chain_length = 100000
+    objects = [('map', wrapt.WraptRefMap('node', {'next': 1}))]
+    for i in range(1, chain_length):
+      objects.append(('map', wrapt.WraptRefMap('node', {'next': i + 1})))
+    objects.append(('int', 0))
+    self.__store._setData(*objects)
+
+    for order in ('dfs', 'bfs', 'clustered'):
+      allocator = wrapt.IndexAllocator(self.__store, order=order)
+      allocator.allocate()
+      self.assertEqual(len(allocator.getAllocationOrder()), chain_length + 1)
+
+  def setDeepTreeData(self):
+    self.__store._setData(
+        ('map', wrapt.WraptRefMap('root', {'a': 2, 'b': 3, 'z': 1})),
+        ('null', None),
+        ('map', wrapt.WraptRefMap('node', {'c': 4})),
+        ('map', wrapt.WraptRefMap('node', {'d': 5})),
+        ('map', wrapt.WraptRefMap('node', {'e': 6})),
+        ('int', 5),
+        ('int', 6))
+
+  def assertAllocationOrder(self, expected_order, **kwargs):
+    allocator = wrapt.IndexAllocator(self.__store, **kwargs)
+    index_map = allocator.allocate()
+    order = list(allocator.getAllocationOrder())
+    self.assertEqual(order, expected_order)
+    self.assertEqual(sorted(index_map[index] for index in order),
+        [index_map[index] for index in order])
+    return index_map
+
+  def test_layoutOrders(self):
+    self.setDeepTreeData()
+    self.assertAllocationOrder([0, 2, 4, 6, 3, 5, 1], order='dfs')
+    self.assertAllocationOrder([0, 2, 3, 1, 4, 5, 6], order='bfs')
+    self.assertAllocationOrder([0, 2, 3, 1, 4, 6, 5], order='clustered')
+
+  def test_traceOrder(self):
+    self.setDeepTreeData()
+    index_map = self.assertAllocationOrder([0, 5, 3, 2, 4, 6, 1],
+        order='trace', access_trace=[5, 3, 99, 5])
+    self.assertEqual(list(index_map), [0, 20, 11, 7, 15, 6, 19])
+
+  def test_traceRequiresTrace(self):
+    with self.assertRaises(ValueError):
+      wrapt.IndexAllocator(self.__store, order='trace')
+    with self.assertRaises(ValueError):
+      wrapt.IndexAllocator(self.__store, access_trace=[1])
+
+class WraptTracingObjectFileTest(unittest.TestCase):
+  def test_recordsReads(self):
+    tracing_file = wrapt.WraptTracingObjectFile(
+        CountingObjectFile([('int', i) for i in range(5)]))
+    tracing_file.getObject(3)
+    tracing_file.getObjects([1, 4])
+    tracing_file.getObject(3)
+    self.assertEqual(list(tracing_file.getTrace()), [3, 1, 4, 3])
+
+def writeStoreData(*objects, **kwargs):
+  store = InMemoryObjectStore()
+  store._setData(*objects)
+  output = io.BytesIO()
+  wrapt.WraptOutputProcessor(store).writeFile(output, **kwargs)
+  return output.getvalue()
+
+def openWraptFile(binfile):
+  store = wrapt.WraptObjectStore(
+      wrapt.WraptCachedObjectFile(createObjectFile(binfile)))
+  return wrapt.WraptFile(store, wrapt.WraptHandleFactory())
+
+class WraptBinaryMapTest(unittest.TestCase):
+  def test_readMap(self):
+    self.assertReadMap(True)
+
+  def test_readMapWithoutStringTable(self):
+    self.assertReadMap(False)
+
+  def assertReadMap(self, use_string_table):
+    wrapt_file = openWraptFile(wrapt.ByteArrayBinaryFile(writeStoreData(
+        ('map', wrapt.WraptRefMap('obj', {'hello': 1, 'goodbye': 2})),
+        ('int', 12),
+        ('float', 2.0),
+        use_string_table=use_string_table)))
+    wrapt_map = wrapt_file.getRootHandle().asMap()
+
+    self.assertEqual(len(wrapt_map), 2)
+    self.assertEqual(wrapt_map.getTag(), 'obj')
+    self.assertEqual(wrapt_map.getValue('hello').asInt(), 12)
+    self.assertEqual(wrapt_map['goodbye'].asFloat(), 2.0)
+    self.assertIs(wrapt_map.getValue('missing'), None)
+    self.assertFalse(wrapt_map.contains('missing'))
+    self.assertEqual(sorted(wrapt_map), ['goodbye', 'hello'])
+    self.assertEqual(sorted(key for key, _ in wrapt_map.getEntries()),
+        ['goodbye', 'hello'])
+    with self.assertRaises(KeyError):
+      wrapt_map['missing']
+    with self.assertRaises(ValueError):
+      wrapt_map['hello'] = 5
+
+  def test_nonMapIsNone(self):
+    wrapt_file = openWraptFile(
+        wrapt.ByteArrayBinaryFile(writeStoreData(('int', 1))))
+    self.assertIs(wrapt_file.getRootHandle().asMap(), None)
+
+  def test_emptyMap(self):
+    wrapt_file = openWraptFile(wrapt.ByteArrayBinaryFile(
+        writeStoreData(('map', wrapt.WraptRefMap('empty', {})))))
+    wrapt_map = wrapt_file.getRootHandle().asMap()
+    self.assertEqual(len(wrapt_map), 0)
+    self.assertIs(wrapt_map.getValue('anything'), None)
+
+  def test_largeMapLookupReadsLittle(self):
+    field_count = 20000
+    fields = dict(('field{0}'.format(i), 1) for i in range(field_count))
+    binfile = CountingBinaryFile(wrapt.ByteArrayBinaryFile(writeStoreData(
+        ('map', wrapt.WraptRefMap('big', fields)), ('int', 7))))
+    wrapt_map = openWraptFile(binfile).getRootHandle().asMap()
+    self.assertEqual(len(wrapt_map), field_count)
+
+    binfile.read_count = 0
+    self.assertEqual(wrapt_map.getValue('field12345').asInt(), 7)
+    self.assertLess(binfile.read_count, 16)
+
+  def test_missingFieldSkipsHashTable(self):
+    fields = dict(('field{0}'.format(i), 1) for i in range(100))
+    binfile = CountingBinaryFile(wrapt.ByteArrayBinaryFile(writeStoreData(
+        ('map', wrapt.WraptRefMap('big', fields)), ('int', 7))))
+    wrapt_map = openWraptFile(binfile).getRootHandle().asMap()
+
+    binfile.read_count = 0
+    self.assertIs(wrapt_map.getValue('missing'), None)
+    self.assertEqual(binfile.read_count, 0)
+
+class WraptStringTableTest(unittest.TestCase):
+  def setUp(self):
+    self.__long_string = 'x' * 300
+    self.__table = wrapt.WraptStringTable.fromStrings(
+        ['pear', 'apple', self.__long_string, 'apple', '\u00e9t\u00e9'])
+
+  def test_sortedAndInterned(self):
+    self.assertEqual(self.__table.getStringCount(), 4)
+    offsets = [self.__table.findOffset(string) for string in
+        ['apple', 'pear', self.__long_string, '\u00e9t\u00e9']]
+    self.assertEqual(offsets, sorted(offsets))
+
+  def test_roundTrip(self):
+    table = wrapt.WraptStringTable(self.__table.getTableData())
+    for string in ['apple', 'pear', self.__long_string, '\u00e9t\u00e9']:
+      offset = table.findOffset(string)
+      self.assertIsNot(offset, None)
+      self.assertEqual(table.getString(offset), string)
+    self.assertIs(table.findOffset('banana'), None)
+
+  def test_truncatedTableFails(self):
+    with self.assertRaises(wrapt.WraptFileFormatException):
+      wrapt.WraptStringTable(self.__table.getTableData()[:-1])
+
+  def test_sharedFieldNamesShrinkFiles(self):
+    objects = [('map', wrapt.WraptRefMap('root',
+        dict(('item{0}'.format(i), i + 1) for i in range(50))))]
+    for i in range(50):
+      objects.append(('map', wrapt.WraptRefMap('item',
+          {'a_long_field_name': 51, 'another_long_field_name': 51})))
+    objects.append(('null', None))
+
+    with_table = writeStoreData(*objects)
+    without_table = writeStoreData(*objects, use_string_table=False)
+    self.assertLess(len(with_table), len(without_table) * 2 // 3)
+
+    wrapt_file = openWraptFile(wrapt.ByteArrayBinaryFile(with_table))
+    item = wrapt_file.getRootHandle().asMap().getValue('item7').asMap()
+    self.assertEqual(item.getTag(), 'item')
+    self.assertTrue(item.getValue('another_long_field_name').isNull())
+
+class WraptLazyArrayTest(unittest.TestCase):
+  def setUp(self):
+    self.__element_count = 5001
+    objects = [('array', wrapt.WraptRefArray(
+        list(range(1, self.__element_count + 1))))]
+    objects.extend(('int', i * 10) for i in range(self.__element_count))
+    self.__binfile = CountingBinaryFile(
+        wrapt.ByteArrayBinaryFile(writeStoreData(*objects)))
+    self.__array = openWraptFile(self.__binfile).getRootHandle().asArray()
+
+  def test_indexing(self):
+    self.assertEqual(len(self.__array), self.__element_count)
+    self.assertEqual(self.__array[0].asInt(), 0)
+    self.assertEqual(self.__array[-1].asInt(), (self.__element_count - 1) * 10)
+    self.assertEqual(self.__array.getElement(17).asInt(), 170)
+    with self.assertRaises(IndexError):
+      self.__array[self.__element_count]
+
+  def test_slicesAreViews(self):
+    view = self.__array[10:20]
+    self.assertIsInstance(view, wrapt.WraptLazyArray)
+    self.assertEqual(len(view), 10)
+    self.assertEqual(view[0].asInt(), 100)
+    stepped = view[::3]
+    self.assertEqual([handle.asInt() for handle in stepped],
+        [100, 130, 160, 190])
+    self.assertEqual(len(self.__array[::-1]), self.__element_count)
+    self.assertEqual(self.__array[::-1][0].asInt(),
+        (self.__element_count - 1) * 10)
+
+  def test_chunkedIterationBatchesReads(self):
+    self.__binfile.read_count = 0
+    values = [handle.asInt() for handle in self.__array]
+    self.assertEqual(values, [i * 10 for i in range(self.__element_count)])
+    self.assertLess(self.__binfile.read_count, 20)
+
+  def test_iterationReusesBatchWithoutCache(self):
+    wrapt_file = wrapt.WraptFile(
+        wrapt.WraptObjectStore(createObjectFile(self.__binfile)),
+        wrapt.WraptHandleFactory())
+    wrapt_array = wrapt_file.getRootHandle().asArray()
+    self.__binfile.read_count = 0
+    values = [handle.asInt() for handle in wrapt_array]
+    self.assertEqual(values, [i * 10 for i in range(self.__element_count)])
+    self.assertLess(self.__binfile.read_count, 20)
+
+  def test_iteratedHandlesSeeLaterWrites(self):
+    handles = list(self.__array[0:2])
+    self.__array[0].createInt(99)
+    self.assertEqual(handles[0].asInt(), 99)
+    handles[1].createString('set')
+    self.assertEqual(self.__array[1].asString(), 'set')
+    self.assertEqual(handles[1].asString(), 'set')
+
+  def test_iterChunks(self):
+    chunks = list(self.__array[0:10].iterChunks(4))
+    self.assertEqual([len(chunk) for chunk in chunks], [4, 4, 2])
+
+class LiteralIndexEntryTest(unittest.TestCase):
+  def test_roundTrip(self):
+    for type_id, value in [('null', None), ('boolean', True),
+        ('boolean', False), ('int', 0), ('int', -1), ('int', (1 << 59) - 1),
+        ('int', -(1 << 59)), ('float', 0.0), ('float', -0.0), ('float', 1.5),
+        ('float', -2.0 ** 63), ('float', 2.0 ** -63), ('float', 0.1)]:
+      entry = wrapt.encodeLiteralEntry(type_id, value)
+      self.assertTrue(entry & wrapt.WraptLowLevelFile.LITERAL_FLAG)
+      decoded = wrapt.decodeLiteralEntry(entry)
+      self.assertEqual(decoded, (type_id, value))
+      if type_id == 'float':
+        self.assertEqual(struct.pack('!d', decoded[1]),
+            struct.pack('!d', value))
+
+  def test_largeValuesAreNotLiterals(self):
+    for type_id, value in [('int', 1 << 59), ('int', -(1 << 59) - 1),
+        ('float', 2.0 ** 64), ('float', 2.0 ** -64), ('float', float('inf')),
+        ('float', float('nan')), ('float', 5e-324), ('string', 'x')]:
+      self.assertIs(wrapt.encodeLiteralEntry(type_id, value), None)
+
+  def test_mixedLiteralsAndBlocks(self):
+    objects = [('array', wrapt.WraptRefArray(list(range(1, 9))))]
+    objects.extend([('string', 'before'), ('int', 1), ('boolean', False),
+        ('null', None), ('int', 1 << 62), ('float', 0.5), ('float', 1e300),
+        ('string', 'last')])
+    output = writeStoreData(*objects)
+    self.assertLess(len(output), len(writeStoreData(*objects,
+        use_literals=False)))
+
+    binfile = CountingBinaryFile(wrapt.ByteArrayBinaryFile(output))
+    low_level_file = wrapt.WraptLowLevelFile(binfile)
+    low_level_file.initialize()
+    object_file = wrapt.WraptObjectFile(low_level_file)
+    type_id, literal = low_level_file.getObject(2)
+    self.assertEqual((type_id, literal.getValue()), ('int', 1))
+    expected = [(type_id, value) for type_id, value in objects[1:]]
+    self.assertEqual([object_file.getObject(i) for i in range(1, 9)], expected)
+    self.assertEqual(object_file.getObjects(list(range(8, 0, -1))),
+        expected[::-1])
+
+    binfile.read_count = 0
+    self.assertEqual(object_file.getObject(3), ('boolean', False))
+    self.assertEqual(binfile.read_count, 1)
+
+    self.assertEqual(low_level_file.countObjectsByType(), {'array': 1,
+        'string': 2, 'int': 2, 'boolean': 1, 'null': 1, 'float': 2})
+    sizes = list(low_level_file.getObjectSizes())
+    self.assertEqual([sizes[i] for i in (2, 3, 4, 6)], [0, 0, 0, 0])
+    self.assertEqual([sizes[i] for i in (5, 7)], [8, 8])
+    self.assertTrue(low_level_file.isIndexOrdered())
+
+class PackedSizeIndexEntryTest(unittest.TestCase):
+  def test_singleIndexReadPerObject(self):
+    binfile = CountingBinaryFile(wrapt.ByteArrayBinaryFile(writeStoreData(
+        ('array', wrapt.WraptRefArray([1, 2])), ('string', 'hello'),
+        ('blob', b'abc'))))
+    object_file = createObjectFile(binfile)
+    binfile.read_count = 0
+    self.assertEqual(object_file.getObject(1), ('string', 'hello'))
+    self.assertEqual(binfile.read_count, 2)
+
+  def test_lengthPrefixedBlocks(self):
+    large_blob = bytes(range(256)) * 200
+    output = writeStoreData(('array', wrapt.WraptRefArray([1, 2, 3])),
+        ('blob', large_blob), ('string', ''), ('null', None),
+        use_literals=False)
+    low_level_file = wrapt.WraptLowLevelFile(wrapt.ByteArrayBinaryFile(output))
+    low_level_file.initialize()
+    object_file = wrapt.WraptObjectFile(low_level_file)
+    self.assertEqual(object_file.getObjects([2, 1, 3]),
+        [('string', ''), ('blob', large_blob), ('null', None)])
+    self.assertEqual(list(low_level_file.getObjectSizes()),
+        [12, len(large_blob), 0, 0])
+
+  def test_outOfOrderData(self):
+    file_data = bytearray(buildLowLevelFileData([
+      (wrapt.WraptLowLevelFile.STRING_TYPE, b'first'),
+      (wrapt.WraptLowLevelFile.INT_TYPE, struct.pack('!q', 5)),
+      (wrapt.WraptLowLevelFile.STRING_TYPE, b'third')]))
+    file_data[48:56], file_data[64:72] = file_data[64:72], file_data[48:56]
+    low_level_file = wrapt.WraptLowLevelFile(
+        wrapt.ByteArrayBinaryFile(bytes(file_data)))
+    low_level_file.initialize()
+    object_file = wrapt.WraptObjectFile(low_level_file)
+    self.assertFalse(low_level_file.isIndexOrdered())
+    self.assertEqual(object_file.getObjects([0, 1, 2]),
+        [('string', 'third'), ('int', 5), ('string', 'first')])
+
+  def test_blockPastEndFails(self):
+    file_data = buildLowLevelFileData(
+        [(wrapt.WraptLowLevelFile.STRING_TYPE, b'short')])
+    entry, = struct.unpack('!Q', file_data[48:56])
+    file_data = (file_data[:48] + struct.pack('!Q', entry + (100 << 48)) +
+        file_data[56:])
+    with self.assertRaises(wrapt.WraptFileFormatException):
+      createObjectFile(wrapt.ByteArrayBinaryFile(file_data)).getObject(0)
+
+class BlockingObjectStore:
+  def __init__(self, objects):
+    self.__objects = objects
+    self.release = threading.Event()
+    self.fetch_count = 0
+
+  def getObject(self, index):
+    self.fetch_count += 1
+    self.release.wait()
+    return self.__objects[index]
+
+  def getObjects(self, indexes):
+    self.fetch_count += 1
+    self.release.wait()
+    return [self.__objects[index] for index in indexes]
+
+  def hasOverride(self, index):
+    return False
+
+class AsyncWraptFileTest(unittest.TestCase):
+  def setUp(self):
+    file_data = writeStoreData(
+        ('map', wrapt.WraptRefMap('root', {'name': 1, 'items': 2})),
+        ('string', 'wrapt'),
+        ('array', wrapt.WraptRefArray([3, 4, 5])),
+        ('int', 1), ('int', 2), ('float', 3.5))
+    self.__wrapt_file = wrapt.AsyncWraptFile(wrapt.WraptObjectStore(
+        createObjectFile(wrapt.ByteArrayBinaryFile(file_data))))
+
+  def test_readPaths(self):
+    async def readPaths():
+      root = await self.__wrapt_file.getRootHandle().asMap()
+      self.assertEqual(len(root), 2)
+      self.assertEqual(await root.getTag(), 'root')
+      self.assertIs(await root.getValue('missing'), None)
+      name, items = await asyncio.gather(
+          root.getValue('name'), root.getValue('items'))
+      items = await items.asArray()
+      self.assertEqual(len(items), 3)
+      self.assertEqual(await items[-1].asFloat(), 3.5)
+      self.assertEqual(
+          [await handle.asInt() async for handle in items[:2]], [1, 2])
+      return await name.asString()
+    self.assertEqual(asyncio.run(readPaths()), 'wrapt')
+
+  def test_duplicateFetchesCoalesced(self):
+    store = BlockingObjectStore([('int', 7), ('int', 8)])
+    async_store = wrapt.AsyncWraptObjectStore(store)
+    async def readConcurrently():
+      reads = asyncio.gather(async_store.getObject(0),
+          async_store.getObject(0), async_store.getObjects([1, 0, 1]))
+      await asyncio.sleep(0.05)
+      store.release.set()
+      return await reads
+    self.assertEqual(asyncio.run(readConcurrently()),
+        [('int', 7), ('int', 7), [('int', 8), ('int', 7), ('int', 8)]])
+    self.assertEqual(store.fetch_count, 2)
+
+  def test_iterationReusesBatch(self):
+    store = BlockingObjectStore([('int', i) for i in range(5)])
+    store.release.set()
+    async_array = wrapt.AsyncWraptArray(
+        wrapt.WraptBinaryArray(struct.pack('!5I', 0, 1, 2, 3, 4)),
+        wrapt.AsyncWraptObjectStore(store))
+    async def readAll():
+      return [await handle.asInt() async for handle in async_array]
+    self.assertEqual(asyncio.run(readAll()), [0, 1, 2, 3, 4])
+    self.assertEqual(store.fetch_count, 1)
+
+  def test_iteratedHandlesSeeLaterWrites(self):
+    store = wrapt.WraptObjectStore(createObjectFile(wrapt.ByteArrayBinaryFile(
+        writeStoreData(('array', wrapt.WraptRefArray([1, 2])),
+            ('int', 1), ('int', 2)))))
+    async def readAfterWrite():
+      items = await wrapt.AsyncWraptFile(store).getRootHandle().asArray()
+      handles = [handle async for handle in items]
+      store.setObject(handles[0].getIndex(), 'int', 99)
+      return [await handle.asInt() for handle in handles]
+    self.assertEqual(asyncio.run(readAfterWrite()), [99, 2])
+
+class ParallelWriteTest(unittest.TestCase):
+  def test_matchesSerialWrite(self):
+    element_count = 9000
+    objects = [('array', wrapt.WraptRefArray(
+        list(range(1, element_count + 2))))]
+    for i in range(1, element_count + 1):
+      if i % 4 == 0:
+        objects.append(('map', wrapt.WraptRefMap('item',
+            {'value': i - 1, 'next': min(i + 1, element_count)})))
+      elif i % 4 == 1:
+        objects.append(('string', 'string {0}'.format(i)))
+      elif i % 4 == 2:
+        objects.append(('int', (1 << 60) + i if i % 8 == 2 else i))
+      else:
+        objects.append(('blob', bytes(i % 50)))
+    objects.append(('blob', b'\x01' * 40000))
+
+    for use_string_table in (True, False):
+      serial = writeStoreData(*objects, use_string_table=use_string_table)
+      parallel = writeStoreData(*objects, use_string_table=use_string_table,
+          workers=2)
+      self.assertEqual(parallel, serial)
+
+  def test_copiesBufferValues(self):
+    objects = [('array', wrapt.WraptRefArray([1, 2])),
+        ('blob', memoryview(b'viewed blob')),
+        ('map', wrapt.WraptRefMap('item', {'data': 1}))]
+    self.assertEqual(writeStoreData(*objects, workers=2),
+        writeStoreData(*objects))
+
+class WraptOverlayWriterTest(unittest.TestCase):
+  def setUp(self):
+    self.__binfile = CountingBinaryFile(wrapt.ByteArrayBinaryFile(
+        writeStoreData(
+            ('map', wrapt.WraptRefMap('root', {'name': 1, 'count': 2})),
+            ('string', 'base'), ('int', 5))))
+    self.__base_file = createObjectFile(self.__binfile)
+    self.__store = wrapt.WraptObjectStore(self.__base_file)
+    wrapt_file = wrapt.WraptFile(self.__store, wrapt.WraptHandleFactory())
+
+    root = wrapt_file.getRootHandle()
+    root_map = root.asMap()
+    count = root_map.getValue('count')
+    count.createInt(6)
+    added = wrapt_file.createHandle()
+    added.createString('added')
+    builder = root.createMap()
+    builder.put('name', root_map.getValue('name'))
+    builder.put('count', count)
+    builder.put('added', added)
+    builder.build()
+
+  def readOverlay(self, overlay_data):
+    layered_file = wrapt.WraptLayeredObjectFile([self.__base_file,
+        createObjectFile(wrapt.ByteArrayBinaryFile(overlay_data))])
+    store = wrapt.WraptObjectStore(layered_file)
+    return wrapt.WraptFile(store, wrapt.WraptHandleFactory())
+
+  def test_writeOverrides(self):
+    for use_string_table in (True, False):
+      self.__binfile.read_count = 0
+      output = io.BytesIO()
+      ranges = wrapt.WraptOverlayWriter(
+          self.__store, use_string_table).writeFile(output)
+      self.assertEqual(self.__binfile.read_count, 0)
+      next_index = self.__store.getNextIndex()
+      self.assertEqual(ranges[-2][0] + ranges[-2][2], next_index)
+      self.assertEqual(ranges[-1][0], next_index)
+
+      root = self.readOverlay(output.getvalue()).getRootHandle().asMap()
+      self.assertEqual(sorted(root), ['added', 'count', 'name'])
+      self.assertEqual(root.getValue('name').asString(), 'base')
+      self.assertEqual(root.getValue('count').asInt(), 6)
+      self.assertEqual(root.getValue('added').asString(), 'added')
+
+  def test_writeOverlayFile(self):
+    with tempfile.TemporaryDirectory() as directory:
+      filename = os.path.join(directory, 'overlay.wrapt')
+      wrapt.WraptFile(self.__store, wrapt.WraptHandleFactory()).writeOverlay(
+          filename)
+      with open(filename, 'rb') as overlay:
+        wrapt_file = self.readOverlay(overlay.read())
+    root = wrapt_file.getRootHandle().asMap()
+    self.assertEqual(root.getValue('count').asInt(), 6)
+    self.assertEqual(root.getTag(), 'root')
+
+  def test_writeRewritesReachableObjects(self):
+    with tempfile.TemporaryDirectory() as directory:
+      filename = os.path.join(directory, 'rewritten.wrapt')
+      wrapt.WraptFile(self.__store, wrapt.WraptHandleFactory()).write(filename)
+      with open(filename, 'rb') as rewritten:
+        object_file = createObjectFile(
+            wrapt.ByteArrayBinaryFile(rewritten.read()))
+    self.assertEqual(readTree(object_file),
+        {'name': 'base', 'count': 6, 'added': 'added'})
+    self.assertEqual(object_file.getObject(0)[1].getTag(), 'root')
+
+  def test_rebuiltMapsKeepTag(self):
+    output = io.BytesIO()
+    wrapt.WraptOverlayWriter(self.__store, False).writeFile(output)
+    root = self.readOverlay(output.getvalue()).getRootHandle()
+    self.assertEqual(root.asMap().getTag(), 'root')
+    builder = root.createMap('renamed')
+    builder.build()
+    self.assertEqual(root.asMap().getTag(), 'renamed')
+
+def writeOverlay(layers, edit, use_string_table=True):
+  store = wrapt.WraptObjectStore(wrapt.WraptLayeredObjectFile(layers))
+  edit(wrapt.WraptFile(store, wrapt.WraptHandleFactory()))
+  output = io.BytesIO()
+  wrapt.WraptOverlayWriter(store, use_string_table).writeFile(output)
+  return createObjectFile(wrapt.ByteArrayBinaryFile(output.getvalue()))
+
+def readTree(object_file):
+  def readValue(handle):
+    wrapt_map = handle.asMap()
+    if wrapt_map is not None:
+      return dict((key, readValue(value))
+          for key, value in wrapt_map.getEntries())
+    wrapt_array = handle.asArray()
+    if wrapt_array is not None:
+      return [readValue(element) for element in wrapt_array]
+    for getter in (handle.asString, handle.asInt, handle.asFloat,
+        handle.asBoolean, handle.asBlob):
+      value = getter()
+      if value is not None:
+        return value
+    return None
+  store = wrapt.WraptObjectStore(object_file)
+  return readValue(wrapt.WraptFile(
+      store, wrapt.WraptHandleFactory()).getRootHandle())
+
+class WraptCompactorTest(unittest.TestCase):
+  def setUp(self):
+    self.__base = createObjectFile(wrapt.ByteArrayBinaryFile(writeStoreData(
+        ('map', wrapt.WraptRefMap('root', {'name': 1, 'items': 2})),
+        ('string', 'base'),
+        ('array', wrapt.WraptRefArray([3, 4])),
+        ('int', 1), ('float', 2.5))))
+
+    def renameRoot(wrapt_file):
+      root = wrapt_file.getRootHandle()
+      root_map = root.asMap()
+      name = wrapt_file.createHandle()
+      name.createString('first')
+      builder = root.createMap()
+      builder.put('name', name)
+      builder.put('items', root_map.getValue('items'))
+      builder.build()
+    self.__first = writeOverlay([self.__base], renameRoot, False)
+
+    def extendItems(wrapt_file):
+      items = wrapt_file.getRootHandle().asMap().getValue('items')
+      elements = list(items.asArray())
+      added = wrapt_file.createHandle()
+      added.createBoolean(True)
+      builder = items.createArray()
+      for element in elements + [added]:
+        builder.add(element)
+      builder.build()
+      elements[0].createInt(10)
+    self.__second = writeOverlay([self.__base, self.__first], extendItems)
+    self.__layers = [self.__base, self.__first, self.__second]
+    self.__expected = {'name': 'first', 'items': [10, 2.5, True]}
+
+  def test_compactAll(self):
+    self.assertEqual(readTree(wrapt.WraptLayeredObjectFile(self.__layers)),
+        self.__expected)
+    progress = []
+    output = io.BytesIO()
+    wrapt.WraptCompactor(self.__layers,
+        lambda *report: progress.append(report)).compactAll(output)
+    compacted = createObjectFile(wrapt.ByteArrayBinaryFile(output.getvalue()))
+    self.assertEqual(readTree(compacted), self.__expected)
+    self.assertEqual(progress, [('allocate', 6, 6), ('write', 6, 6)])
+    self.assertLess(compacted.getObjectCount(),
+        wrapt.WraptLayeredObjectFile(self.__layers).getObjectCount())
+
+  def test_compactTop(self):
+    progress = []
+    output = io.BytesIO()
+    ranges = wrapt.WraptCompactor(self.__layers,
+        lambda *report: progress.append(report)).compactTop(output, 2)
+    merged = createObjectFile(wrapt.ByteArrayBinaryFile(output.getvalue()))
+    self.assertEqual(merged.getIndexRanges(), ranges)
+    self.assertEqual(readTree(wrapt.WraptLayeredObjectFile(
+        [self.__base, merged])), self.__expected)
+    object_count = sum(size for _, _, size in ranges)
+    self.assertIn(('scan', object_count, object_count), progress)
+    self.assertEqual(progress[-1], ('copy', object_count, object_count))
+
+  def test_compactTooManyLayersFails(self):
+    with self.assertRaises(ValueError):
+      wrapt.WraptCompactor(self.__layers).compactTop(io.BytesIO(), 4)
+
+class CompactHandleTest(unittest.TestCase):
+  def test_handlesHaveNoInstanceDict(self):
+    wrapt_file = openWraptFile(wrapt.ByteArrayBinaryFile(writeStoreData(
+        ('map', wrapt.WraptRefMap('root', {'a': 1})), ('int', 3))))
+    root = wrapt_file.getRootHandle()
+    child = root.asMap().getValue('a')
+    for handle in (root, child):
+      self.assertFalse(hasattr(handle, '__dict__'))
+    self.assertEqual(child.asInt(), 3)
+    self.assertEqual(child.getIndex(), root.asMap().getValue('a').getIndex())
+
+class WraptMetricsTest(unittest.TestCase):
+  def test_recordsReadStack(self):
+    records = []
+    metrics = wrapt.WraptMetrics(
+        lambda kind, name, value: records.append((kind, name)))
+    with tempfile.TemporaryFile() as fileobj:
+      fileobj.write(writeStoreData(('array', wrapt.WraptRefArray([1, 2])),
+          ('string', 'metrics'), ('int', 4)))
+      fileobj.flush()
+      low_level_file = wrapt.WraptLowLevelFile(
+          wrapt.FileObjectBinaryFile(fileobj, metrics), metrics=metrics)
+      low_level_file.initialize()
+      metrics.reset()
+      cached_file = wrapt.WraptCachedObjectFile(
+          wrapt.WraptObjectFile(low_level_file), metrics=metrics)
+      store = wrapt.WraptObjectStore(cached_file, metrics)
+      store.getObject(1)
+      store.getObject(1)
+      store.getObjects([1, 2])
+      store.setObject(2, 'int', 5)
+      store.getObject(2)
+
+    snapshot = metrics.snapshot()
+    self.assertEqual(snapshot['counters'], {
+      'store.file_reads': 4,
+      'store.override_hits': 1,
+      'cache.hits': 2,
+      'cache.misses': 2,
+      'lowlevel.index_reads': 2,
+      'lowlevel.data_reads': 1,
+      'lowlevel.literal_objects': 1,
+      'binfile.reads': 3,
+      'binfile.read_bytes': 8 + 8 + len('metrics'),
+    })
+    histogram = snapshot['histograms']['binfile.read_seconds']
+    self.assertEqual(histogram['count'], 3)
+    self.assertEqual(sum(histogram['buckets']), 3)
+    self.assertEqual(snapshot['histograms']['lowlevel.get_object_seconds'][
+        'count'], 1)
+    self.assertEqual(dict((name, snapshot['histograms'][name]['count'])
+        for name in ('cache.get_object_seconds', 'cache.get_objects_seconds',
+            'store.get_object_seconds', 'store.get_objects_seconds')), {
+      'cache.get_object_seconds': 2,
+      'cache.get_objects_seconds': 1,
+      'store.get_object_seconds': 3,
+      'store.get_objects_seconds': 1,
+    })
+    self.assertIn(('counter', 'cache.hits'), records)
+    self.assertIn(('histogram', 'binfile.read_seconds'), records)
+
+  def test_sinkMayReadCache(self):
+    stats = []
+    cached_file = None
+    def sink(kind, name, value):
+      if name.startswith('cache.'):
+        stats.append(cached_file.getCacheStats()['hits'])
+    cached_file = wrapt.WraptCachedObjectFile(
+        CountingObjectFile([('int', 1)]), metrics=wrapt.WraptMetrics(sink))
+    cached_file.getObject(0)
+    cached_file.getObject(0)
+    self.assertEqual(stats[-2:], [1, 1])
+
+class CompressedDataSectionTest(unittest.TestCase):
+  def setUp(self):
+    self.__objects = [
+      ('array', wrapt.WraptRefArray([1, 2, 3, 4])),
+      ('string', 'compressed ' * 2000),
+      ('blob', bytes(range(256)) * 1000),
+      ('map', wrapt.WraptRefMap('item', {'value': 4})),
+      ('int', 1 << 62),
+    ]
+
+  def test_roundTrip(self):
+    uncompressed = writeStoreData(*self.__objects)
+    for compression in ('zlib', 'lzma'):
+      output = writeStoreData(*self.__objects, compression=compression)
+      self.assertEqual(output[:8], b'WraptCmp')
+      self.assertLess(len(output), len(uncompressed))
+      self.assertEqual(
+          readTree(createObjectFile(wrapt.ByteArrayBinaryFile(output))),
+          readTree(createObjectFile(
+              wrapt.ByteArrayBinaryFile(uncompressed))))
+
+  def test_readsOnlyNeededChunks(self):
+    binfile = CountingBinaryFile(wrapt.ByteArrayBinaryFile(
+        writeStoreData(*self.__objects, compression='zlib')))
+    object_file = createObjectFile(binfile)
+    binfile.read_count = 0
+    self.assertEqual(object_file.getObject(5), ('int', 1 << 62))
+    # One index entry read and one chunk read.
+    self.assertEqual(binfile.read_count, 2)
+    binfile.read_count = 0
+    self.assertEqual(object_file.getObject(5), ('int', 1 << 62))
+    self.assertEqual(binfile.read_count, 1)
+
+  def test_unknownCodec(self):
+    with self.assertRaises(ValueError):
+      writeStoreData(*self.__objects, compression='bogus')
+
+class ImmediateExecutor:
+  def submit(self, fn, *args):
+    future = concurrent.futures.Future()
+    future.set_result(fn(*args))
+    return future
+
+class DeferredExecutor:
+  def __init__(self):
+    self.calls = []
+
+  def submit(self, fn, *args):
+    future = concurrent.futures.Future()
+    self.calls.append((future, fn, args))
+    return future
+
+  def runAll(self):
+    while self.calls:
+      future, fn, args = self.calls.pop(0)
+      future.set_result(fn(*args))
+
+class ScanCountingCachedFile(wrapt.WraptCachedObjectFile):
+  def __init__(self, delegate):
+    super().__init__(delegate)
+    self.scanned = []
+
+  def getCachedIndexes(self, indexes):
+    indexes = list(indexes)
+    self.scanned.append(len(indexes))
+    return super().getCachedIndexes(indexes)
+
+class FailingObjectFile:
+  def __init__(self, delegate, failing_indexes):
+    self.__delegate = delegate
+    self.__failing_indexes = set(failing_indexes)
+
+  def getObject(self, index):
+    return self.getObjects([index])[0]
+
+  def getObjects(self, indexes):
+    indexes = list(indexes)
+    if self.__failing_indexes.intersection(indexes):
+      raise wrapt.WraptFileIOError()
+    return self.__delegate.getObjects(indexes)
+
+  def getObjectCount(self):
+    return self.__delegate.getObjectCount()
+
+class WraptPrefetchingObjectFileTest(unittest.TestCase):
+  def test_prefetchesLevels(self):
+    object_file = createObjectFile(wrapt.ByteArrayBinaryFile(writeStoreData(
+        ('array', wrapt.WraptRefArray([1, 2])),
+        ('map', wrapt.WraptRefMap('item', {'name': 3})),
+        ('map', wrapt.WraptRefMap('item', {'name': 4})),
+        ('string', 'first'),
+        ('string', 'second'))))
+    executor = concurrent.futures.ThreadPoolExecutor(2)
+    self.addCleanup(executor.shutdown)
+    for depth, expected_misses in ((1, 3), (2, 1)):
+      cached_file = wrapt.WraptCachedObjectFile(object_file)
+      prefetching_file = wrapt.WraptPrefetchingObjectFile(
+          cached_file, executor, depth)
+      prefetching_file.getObject(0)
+      prefetching_file.wait()
+      self.assertEqual(readTree(cached_file)[1]['name'], 'second')
+      self.assertEqual(cached_file.getCacheStats()['misses'], expected_misses)
+
+  def test_throttlesUnderCachePressure(self):
+    object_file = createObjectFile(wrapt.ByteArrayBinaryFile(writeStoreData(
+        ('array', wrapt.WraptRefArray(list(range(1, 41)))),
+        *[('int', i) for i in range(40)])))
+    cached_file = wrapt.WraptCachedObjectFile(object_file, max_entries=4)
+    prefetching_file = wrapt.WraptPrefetchingObjectFile(cached_file,
+        ImmediateExecutor(), min_window=2, max_window=16)
+
+    _, root = prefetching_file.getObject(0)
+    first, second = root.getIndexes(range(2))
+    self.assertEqual(cached_file.getCachedIndexes([first, second]),
+        set([first, second]))
+    prefetching_file.getObject(first)
+    prefetching_file.getObject(second)
+    stats = prefetching_file.getPrefetchStats()
+    self.assertEqual((stats['prefetched'], stats['used'], stats['window']),
+        (2, 2, 4))
+
+    # The next four prefetches overflow the cache, so the window shrinks.
+    prefetching_file.getObject(0)
+    prefetching_file.getObject(0)
+    stats = prefetching_file.getPrefetchStats()
+    self.assertEqual((stats['prefetched'], stats['unread'], stats['window']),
+        (6, 2, 2))
+
+  def test_creditsOnlyCompletedPrefetches(self):
+    object_file = createObjectFile(wrapt.ByteArrayBinaryFile(writeStoreData(
+        ('array', wrapt.WraptRefArray([1, 2])), ('int', 1), ('int', 2))))
+    executor = DeferredExecutor()
+    prefetching_file = wrapt.WraptPrefetchingObjectFile(
+        wrapt.WraptCachedObjectFile(object_file), executor, min_window=2)
+    _, root = prefetching_file.getObject(0)
+    first, second = root.getIndexes(range(2))
+    prefetching_file.getObject(first)
+    executor.runAll()
+    prefetching_file.getObject(second)
+    stats = prefetching_file.getPrefetchStats()
+    self.assertEqual((stats['used'], stats['window'], stats['unread']),
+        (1, 3, 0))
+
+  def test_rereadsScanBoundedChildren(self):
+    element_count = 100
+    object_file = createObjectFile(wrapt.ByteArrayBinaryFile(writeStoreData(
+        ('array', wrapt.WraptRefArray(list(range(1, element_count + 1)))),
+        *[('int', i) for i in range(element_count)])))
+    cached_file = ScanCountingCachedFile(object_file)
+    prefetching_file = wrapt.WraptPrefetchingObjectFile(cached_file,
+        ImmediateExecutor(), min_window=4, max_window=4)
+    for _ in range(3):
+      prefetching_file.getObject(0)
+    self.assertEqual(cached_file.scanned, [4])
+    _, root = object_file.getObject(0)
+    prefetching_file.getObjects(root.getIndexes(range(4)))
+    prefetching_file.getObject(0)
+    self.assertEqual(cached_file.scanned, [4, 4])
+
+  def test_countsFailedPrefetches(self):
+    object_file = createObjectFile(wrapt.ByteArrayBinaryFile(writeStoreData(
+        ('array', wrapt.WraptRefArray([1, 2])),
+        ('int', 1 << 62), ('int', 1 << 61))))
+    _, root = object_file.getObject(0)
+    cached_file = wrapt.WraptCachedObjectFile(
+        FailingObjectFile(object_file, root.getIndexes(range(1))))
+    prefetching_file = wrapt.WraptPrefetchingObjectFile(
+        cached_file, ImmediateExecutor())
+    prefetching_file.getObject(0)
+    stats = prefetching_file.getPrefetchStats()
+    self.assertEqual((stats['failed'], stats['unread']), (1, 0))
+
+  def test_skipsPrefetchAfterShutdown(self):
+    object_file = createObjectFile(wrapt.ByteArrayBinaryFile(writeStoreData(
+        ('array', wrapt.WraptRefArray([1])), ('int', 1 << 62))))
+    executor = concurrent.futures.ThreadPoolExecutor(1)
+    executor.shutdown()
+    prefetching_file = wrapt.WraptPrefetchingObjectFile(
+        wrapt.WraptCachedObjectFile(object_file), executor)
+    prefetching_file.getObject(0)
+    prefetching_file.wait()
+    self.assertEqual(prefetching_file.getPrefetchStats()['unread'], 0)
+
+
+class WraptColumnsTest(unittest.TestCase):
+  def writeTable(self, use_string_table):
+    return writeStoreData(
+        ('array', wrapt.WraptRefArray([1, 2, 3, 10])),
+        ('map', wrapt.WraptRefMap('row', {'id': 4, 'score': 5, 'name': 6})),
+        ('map', wrapt.WraptRefMap('row', {'id': 7, 'score': 8, 'name': 9})),
+        ('map', wrapt.WraptRefMap('row', {'name': 11, 'id': 12})),
+        ('int', 1), ('float', 0.5), ('string', 'first'),
+        ('int', 2), ('float', 1.5), ('string', 'second'),
+        ('string', 'not a map'), ('string', 'third'), ('int', 3),
+        use_string_table=use_string_table)
+
+  def test_getColumns(self):
+    for use_string_table in (True, False):
+      wrapt_file = openWraptFile(wrapt.ByteArrayBinaryFile(
+          self.writeTable(use_string_table)))
+      rows = wrapt_file.getRootHandle().asArray()
+      columns = rows[:3].getColumns(['id', 'name'], chunk_size=2)
+      self.assertEqual(list(columns['id']), [1, 2, 3])
+      self.assertNotIsInstance(columns['id'], list)
+      self.assertEqual(columns['name'], ['first', 'second', 'third'])
+
+      columns = rows.getColumns(['score', 'missing'])
+      self.assertEqual(columns['score'], [0.5, 1.5, None, None])
+      self.assertEqual(columns['missing'], [None] * 4)
+      self.assertEqual(list(rows[:2].getColumns(['score'])['score']),
+          [0.5, 1.5])
+
+  def test_emptyColumnsMatchIntColumns(self):
+    wrapt_file = openWraptFile(wrapt.ByteArrayBinaryFile(
+        self.writeTable(True)))
+    rows = wrapt_file.getRootHandle().asArray()
+    empty_column = rows[:0].getColumns(['id'])['id']
+    self.assertEqual(len(empty_column), 0)
+    self.assertIs(type(empty_column), type(rows[:3].getColumns(['id'])['id']))
+
+  def test_inMemoryArrayColumns(self):
+    wrapt_file = wrapt.WraptFile(wrapt.WraptObjectStore(createObjectFile(
+        wrapt.ByteArrayBinaryFile(self.writeTable(True)))),
+        wrapt.WraptHandleFactory())
+    file_rows = wrapt_file.getRootHandle().asArray()
+    row = wrapt_file.createHandle()
+    row_builder = row.createMap('row')
+    row_id = wrapt_file.createHandle()
+    row_id.createInt(4)
+    row_builder.put('id', row_id)
+    row_builder.build()
+    array_builder = wrapt_file.getRootHandle().createArray()
+    for handle in list(file_rows[:2]) + [row]:
+      array_builder.add(handle)
+    array_builder.build()
+
+    rows = wrapt_file.getRootHandle().asArray()
+    self.assertIsInstance(rows, wrapt.WraptArray)
+    columns = rows.getColumns(['id', 'name'], chunk_size=2)
+    self.assertEqual(list(columns['id']), [1, 2, 4])
+    self.assertNotIsInstance(columns['id'], list)
+    self.assertEqual(columns['name'], ['first', 'second', None])
+
+  def test_asyncArrayColumns(self):
+    async_file = wrapt.AsyncWraptFile(wrapt.WraptObjectStore(createObjectFile(
+        wrapt.ByteArrayBinaryFile(self.writeTable(True)))))
+    async def readColumns():
+      rows = await async_file.getRootHandle().asArray()
+      return await rows.getColumns(['id', 'score'], chunk_size=2)
+    columns = asyncio.run(readColumns())
+    self.assertEqual(list(columns['id']), [1, 2, 3, None])
+    self.assertEqual(columns['score'], [0.5, 1.5, None, None])
@@ -1,6 +1,23 @@
+import array
+import asyncio
+import bisect
+import collections
+import collections.abc
+import concurrent.futures
 import threading
 import struct
 import itertools
+import lzma
+import mmap
+import os
+import sys
+import time
+import zlib
+
+try:
+  import numpy
+except ImportError:
+  numpy = None
 
 class WraptFileFormatException(Exception):
   pass
@@ -23,13 +40,26 @@ class WraptFile(object):
   def createHandle(self):
     return self.__wrapt_factory.createHandle(self.__object_store, self.__object_store.allocateIndex())
 
+  # Writes the objects reachable from the root as a new, self-contained file,
+  # leaving out everything unreachable. Handles stay valid, as they refer to
+  # the object store rather than the file.
   def write(self, filename):
-    raise NotImplementedError()
+    with open(filename, 'wb') as fileobj:
+      WraptOutputProcessor(WraptRewriteStore(self.__object_store)).writeFile(
+          fileobj)
+
+  # Writes only the objects changed or created since the store was opened,
+  # as an overlay file to be stacked on the files it was read from; see
+  # WraptOverlayWriter.
+  def writeOverlay(self, filename):
+    with open(filename, 'wb') as fileobj:
+      WraptOverlayWriter(self.__object_store).writeFile(fileobj)
 
 
 class WraptMapBuilder:
-  def __init__(self, dest_cell):
+  def __init__(self, dest_cell, tag=''):
     self.__dest_cell = dest_cell
+    self.__tag = tag
     self.__entries = []
     self.__has_built = False
 
@@ -39,40 +69,313 @@ class WraptMapBuilder:
   def build(self):
     if self.__has_built:
       raise ValueError("Tried to build a map twice on the same builder")
-    self.__dest_cell.setObject('map', self.__entries)
+    self.__dest_cell.setObject('map', WraptMap(self.__entries, self.__tag))
+    self.__has_built = True
+
+
+class WraptArrayBuilder:
+  def __init__(self, dest_cell):
+    self.__dest_cell = dest_cell
+    self.__elements = []
+    self.__has_built = False
+
+  def add(self, handle):
+    self.__elements.append(handle)
+
+  def build(self):
+    if self.__has_built:
+      raise ValueError("Tried to build an array twice on the same builder")
+    self.__dest_cell.setObject('array', self.__elements)
     self.__has_built = True
 
 
+# A map built in memory, from (key, handle) entries.
 class WraptMap(dict):
-  def __init__(self, entries):
+  def __init__(self, entries, tag=''):
     for key, value in entries:
       super(WraptMap, self).__setitem__(key, value)
+    self.__tag = tag
+
+  def getTag(self):
+    return self.__tag
 
   def __setitem__(self, key, value):
     raise ValueError("Cannot set a wrapt map directly")
 
+  def getValue(self, key):
+    return self.get(key)
+
+  def contains(self, key):
+    return key in self
+
+  def getEntries(self):
+    return list(self.items())
+
+
+# A read-only map over a WraptBinaryMap read from a file. Lookups go through
+# the map's on-disk hash table and only the probed keys are read; values are
+# returned as handles into the object store.
+class WraptLazyMap(collections.abc.Mapping):
+  def __init__(self, binary_map, object_store, array_map_factory=None):
+    if array_map_factory is None:
+      array_map_factory = WraptArrayMapFactory(object_store)
+    self.__binary_map = binary_map
+    self.__object_store = object_store
+    self.__array_map_factory = array_map_factory
+
+  def __createHandle(self, index):
+    return WraptHandle(WraptObjectCell(self.__object_store, index),
+        self.__array_map_factory)
+
+  def getTag(self):
+    return self.__binary_map.getTag()
+
+  def getValue(self, key):
+    value_index = self.__binary_map.findValueIndex(key)
+    if value_index is None:
+      return None
+    return self.__createHandle(value_index)
+
+  def contains(self, key):
+    return self.__binary_map.findValueIndex(key) is not None
+
+  def getEntries(self):
+    return [(key, self.__createHandle(value_index))
+        for key, value_index in self.__binary_map.getEntries()]
+
+  def __getitem__(self, key):
+    handle = self.getValue(key)
+    if handle is None:
+      raise KeyError(key)
+    return handle
+
+  def __setitem__(self, key, value):
+    raise ValueError("Cannot set a wrapt map directly")
+
+  def __contains__(self, key):
+    return self.contains(key)
+
+  def __iter__(self):
+    return iter([key for key, _ in self.__binary_map.getEntries()])
+
+  def __len__(self):
+    return len(self.__binary_map)
+
+
+# The number of elements array iteration and getColumns fetch per batch.
+ITERATION_CHUNK_SIZE = 1024
+
+# An array built in memory, from element handles on object_store.
+class WraptArray(tuple):
+  def __new__(cls, elements, object_store):
+    wrapt_array = super(WraptArray, cls).__new__(cls, elements)
+    wrapt_array.__object_store = object_store
+    return wrapt_array
+
+  def getElement(self, index):
+    return self[index]
+
+  def getElements(self):
+    return list(self)
+
+  # Reads fields from every element into columns; see readColumns.
+  def getColumns(self, fields, chunk_size=ITERATION_CHUNK_SIZE):
+    indexes = [handle.getIndex() for handle in self]
+    return readColumns(self.__object_store, fields,
+        (indexes[chunk_start:chunk_start + chunk_size]
+            for chunk_start in range(0, len(indexes), chunk_size)))
+
+
+COLUMN_TYPECODES = {'int': 'q', 'float': 'd'}
+
+# Packs the values of a column read by readColumns. A column of only ints or
+# only floats becomes a numpy array when numpy is available and an
+# array.array otherwise; any other column stays a list. A column read from no
+# elements is packed as an int column, so empty arrays give the same column
+# type as arrays of int fields.
+def createColumn(values, type_ids):
+  if not type_ids:
+    type_ids = {'int'}
+  if len(type_ids) == 1:
+    typecode = COLUMN_TYPECODES.get(next(iter(type_ids)))
+    if typecode is not None:
+      if numpy is not None:
+        return numpy.array(values, dtype=typecode)
+      return array.array(typecode, values)
+  return values
+
+
+# A read-only sequence over a WraptBinaryArray read from a file. Only the raw
+# index buffer is held: len() and indexing are O(1), slices are views over
+# the same buffer, and iteration fetches elements from the object store in
+# batches of ITERATION_CHUNK_SIZE. Handles yielded by iteration hold the
+# element as read in their batch, so they do not read the store again.
+class WraptLazyArray(collections.abc.Sequence):
+  def __init__(self, binary_array, object_store, positions=None,
+      array_map_factory=None):
+    if positions is None:
+      positions = range(len(binary_array))
+    if array_map_factory is None:
+      array_map_factory = WraptArrayMapFactory(object_store)
+    self.__binary_array = binary_array
+    self.__object_store = object_store
+    self.__positions = positions
+    self.__array_map_factory = array_map_factory
+
+  def __createHandle(self, index):
+    return WraptHandle(WraptObjectCell(self.__object_store, index),
+        self.__array_map_factory)
+
+  def __len__(self):
+    return len(self.__positions)
+
+  def __getitem__(self, key):
+    if isinstance(key, slice):
+      return WraptLazyArray(self.__binary_array, self.__object_store,
+          self.__positions[key], self.__array_map_factory)
+    return self.__createHandle(
+        self.__binary_array.getIndex(self.__positions[key]))
+
+  def getElement(self, index):
+    return self[index]
+
+  def getElements(self):
+    return list(self)
+
+  # Returns the object store indexes of the elements.
+  def getIndexes(self):
+    return self.__binary_array.getIndexes(self.__positions)
+
+  def __iterIndexChunks(self, chunk_size):
+    for chunk_start in range(0, len(self.__positions), chunk_size):
+      yield self.__binary_array.getIndexes(
+          self.__positions[chunk_start:chunk_start + chunk_size])
+
+  # Yields lists of element handles, at most chunk_size long. The elements
+  # of each chunk are fetched from the object store with a single batched
+  # read before the chunk is yielded, and the handles are backed by them.
+  def iterChunks(self, chunk_size=ITERATION_CHUNK_SIZE):
+    for indexes in self.__iterIndexChunks(chunk_size):
+      objects = self.__object_store.getObjects(indexes)
+      yield [WraptHandle(
+          WraptLoadedObjectCell(self.__object_store, index, obj),
+          self.__array_map_factory) for index, obj in zip(indexes, objects)]
+
+  def __iter__(self):
+    for chunk in self.iterChunks():
+      for handle in chunk:
+        yield handle
+
+  # Reads fields from every element into columns; see readColumns.
+  def getColumns(self, fields, chunk_size=ITERATION_CHUNK_SIZE):
+    return readColumns(self.__object_store, fields,
+        self.__iterIndexChunks(chunk_size))
+
+
+# Reads fields from the elements at the object store indexes in each chunk of
+# index_chunks into columns, returned as a dict from field to column (see
+# createColumn). Values of missing fields, and of elements that are not maps,
+# are None. Each chunk is read with one batched fetch of the maps and one of
+# their values, and no handles are created.
+def readColumns(object_store, fields, index_chunks):
+  fields = list(fields)
+  if not fields:
+    return {}
+  columns = [[] for _ in fields]
+  column_type_ids = [set() for _ in fields]
+  positions = None
+  for indexes in index_chunks:
+    value_indexes = []
+    for type_id, value in object_store.getObjects(indexes):
+      if type_id != 'map':
+        value_indexes.extend([None] * len(fields))
+      elif isinstance(value, WraptBinaryMap):
+        row_indexes, positions = value.findValueIndexes(fields, positions)
+        value_indexes.extend(row_indexes)
+      else:
+        entries = dict((key, handle.getIndex())
+            for key, handle in value.getEntries())
+        value_indexes.extend(entries.get(field) for field in fields)
+    values = iter(object_store.getObjects(
+        [index for index in value_indexes if index is not None]))
+    for position, value_index in enumerate(value_indexes):
+      column_number = position % len(fields)
+      type_id, value = ('null', None) if value_index is None else next(values)
+      columns[column_number].append(value)
+      column_type_ids[column_number].add(type_id)
+  return dict((field, createColumn(column, type_ids))
+      for field, column, type_ids in zip(fields, columns, column_type_ids))
+
 
 class WraptArrayMapFactory:
+  __slots__ = ('__object_store',)
+
   def __init__(self, object_store):
     self.__object_store = object_store
 
-  def createMapBuilder(self, object_cell):
-    return WraptMapBuilder(object_cell)
+  # If tag is None, the map keeps the tag of the map the cell holds, if any.
+  def createMapBuilder(self, object_cell, tag=None):
+    if tag is None:
+      tag = self.__getMapTag(object_cell)
+    return WraptMapBuilder(object_cell, tag)
+
+  def __getMapTag(self, object_cell):
+    try:
+      obj = object_cell.getObject()
+    except WraptIndexOutOfBoundsException:
+      return ''
+    if obj is None or obj[0] != 'map':
+      return ''
+    return obj[1].getTag()
+
+  def createArrayBuilder(self, object_cell):
+    return WraptArrayBuilder(object_cell)
+
+  def createArray(self, rawArray):
+    if rawArray is None:
+      return None
+    elif isinstance(rawArray, WraptBinaryArray):
+      return WraptLazyArray(rawArray, self.__object_store,
+          array_map_factory=self)
+    return WraptArray(rawArray, self.__object_store)
 
   def createMap(self, rawMap):
+    if rawMap is None:
+      return None
+    elif isinstance(rawMap, WraptBinaryMap):
+      return WraptLazyMap(rawMap, self.__object_store, self)
+    elif isinstance(rawMap, WraptMap):
+      return rawMap
     return WraptMap(rawMap)
 
 
+# Creates handles, sharing one WraptArrayMapFactory between all handles on
+# the same store. Handles and cells use __slots__, so each handle costs two
+# small objects.
 class WraptHandleFactory:
+  __slots__ = ('__factory_cache',)
+
+  def __init__(self):
+    self.__factory_cache = (None, None)
+
   def createHandle(self, object_store, index):
-    return WraptHandle(WraptObjectCell(object_store, index), WraptArrayMapFactory(object_store))
+    cached_store, array_map_factory = self.__factory_cache
+    if cached_store is not object_store:
+      array_map_factory = WraptArrayMapFactory(object_store)
+      self.__factory_cache = (object_store, array_map_factory)
+    return WraptHandle(WraptObjectCell(object_store, index), array_map_factory)
 
 
 class WraptObjectCell:
+  __slots__ = ('__object_store', '__index')
+
   def __init__(self, object_store, index):
     self.__object_store = object_store
     self.__index = index
 
+  def getIndex(self):
+    return self.__index
+
   def getObject(self):
     return self.__object_store.getObject(self.__index)
 
@@ -80,11 +383,39 @@ class WraptObjectCell:
     self.__object_store.setObject(self.__index, type_id, value)
 
 
+# An object cell holding an object already fetched from a WraptObjectStore
+# by a batched read, which is returned instead of reading the store again
+# unless the index has since been set through any handle.
+class WraptLoadedObjectCell:
+  __slots__ = ('__object_store', '__index', '__object')
+
+  def __init__(self, object_store, index, obj):
+    self.__object_store = object_store
+    self.__index = index
+    self.__object = obj
+
+  def getIndex(self):
+    return self.__index
+
+  def getObject(self):
+    if self.__object_store.hasOverride(self.__index):
+      return self.__object_store.getObject(self.__index)
+    return self.__object
+
+  def setObject(self, type_id, value):
+    self.__object_store.setObject(self.__index, type_id, value)
+
+
 class WraptHandle:
+  __slots__ = ('__object_cell', '__handle_factory')
+
   def __init__(self, object_cell, handle_factory):
     self.__object_cell = object_cell
     self.__handle_factory = handle_factory 
 
+  def getIndex(self):
+    return self.__object_cell.getIndex()
+
   def __getTypedObject(self, expected_type_id):
     type_id, value = self.__object_cell.getObject()
     if type_id != expected_type_id:
@@ -129,8 +460,10 @@ class WraptHandle:
   def createBoolean(self, value):
     self.__object_cell.setObject('boolean', value)
 
-  def createMap(self):
-    return self.__handle_factory.createMapBuilder(self.__object_cell)
+  # The map is built with tag or, if it is None, with the tag of the map the
+  # handle holds, so rebuilding a map keeps its tag.
+  def createMap(self, tag=None):
+    return self.__handle_factory.createMapBuilder(self.__object_cell, tag)
 
   def createArray(self):
     return self.__handle_factory.createArrayBuilder(self.__object_cell)
@@ -142,18 +475,112 @@ class WraptHandle:
     self.__object_cell.setObject('blob', value)
 
 
+# Collects counters and latency histograms from the read stack. Binary files,
+# WraptLowLevelFile, WraptCachedObjectFile and WraptObjectStore take an
+# optional metrics argument and record nothing when it is None, so disabled
+# metrics cost one attribute check per operation.
+#
+# Histograms count observations in buckets whose upper bounds, in seconds, are
+# HISTOGRAM_BOUNDS, with a final bucket for anything slower. snapshot()
+# returns a copy of everything recorded; if given, sink is also called as
+# sink(kind, name, value) for each record, with kind 'counter' or
+# 'histogram', to forward metrics as they happen.
+class WraptMetrics:
+  HISTOGRAM_BOUNDS = tuple(1e-6 * 4 ** i for i in range(11))
+
+  def __init__(self, sink=None):
+    self.__sink = sink
+    self.__lock = threading.Lock()
+    self.__counters = collections.Counter()
+    self.__histograms = {}
+
+  def increment(self, name, amount=1):
+    with self.__lock:
+      self.__counters[name] += amount
+    if self.__sink is not None:
+      self.__sink('counter', name, amount)
+
+  def observe(self, name, seconds):
+    bucket = bisect.bisect_left(self.HISTOGRAM_BOUNDS, seconds)
+    with self.__lock:
+      histogram = self.__histograms.get(name)
+      if histogram is None:
+        histogram = self.__histograms[name] = {
+          'buckets': [0] * (len(self.HISTOGRAM_BOUNDS) + 1),
+          'count': 0,
+          'sum': 0.0,
+        }
+      histogram['buckets'][bucket] += 1
+      histogram['count'] += 1
+      histogram['sum'] += seconds
+    if self.__sink is not None:
+      self.__sink('histogram', name, seconds)
+
+  def snapshot(self):
+    with self.__lock:
+      return {
+        'counters': dict(self.__counters),
+        'histograms': dict((name, {
+          'bounds': list(self.HISTOGRAM_BOUNDS),
+          'buckets': list(histogram['buckets']),
+          'count': histogram['count'],
+          'sum': histogram['sum'],
+        }) for name, histogram in self.__histograms.items()),
+      }
+
+  def reset(self):
+    with self.__lock:
+      self.__counters.clear()
+      self.__histograms.clear()
+
+
 class WraptObjectStore:
-  def __init__(self, object_file):
+  def __init__(self, object_file, metrics=None):
     self.__object_file = object_file
-    self.__max_index = object_file.getMaxIndex()
+    self.__max_index = object_file.getObjectCount()
     self.__overrides = {}
+    self.__metrics = metrics
 
   def getObject(self, index):
+    if self.__metrics is None:
+      return self.__readObject(index)
+    start = time.perf_counter()
+    result = self.__readObject(index)
+    self.__metrics.observe(
+        'store.get_object_seconds', time.perf_counter() - start)
+    return result
+
+  def getObjects(self, indexes):
+    if self.__metrics is None:
+      return self.__readObjects(indexes)
+    start = time.perf_counter()
+    result = self.__readObjects(indexes)
+    self.__metrics.observe(
+        'store.get_objects_seconds', time.perf_counter() - start)
+    return result
+
+  def __readObject(self, index):
     if index in self.__overrides:
+      if self.__metrics is not None:
+        self.__metrics.increment('store.override_hits')
       return self.__overrides[index]
     else:
+      if self.__metrics is not None:
+        self.__metrics.increment('store.file_reads')
       return self.__object_file.getObject(index)
 
+  def __readObjects(self, indexes):
+    indexes = list(indexes)
+    file_indexes = [index for index in indexes if index not in self.__overrides]
+    if self.__metrics is not None:
+      self.__metrics.increment(
+          'store.override_hits', len(indexes) - len(file_indexes))
+      self.__metrics.increment('store.file_reads', len(file_indexes))
+    file_objects = dict(
+        zip(file_indexes, self.__object_file.getObjects(file_indexes)))
+    return [self.__overrides[index] if index in self.__overrides
+        else file_objects[index] for index in indexes]
+
   def setObject(self, index, type_id, data):
     if index >= self.__max_index:
       raise WraptIndexOutOfBoundsException
@@ -164,61 +591,1142 @@ class WraptObjectStore:
     self.__max_index += 1
     return result_index
 
+  # The index the next allocateIndex call will return.
+  def getNextIndex(self):
+    return self.__max_index
+
+  def hasOverride(self, index):
+    return index in self.__overrides
+
+  # The objects set in memory, as (index, (type_id, value)) pairs in index
+  # order.
+  def getOverrides(self):
+    return sorted(self.__overrides.items())
+
+
+# Runs reads of a synchronous object store on an executor (by default the
+# event loop's), so coroutines never block the loop and independent lookups
+# overlap. A request for an index that is already being fetched waits on that
+# fetch instead of issuing another. Must be used from a single event loop.
+class AsyncWraptObjectStore:
+  def __init__(self, object_store, executor=None):
+    self.__object_store = object_store
+    self.__executor = executor
+    self.__pending = {}
+
+  def getObjectStore(self):
+    return self.__object_store
+
+  # Calls function(*args) on the executor and returns its result.
+  async def call(self, function, *args):
+    loop = asyncio.get_running_loop()
+    return await loop.run_in_executor(self.__executor, function, *args)
+
+  def __addPending(self, index, future):
+    self.__pending[index] = future
+    def removePending(_):
+      if self.__pending.get(index) is future:
+        del self.__pending[index]
+    future.add_done_callback(removePending)
+
+  async def getObject(self, index):
+    future = self.__pending.get(index)
+    if future is None:
+      future = asyncio.ensure_future(
+          self.call(self.__object_store.getObject, index))
+      self.__addPending(index, future)
+    return await asyncio.shield(future)
+
+  async def getObjects(self, indexes):
+    indexes = list(indexes)
+    futures = dict((index, self.__pending.get(index)) for index in indexes)
+    missing = [index for index, future in futures.items() if future is None]
+    if missing:
+      loop = asyncio.get_running_loop()
+      batch = asyncio.ensure_future(
+          self.call(self.__object_store.getObjects, missing))
+      for index in missing:
+        futures[index] = loop.create_future()
+        self.__addPending(index, futures[index])
+      def resolveMissing(batch):
+        for position, index in enumerate(missing):
+          if futures[index].done():
+            continue
+          if batch.cancelled():
+            futures[index].cancel()
+          elif batch.exception() is not None:
+            futures[index].set_exception(batch.exception())
+          else:
+            futures[index].set_result(batch.result()[position])
+      batch.add_done_callback(resolveMissing)
+    unique_indexes = list(futures)
+    results = await asyncio.gather(
+        *(asyncio.shield(futures[index]) for index in unique_indexes))
+    objects = dict(zip(unique_indexes, results))
+    return [objects[index] for index in indexes]
+
+
+# The asyncio counterpart of WraptFile, for reading. Handles and containers
+# mirror the synchronous API, with every method that may read the file being
+# a coroutine.
+class AsyncWraptFile:
+  def __init__(self, object_store, executor=None):
+    self.__async_store = AsyncWraptObjectStore(object_store, executor)
+
+  def getAsyncStore(self):
+    return self.__async_store
+
+  def getRootHandle(self):
+    return AsyncWraptHandle(self.__async_store, 0)
+
+  def getHandle(self, index):
+    return AsyncWraptHandle(self.__async_store, index)
+
+
+# A handle created by a batched read may hold its object, obj, which is then
+# used instead of reading the store again unless the index has since been
+# set in the store.
+class AsyncWraptHandle:
+  __slots__ = ('__async_store', '__index', '__object')
+
+  def __init__(self, async_store, index, obj=None):
+    self.__async_store = async_store
+    self.__index = index
+    self.__object = obj
+
+  def getIndex(self):
+    return self.__index
+
+  async def __getObject(self):
+    if self.__object is not None and not (
+        self.__async_store.getObjectStore().hasOverride(self.__index)):
+      return self.__object
+    return await self.__async_store.getObject(self.__index)
+
+  async def __getTypedObject(self, expected_type_id):
+    type_id, value = await self.__getObject()
+    if type_id != expected_type_id:
+      return None
+    else:
+      return value
+
+  async def asInt(self):
+    return await self.__getTypedObject('int')
+
+  async def asFloat(self):
+    return await self.__getTypedObject('float')
+
+  async def asBoolean(self):
+    return await self.__getTypedObject('boolean')
+
+  async def asString(self):
+    return await self.__getTypedObject('string')
+
+  async def asBlob(self):
+    return await self.__getTypedObject('blob')
+
+  async def isNull(self):
+    type_id, value = await self.__getObject()
+    return type_id == 'null'
+
+  # Containers read from a file are wrapped for async access; containers set
+  # in memory are returned as the synchronous WraptMap and WraptArray.
+  async def asMap(self):
+    raw_map = await self.__getTypedObject('map')
+    if isinstance(raw_map, WraptBinaryMap):
+      return AsyncWraptMap(raw_map, self.__async_store)
+    return WraptArrayMapFactory(
+        self.__async_store.getObjectStore()).createMap(raw_map)
+
+  async def asArray(self):
+    raw_array = await self.__getTypedObject('array')
+    if isinstance(raw_array, WraptBinaryArray):
+      return AsyncWraptArray(raw_array, self.__async_store)
+    return WraptArrayMapFactory(
+        self.__async_store.getObjectStore()).createArray(raw_array)
+
+
+# Async access to a WraptBinaryMap. Field lookups may read the map's hash
+# table and key strings, so they run on the store's executor.
+class AsyncWraptMap:
+  def __init__(self, binary_map, async_store):
+    self.__binary_map = binary_map
+    self.__async_store = async_store
+
+  def __len__(self):
+    return len(self.__binary_map)
+
+  async def getTag(self):
+    return await self.__async_store.call(self.__binary_map.getTag)
+
+  async def getValue(self, key):
+    value_index = await self.__async_store.call(
+        self.__binary_map.findValueIndex, key)
+    if value_index is None:
+      return None
+    return AsyncWraptHandle(self.__async_store, value_index)
+
+  async def contains(self, key):
+    return await self.__async_store.call(
+        self.__binary_map.findValueIndex, key) is not None
+
+  async def getEntries(self):
+    entries = await self.__async_store.call(self.__binary_map.getEntries)
+    return [(key, AsyncWraptHandle(self.__async_store, value_index))
+        for key, value_index in entries]
+
+
+# Async access to a WraptBinaryArray. The index buffer is already in memory,
+# so length, indexing and slicing need no I/O; iteration fetches elements in
+# batches as WraptLazyArray does, yielding handles that hold them.
+class AsyncWraptArray:
+  def __init__(self, binary_array, async_store, positions=None):
+    if positions is None:
+      positions = range(len(binary_array))
+    self.__binary_array = binary_array
+    self.__async_store = async_store
+    self.__positions = positions
+
+  def __len__(self):
+    return len(self.__positions)
+
+  def __getitem__(self, key):
+    if isinstance(key, slice):
+      return AsyncWraptArray(
+          self.__binary_array, self.__async_store, self.__positions[key])
+    return AsyncWraptHandle(self.__async_store,
+        self.__binary_array.getIndex(self.__positions[key]))
+
+  def getElement(self, index):
+    return self[index]
+
+  def getIndexes(self):
+    return self.__binary_array.getIndexes(self.__positions)
+
+  async def iterChunks(self, chunk_size=ITERATION_CHUNK_SIZE):
+    for chunk_start in range(0, len(self.__positions), chunk_size):
+      indexes = self.__binary_array.getIndexes(
+          self.__positions[chunk_start:chunk_start + chunk_size])
+      objects = await self.__async_store.getObjects(indexes)
+      yield [AsyncWraptHandle(self.__async_store, index, obj)
+          for index, obj in zip(indexes, objects)]
+
+  # Reads fields from every element into columns on the store's executor;
+  # see readColumns.
+  async def getColumns(self, fields, chunk_size=ITERATION_CHUNK_SIZE):
+    index_chunks = [self.__binary_array.getIndexes(
+        self.__positions[chunk_start:chunk_start + chunk_size])
+        for chunk_start in range(0, len(self.__positions), chunk_size)]
+    return await self.__async_store.call(readColumns,
+        self.__async_store.getObjectStore(), fields, index_chunks)
+
+  async def getElements(self):
+    elements = []
+    async for chunk in self.iterChunks():
+      elements.extend(chunk)
+    return elements
+
+  async def __aiter__(self):
+    async for chunk in self.iterChunks():
+      for handle in chunk:
+        yield handle
+
+
+def recordBinaryRead(metrics, length, start):
+  metrics.increment('binfile.reads')
+  metrics.increment('binfile.read_bytes', length)
+  metrics.observe('binfile.read_seconds', time.perf_counter() - start)
+
 
 class ByteArrayBinaryFile:
   def __init__(self, __byte_array):
     self.__byte_array = __byte_array
 
   def readBytes(self, offset, length):
-    return self.__byte_array[offset, offset + length]
+    return self.__byte_array[offset:offset + length]
 
   def getLength(self):
     return len(self.__byte_array)
 
 class FileObjectBinaryFile:
-  def __init__(self, fileobj):
+  def __init__(self, fileobj, metrics=None):
     self.__file = fileobj
     self.__file_lock = threading.RLock()
+    self.__metrics = metrics
 
   def readBytes(self, offset, length):
+    if self.__metrics is not None:
+      start = time.perf_counter()
     with self.__file_lock:
       self.__file.seek(offset)
       result = self.__file.read(length)
       if len(result) != length:
-        raise WraptFileIoError()
-      return result
+        raise WraptFileIOError()
+    if self.__metrics is not None:
+      recordBinaryRead(self.__metrics, length, start)
+    return result
 
   def getLength(self):
     with self.__file_lock:
       self.__file.seek(0, os.SEEK_END)
       return self.__file.tell()
 
+# Reads with os.pread on the file's descriptor. Each read carries its own
+# offset and there is no shared file position, so concurrent readers need no
+# lock. os.pread is only available on Unix.
+class PreadBinaryFile:
+  def __init__(self, fileobj, metrics=None):
+    self.__fd = fileobj.fileno()
+    self.__metrics = metrics
+
+  def readBytes(self, offset, length):
+    if offset < 0:
+      raise WraptFileIOError()
+    if self.__metrics is not None:
+      start = time.perf_counter()
+    result = os.pread(self.__fd, length, offset)
+    while len(result) < length:
+      chunk = os.pread(self.__fd, length - len(result), offset + len(result))
+      if not chunk:
+        raise WraptFileIOError()
+      result += chunk
+    if self.__metrics is not None:
+      recordBinaryRead(self.__metrics, length, start)
+    return result
+
+  def getLength(self):
+    return os.fstat(self.__fd).st_size
+
+# Maps the whole file read-only. Reads are slices of a shared memoryview, so
+# they need no lock and copy nothing; pages are served by the OS page cache.
+# An empty file cannot be mapped, and is rejected as not a Wrapt file.
+#
+# close() unmaps the file at once unless slices returned by readBytes are
+# still alive, as they are while a WraptCachedObjectFile or a WraptBinaryMap
+# holds one; the mapping is then closed when the last of them is collected.
+class MmapBinaryFile:
+  def __init__(self, fileobj):
+    if os.fstat(fileobj.fileno()).st_size == 0:
+      raise WraptFileFormatException()
+    self.__mmap = mmap.mmap(fileobj.fileno(), 0, access=mmap.ACCESS_READ)
+    self.__view = memoryview(self.__mmap)
+
+  def readBytes(self, offset, length):
+    if offset < 0 or offset + length > len(self.__view):
+      raise WraptFileIOError()
+    return self.__view[offset:offset + length]
+
+  def getLength(self):
+    return len(self.__view)
+
+  def close(self):
+    if self.__mmap is None:
+      return
+    self.__view.release()
+    try:
+      self.__mmap.close()
+    except BufferError:
+      pass
+    self.__mmap = None
+
 
 class InvalidTypeException(Exception):
   pass
 
 
+# Rounds offset up to the next 8 byte boundary.
+def alignOffset(offset):
+  return (offset + 7) & ~7
+
+
+# 32-bit FNV-1a over the UTF-8 encoding of a map field name. This is the
+# hash used by the on-disk map field tables, so it must not change.
+def hashFieldName(key):
+  field_hash = 0x811c9dc5
+  for byte in key.encode('utf-8'):
+    field_hash = ((field_hash ^ byte) * 0x01000193) & 0xffffffff
+  return field_hash
+
+
+# Builds the open-addressed hash table stored alongside a map. The table is a
+# power of two number of uint32 slots, at most half full, each holding zero
+# for an empty slot or one more than the position of a field in the map's
+# entry list. Collisions are resolved by linear probing.
+def buildFieldHashTable(keys):
+  slot_count = 1
+  while slot_count < 2 * len(keys):
+    slot_count *= 2
+  slots = [0] * slot_count
+  for position, key in enumerate(keys):
+    slot = hashFieldName(key) & (slot_count - 1)
+    while slots[slot]:
+      slot = (slot + 1) & (slot_count - 1)
+    slots[slot] = position + 1
+  return struct.pack('!{0}I'.format(slot_count), *slots)
+
+
+# Encodes a single object's data block. The block's size is recorded by the
+# writer, in the index entry or as a length prefix, so the data carries none.
+def encodeObjectData(type_id, value):
+  if type_id == 'int':
+    return struct.pack('!q', value)
+  elif type_id == 'float':
+    return struct.pack('!d', value)
+  elif type_id == 'boolean':
+    return struct.pack('!Q', 1 if value else 0)
+  elif type_id == 'null':
+    return b''
+  elif type_id == 'string':
+    return value.encode('utf-8')
+  elif type_id == 'blob':
+    return bytes(value)
+  elif type_id == 'array':
+    index_data = array.array('I', value)
+    if sys.byteorder == 'little':
+      index_data.byteswap()
+    return index_data.tobytes()
+  elif type_id == 'map':
+    return struct.pack('!QQ', value.getTagIndex(), value.getHashDataIndex()) + (
+        b''.join(struct.pack('!QQ', key_index, value_index)
+            for key_index, value_index in value.getMappings()))
+  else:
+    raise ValueError("Don't support type '{0}'".format(type_id))
+
+
+# Encodes a null, boolean, int or float directly into an index entry, as
+# described in the README. Returns None if the value does not fit: ints must
+# fit in 60 signed bits, and floats must be zero or have an unbiased exponent
+# in [-63, 63], as only 7 exponent bits are kept.
+def encodeLiteralEntry(type_id, value):
+  if type_id == 'null':
+    literal_type, payload = WraptLowLevelFile.LITERAL_NULL, 0
+  elif type_id == 'boolean':
+    literal_type = (WraptLowLevelFile.LITERAL_TRUE if value
+        else WraptLowLevelFile.LITERAL_FALSE)
+    payload = 0
+  elif type_id == 'int':
+    if not -(1 << 59) <= value < (1 << 59):
+      return None
+    literal_type = WraptLowLevelFile.LITERAL_INT
+    payload = value & WraptLowLevelFile.LITERAL_PAYLOAD_MASK
+  elif type_id == 'float':
+    bits, = struct.unpack('!Q', struct.pack('!d', value))
+    exponent = (bits >> 52) & 0x7ff
+    mantissa = bits & ((1 << 52) - 1)
+    if exponent == 0 and mantissa == 0:
+      short_exponent = 0
+    elif 1023 - 63 <= exponent <= 1023 + 63:
+      short_exponent = exponent - 1023 + 64
+    else:
+      return None
+    literal_type = WraptLowLevelFile.LITERAL_FLOAT
+    payload = (bits >> 63) << 59 | short_exponent << 52 | mantissa
+  else:
+    return None
+  return (WraptLowLevelFile.LITERAL_FLAG |
+      literal_type << WraptLowLevelFile.LITERAL_TYPE_SHIFT | payload)
+
+
+# The value of a literal index entry. WraptLowLevelFile returns it in place of
+# block data, as the value is already decoded.
+class WraptLiteralValue:
+  __slots__ = ('__value',)
+
+  def __init__(self, value):
+    self.__value = value
+
+  def getValue(self):
+    return self.__value
+
+
+# Decodes a literal index entry into a (type_id, value) pair.
+def decodeLiteralEntry(entry):
+  literal_type = ((entry >> WraptLowLevelFile.LITERAL_TYPE_SHIFT) &
+      WraptLowLevelFile.TYPE_MASK)
+  payload = entry & WraptLowLevelFile.LITERAL_PAYLOAD_MASK
+  if literal_type == WraptLowLevelFile.LITERAL_NULL:
+    return 'null', None
+  elif literal_type == WraptLowLevelFile.LITERAL_INT:
+    if payload & (1 << 59):
+      payload -= 1 << 60
+    return 'int', payload
+  elif literal_type == WraptLowLevelFile.LITERAL_FLOAT:
+    short_exponent = (payload >> 52) & 0x7f
+    exponent = short_exponent - 64 + 1023 if short_exponent else 0
+    bits = ((payload >> 59) << 63 | exponent << 52 |
+        payload & ((1 << 52) - 1))
+    return 'float', struct.unpack('!d', struct.pack('!Q', bits))[0]
+  elif literal_type == WraptLowLevelFile.LITERAL_TRUE:
+    return 'boolean', True
+  elif literal_type == WraptLowLevelFile.LITERAL_FALSE:
+    return 'boolean', False
+  else:
+    raise WraptFileFormatException()
+
+
+# Encodes one object as it is stored in a file, returning its index entry and
+# its padded data block (empty for a literal entry). The entry's offset is
+# relative to the start of the block.
+def encodeIndexedObject(type_id, value, use_literals=True):
+  if use_literals:
+    literal_entry = encodeLiteralEntry(type_id, value)
+    if literal_entry is not None:
+      return literal_entry, b''
+  data = encodeObjectData(type_id, value)
+  if 0 < len(data) <= WraptLowLevelFile.SIZE_MASK:
+    size_bits = len(data) << WraptLowLevelFile.SIZE_SHIFT
+  else:
+    size_bits = 0
+    data = struct.pack('!Q', len(data)) + data
+  padding = alignOffset(len(data)) - len(data)
+  if padding:
+    data += b'\0' * padding
+  return size_bits | WraptLowLevelFile.TYPE_CODES[type_id], data
+
+
+# Encodes a sequence of (type_id, value) objects into an array of index
+# entries, with offsets relative to the start of the returned data.
+def encodeObjectBlocks(objects, use_literals=True):
+  entries = array.array('Q')
+  blocks = []
+  data_size = 0
+  for type_id, value in objects:
+    entry, block = encodeIndexedObject(type_id, value, use_literals)
+    if block:
+      entry |= data_size
+      blocks.append(block)
+      data_size += len(block)
+    entries.append(entry)
+  return entries, b''.join(blocks)
+
+
+# The string table of the write a worker process encodes shards for, set by
+# initEncodeWorker when the process starts.
+_worker_string_table = None
+
+def initEncodeWorker(table_data):
+  global _worker_string_table
+  if table_data is not None:
+    _worker_string_table = WraptStringTable(table_data)
+
+
+# Expands store objects, given as (type_id, value, base_index) with the
+# indexes in maps and arrays already remapped, into base objects, building
+# map hash tables, and encodes them with encodeObjectBlocks. This is the unit
+# of work of a parallel write, so it is a module-level function that worker
+# processes can import.
+def encodeStoreObjects(objects, use_literals=True):
+  base_objects = []
+  for type_id, value, base_index in objects:
+    if type_id in ('map', 'array'):
+      base_objects.extend(
+          value.getBaseObjects(base_index, None, _worker_string_table))
+    else:
+      base_objects.append((type_id, value))
+  return encodeObjectBlocks(base_objects, use_literals)
+
+
+# Caches decoded objects in LRU order. The cache may be bounded by entry
+# count and by approximate byte size; objects larger than max_object_bytes
+# (by default an eighth of max_bytes) are passed through uncached, so a single
+# large blob cannot flush many small, frequently used objects.
 class WraptCachedObjectFile:
+  OBJECT_OVERHEAD = 64
+  CONTAINER_ENTRY_SIZE = 16
+
+  def __init__(self, delegate, max_entries=None, max_bytes=None,
+      max_object_bytes=None, metrics=None):
+    if max_object_bytes is None and max_bytes is not None:
+      max_object_bytes = max_bytes // 8
+    self.__cache = collections.OrderedDict()
+    self.__delegate = delegate
+    self.__max_entries = max_entries
+    self.__max_bytes = max_bytes
+    self.__max_object_bytes = max_object_bytes
+    self.__cache_bytes = 0
+    self.__cache_lock = threading.Lock()
+    self.__hits = 0
+    self.__misses = 0
+    self.__evictions = 0
+    self.__metrics = metrics
+
+  def getObject(self, index):
+    if self.__metrics is None:
+      return self.__readObject(index)
+    start = time.perf_counter()
+    result = self.__readObject(index)
+    self.__metrics.observe(
+        'cache.get_object_seconds', time.perf_counter() - start)
+    return result
+
+  def getObjects(self, indexes):
+    if self.__metrics is None:
+      return self.__readObjects(indexes)
+    start = time.perf_counter()
+    result = self.__readObjects(indexes)
+    self.__metrics.observe(
+        'cache.get_objects_seconds', time.perf_counter() - start)
+    return result
+
+  # Metrics are recorded outside the cache lock, since the sink may call
+  # back into the cache.
+  def __readObject(self, index):
+    with self.__cache_lock:
+      cached = self.__cache.get(index)
+      if cached is not None:
+        self.__hits += 1
+        self.__cache.move_to_end(index)
+      else:
+        self.__misses += 1
+    if cached is not None:
+      if self.__metrics is not None:
+        self.__metrics.increment('cache.hits')
+      return cached[0]
+    if self.__metrics is not None:
+      self.__metrics.increment('cache.misses')
+    obj = self.__delegate.getObject(index)
+    self.__insert(index, obj)
+    return obj
+
+  def __readObjects(self, indexes):
+    indexes = list(indexes)
+    objects = {}
+    hit_count = 0
+    with self.__cache_lock:
+      for index in indexes:
+        if index in self.__cache:
+          hit_count += 1
+          self.__cache.move_to_end(index)
+          objects[index] = self.__cache[index][0]
+      missing_indexes = [index for index in set(indexes)
+          if index not in objects]
+      self.__hits += hit_count
+      self.__misses += len(missing_indexes)
+    if self.__metrics is not None:
+      self.__metrics.increment('cache.hits', hit_count)
+      self.__metrics.increment('cache.misses', len(missing_indexes))
+    if missing_indexes:
+      missing_objects = self.__delegate.getObjects(missing_indexes)
+      for index, obj in zip(missing_indexes, missing_objects):
+        objects[index] = obj
+        self.__insert(index, obj)
+    return [objects[index] for index in indexes]
+
+  # Loads the objects at indexes that are not cached and returns all of them,
+  # without counting hits or misses or reordering the objects already cached.
+  def prefetchObjects(self, indexes):
+    indexes = list(indexes)
+    objects = {}
+    with self.__cache_lock:
+      for index in indexes:
+        if index in self.__cache:
+          objects[index] = self.__cache[index][0]
+    missing_indexes = [index for index in dict.fromkeys(indexes)
+        if index not in objects]
+    if missing_indexes:
+      missing_objects = self.__delegate.getObjects(missing_indexes)
+      for index, obj in zip(missing_indexes, missing_objects):
+        objects[index] = obj
+        self.__insert(index, obj)
+      if self.__metrics is not None:
+        self.__metrics.increment('cache.prefetches', len(missing_indexes))
+    return [objects[index] for index in indexes]
+
+  # Returns the set of indexes that are cached, without counting hits.
+  def getCachedIndexes(self, indexes):
+    with self.__cache_lock:
+      return set(index for index in indexes if index in self.__cache)
+
+  def getObjectCount(self):
+    return self.__delegate.getObjectCount()
+
+  def getCacheStats(self):
+    with self.__cache_lock:
+      return {
+        'hits': self.__hits,
+        'misses': self.__misses,
+        'evictions': self.__evictions,
+        'entries': len(self.__cache),
+        'bytes': self.__cache_bytes,
+      }
+
+  def __insert(self, index, obj):
+    size = self.__getObjectSize(obj)
+    if self.__max_object_bytes is not None and size > self.__max_object_bytes:
+      return
+    evicted_count = 0
+    with self.__cache_lock:
+      if index in self.__cache:
+        return
+      self.__cache[index] = (obj, size)
+      self.__cache_bytes += size
+      while self.__isOverLimit():
+        _, (_, evicted_size) = self.__cache.popitem(last=False)
+        self.__cache_bytes -= evicted_size
+        evicted_count += 1
+      self.__evictions += evicted_count
+    if self.__metrics is not None and evicted_count:
+      self.__metrics.increment('cache.evictions', evicted_count)
+
+  def __isOverLimit(self):
+    if self.__max_entries is not None and len(self.__cache) > self.__max_entries:
+      return True
+    if self.__max_bytes is not None and self.__cache_bytes > self.__max_bytes:
+      return True
+    return False
+
+  def __getObjectSize(self, obj):
+    type_id, value = obj
+    if type_id in ('string', 'blob'):
+      return self.OBJECT_OVERHEAD + len(value)
+    elif type_id in ('map', 'array') and value is not None:
+      return self.OBJECT_OVERHEAD + self.CONTAINER_ENTRY_SIZE * len(value)
+    else:
+      return self.OBJECT_OVERHEAD
+
+
+# Records the order in which object indexes are read, for use as the access
+# trace of a 'trace' layout when the file is rewritten.
+class WraptTracingObjectFile:
   def __init__(self, delegate):
-    self.__cache = {}
     self.__delegate = delegate
+    self.__trace = array.array('Q')
 
   def getObject(self, index):
-    if index not in self.__cache:
-      self.__cache[index] = self.__delegate.getObject(index)
-    return self.__cache[index]
+    self.__trace.append(index)
+    return self.__delegate.getObject(index)
+
+  def getObjects(self, indexes):
+    indexes = list(indexes)
+    self.__trace.extend(indexes)
+    return self.__delegate.getObjects(indexes)
 
   def getObjectCount(self):
     return self.__delegate.getObjectCount()
 
+  def getTrace(self):
+    return self.__trace
+
+
+# Reads ahead the children of the maps and arrays read through it, down to
+# depth levels below them, on an executor, so that they are already in
+# cached_file (a WraptCachedObjectFile) when their handles are dereferenced.
+# Children that are already cached are not read ahead, nor are their own
+# children.
+#
+# Prefetching is throttled by a window on the number of prefetched objects
+# not yet read. Each read of an object whose prefetch has completed widens
+# the window by one; if the cache has evicted objects while prefetched
+# objects were still unread, the window is halved and the oldest unread
+# prefetches are written off, so read-ahead backs off before it pushes the
+# hot set out of the cache.
+#
+# Each read of a container scans at most as many of its children as the
+# window has room for, resuming where the last scan of that container
+# stopped, so rereading a large or fully scanned container is cheap. Scan
+# positions are kept for the last SCANNED_CONTAINERS containers.
+#
+# Each read submits at most one task, which walks all depth levels itself.
+# wait() blocks until the submitted tasks are done. Prefetch failures are
+# not raised, since the same read will fail again when demanded, but are
+# counted in the 'failed' stat.
+class WraptPrefetchingObjectFile:
+  MIN_WINDOW = 16
+  MAX_WINDOW = 4096
+  SCANNED_CONTAINERS = 65536
+
+  def __init__(self, cached_file, executor, depth=1, min_window=MIN_WINDOW,
+      max_window=MAX_WINDOW):
+    self.__cached_file = cached_file
+    self.__executor = executor
+    self.__depth = depth
+    self.__min_window = min_window
+    self.__max_window = max_window
+    self.__window = min_window
+    # Maps unread prefetched indexes to whether their prefetch has completed.
+    self.__unread = collections.OrderedDict()
+    self.__scan_positions = collections.OrderedDict()
+    self.__lock = threading.Lock()
+    self.__evictions = cached_file.getCacheStats()['evictions']
+    self.__prefetched = 0
+    self.__used = 0
+    self.__failed = 0
+    self.__pending = set()
+
+  def getObject(self, index):
+    self.__markRead([index])
+    obj = self.__cached_file.getObject(index)
+    self.__schedule([(index, obj)], self.__depth)
+    return obj
+
+  def getObjects(self, indexes):
+    indexes = list(indexes)
+    self.__markRead(indexes)
+    objects = self.__cached_file.getObjects(indexes)
+    self.__schedule(zip(indexes, objects), self.__depth)
+    return objects
+
+  def getObjectCount(self):
+    return self.__cached_file.getObjectCount()
+
+  def getPrefetchStats(self):
+    with self.__lock:
+      return {
+        'prefetched': self.__prefetched,
+        'used': self.__used,
+        'unread': len(self.__unread),
+        'window': self.__window,
+        'failed': self.__failed,
+      }
+
+  def wait(self):
+    while True:
+      with self.__lock:
+        pending = list(self.__pending)
+      if not pending:
+        return
+      concurrent.futures.wait(pending)
+
+  def __markRead(self, indexes):
+    with self.__lock:
+      for index in indexes:
+        if self.__unread.pop(index, False):
+          self.__used += 1
+          self.__window = min(self.__window + 1, self.__max_window)
+
+  def __schedule(self, entries, depth):
+    if depth <= 0:
+      return
+    batch = self.__selectBatch(entries)
+    if not batch:
+      return
+    try:
+      future = self.__executor.submit(self.__prefetch, batch, depth)
+    except RuntimeError:
+      self.__cancelBatch(batch)
+      return
+    with self.__lock:
+      self.__pending.add(future)
+    future.add_done_callback(self.__finishTask)
+
+  def __finishTask(self, future):
+    with self.__lock:
+      self.__pending.discard(future)
+
+  # Chooses children of the (index, object) entries to prefetch, and marks
+  # them unread.
+  def __selectBatch(self, entries):
+    containers = [(index, value) for index, (type_id, value) in entries
+        if type_id in ('map', 'array')]
+    if not containers:
+      return []
+    scans = []
+    with self.__lock:
+      self.__updateWindow()
+      room = self.__window - len(self.__unread)
+      for index, value in containers:
+        if room <= 0:
+          break
+        start = self.__scan_positions.get(index, 0)
+        if start >= len(value):
+          continue
+        end = min(len(value), start + room)
+        scans.append((value, range(start, end)))
+        room -= end - start
+        self.__scan_positions[index] = end
+        self.__scan_positions.move_to_end(index)
+        if len(self.__scan_positions) > self.SCANNED_CONTAINERS:
+          self.__scan_positions.popitem(last=False)
+    child_indexes = []
+    for value, positions in scans:
+      if isinstance(value, WraptBinaryMap):
+        child_indexes.extend(value.getValueIndexes(positions))
+      else:
+        child_indexes.extend(value.getIndexes(positions))
+    if not child_indexes:
+      return []
+    cached_indexes = self.__cached_file.getCachedIndexes(child_indexes)
+    with self.__lock:
+      batch = [index for index in dict.fromkeys(child_indexes)
+          if index not in self.__unread and index not in cached_indexes]
+      for index in batch:
+        self.__unread[index] = False
+    return batch
+
+  def __cancelBatch(self, batch):
+    with self.__lock:
+      for index in batch:
+        self.__unread.pop(index, None)
+
+  def __updateWindow(self):
+    evictions = self.__cached_file.getCacheStats()['evictions']
+    if evictions > self.__evictions and self.__unread:
+      self.__window = max(self.__window // 2, self.__min_window)
+      while len(self.__unread) > self.__window:
+        self.__unread.popitem(last=False)
+    self.__evictions = evictions
+
+  def __prefetch(self, batch, depth):
+    for level in range(depth):
+      try:
+        objects = self.__cached_file.prefetchObjects(batch)
+      except Exception:
+        self.__cancelBatch(batch)
+        with self.__lock:
+          self.__failed += 1
+        return
+      with self.__lock:
+        self.__prefetched += len(batch)
+        for index in batch:
+          if index in self.__unread:
+            self.__unread[index] = True
+      if level + 1 == depth:
+        return
+      batch = self.__selectBatch(zip(batch, objects))
+      if not batch:
+        return
+
+
+# The string table holding map tags and field names. Each string is stored
+# once as a variable-length size followed by its UTF-8 bytes, in sorted
+# order, so strings are referred to, and compared, by their byte offset into
+# the table. Decoded strings are cached by offset.
+class WraptStringTable:
+  def __init__(self, table_data):
+    self.__table_data = table_data
+    self.__offsets = array.array('L')
+    self.__strings = {}
+    self.__string_offsets = {}
+    offset = 0
+    while offset < len(table_data):
+      self.__offsets.append(offset)
+      size, offset = self.__readSize(offset)
+      offset += size
+    if offset != len(table_data):
+      raise WraptFileFormatException()
+
+  @classmethod
+  def fromStrings(cls, strings):
+    table_data = bytearray()
+    for string in sorted(set(strings)):
+      data = string.encode('utf-8')
+      table_data += cls.__encodeSize(len(data))
+      table_data += data
+    return cls(bytes(table_data))
+
+  @staticmethod
+  def __encodeSize(size):
+    groups = [size & 0x7f]
+    size >>= 7
+    while size:
+      groups.append(0x80 | (size & 0x7f))
+      size >>= 7
+    return bytes(reversed(groups))
+
+  def __readSize(self, offset):
+    size = 0
+    while True:
+      if offset >= len(self.__table_data):
+        raise WraptFileFormatException()
+      byte = self.__table_data[offset]
+      offset += 1
+      size = (size << 7) | (byte & 0x7f)
+      if not byte & 0x80:
+        return size, offset
+
+  def getTableData(self):
+    return self.__table_data
+
+  def getStringCount(self):
+    return len(self.__offsets)
+
+  def getString(self, offset):
+    string = self.__strings.get(offset)
+    if string is None:
+      size, data_offset = self.__readSize(offset)
+      string = str(self.__table_data[data_offset:data_offset + size], 'utf-8')
+      self.__strings[offset] = string
+      self.__string_offsets[string] = offset
+    return string
+
+  # Returns the offset of string in the table, or None if it is not present.
+  def findOffset(self, string):
+    offset = self.__string_offsets.get(string)
+    if offset is not None:
+      return offset
+    low, high = 0, len(self.__offsets)
+    while low < high:
+      middle = (low + high) // 2
+      middle_string = self.getString(self.__offsets[middle])
+      if middle_string == string:
+        return self.__offsets[middle]
+      elif middle_string < string:
+        low = middle + 1
+      else:
+        high = middle
+    return None
+
+
+# A map as stored in a file. Only the raw entry list is held; the tag, the
+# field hash table and the field names are read on demand, so a lookup costs
+# a hash table probe and a read of the probed key. In files with a string
+# table, tags and keys are string table offsets rather than object indexes,
+# and probed keys are compared by offset without reading them.
+class WraptBinaryMap:
+  __entry_format = struct.Struct('!QQ')
+
+  def __init__(self, object_file, tag_index, hash_data_index, entry_data,
+      string_table=None):
+    self.__object_file = object_file
+    self.__tag_index = tag_index
+    self.__hash_data_index = hash_data_index
+    self.__entry_data = entry_data
+    self.__string_table = string_table
+    self.__hash_data = None
+
+  def __len__(self):
+    return len(self.__entry_data) // self.__entry_format.size
+
+  def __getEntry(self, position):
+    return self.__entry_format.unpack_from(
+        self.__entry_data, position * self.__entry_format.size)
+
+  def __getHashData(self):
+    if self.__hash_data is None:
+      type_id, hash_data = self.__object_file.getObject(self.__hash_data_index)
+      self.__hash_data = hash_data if type_id == 'blob' else b''
+    return self.__hash_data
+
+  def getTag(self):
+    if self.__string_table is not None:
+      return self.__string_table.getString(self.__tag_index)
+    type_id, tag = self.__object_file.getObject(self.__tag_index)
+    if type_id != 'string':
+      raise WraptFileFormatException()
+    return tag
+
+  def getTagIndex(self):
+    return self.__tag_index
+
+  def getHashDataIndex(self):
+    return self.__hash_data_index
+
+  # Returns (key_index, value_index) pairs in entry order.
+  def getMappings(self):
+    return [self.__getEntry(i) for i in range(len(self))]
+
+  # Returns the value indexes of the entries at the positions in a range.
+  def getValueIndexes(self, positions):
+    return [self.__getEntry(position)[1] for position in positions]
+
+  # Returns (key, value_index) pairs in entry order, reading all keys in a
+  # single batch.
+  def getEntries(self):
+    mappings = self.getMappings()
+    if self.__string_table is not None:
+      return [(self.__string_table.getString(key_offset), value_index)
+          for key_offset, value_index in mappings]
+    keys = self.__object_file.getObjects(
+        [key_index for key_index, _ in mappings])
+    return [(key, value_index)
+        for (_, key), (_, value_index) in zip(keys, mappings)]
+
+  def findValueIndex(self, key):
+    position = self.__findPosition(key)
+    if position is None:
+      return None
+    _, value_index = self.__getEntry(position)
+    return value_index
+
+  # Returns the value indexes of keys, None for missing keys, along with the
+  # entry positions they were found at. Maps built from the same fields share
+  # entry positions, so the positions returned for one map can be passed in
+  # for the next to skip probing its hash table; each guess is checked
+  # against the key stored at that position.
+  def findValueIndexes(self, keys, positions=None):
+    found_positions = []
+    for key_number, key in enumerate(keys):
+      position = None if positions is None else positions[key_number]
+      if position is None or position >= len(self) or not self.__isKeyAt(
+          position, key):
+        position = self.__findPosition(key)
+      found_positions.append(position)
+    value_indexes = [None if position is None else self.__getEntry(position)[1]
+        for position in found_positions]
+    return value_indexes, found_positions
+
+  def __isKeyAt(self, position, key):
+    key_index, _ = self.__getEntry(position)
+    if self.__string_table is not None:
+      return key_index == self.__string_table.findOffset(key)
+    return self.__object_file.getObject(key_index) == ('string', key)
+
+  def __findPosition(self, key):
+    # A key missing from the string table cannot be a field of any map, so
+    # the hash table need not be read at all.
+    if self.__string_table is not None:
+      key_offset = self.__string_table.findOffset(key)
+      if key_offset is None:
+        return None
+
+    hash_data = self.__getHashData()
+    slot_count = len(hash_data) // 4
+    if slot_count == 0:
+      for position, (entry_key, _) in enumerate(self.getEntries()):
+        if entry_key == key:
+          return position
+      return None
+
+    slot = hashFieldName(key) & (slot_count - 1)
+    for _ in range(slot_count):
+      position, = struct.unpack_from('!I', hash_data, slot * 4)
+      if position == 0:
+        return None
+      key_index, _ = self.__getEntry(position - 1)
+      if self.__string_table is not None:
+        if key_index == key_offset:
+          return position - 1
+      elif self.__object_file.getObject(key_index) == ('string', key):
+        return position - 1
+      slot = (slot + 1) & (slot_count - 1)
+    return None
+
+
+# An array as stored in a file: a buffer of big-endian uint32 element
+# indexes, decoded on access.
+class WraptBinaryArray:
+  def __init__(self, index_data):
+    self.__index_data = index_data
+
+  def __len__(self):
+    return len(self.__index_data) // 4
+
+  def getIndex(self, position):
+    if not 0 <= position < len(self):
+      raise IndexError(position)
+    index, = struct.unpack_from('!I', self.__index_data, position * 4)
+    return index
+
+  # Decodes the indexes at the positions in a range object, in one unpack
+  # when the range is contiguous.
+  def getIndexes(self, positions):
+    if positions.step == 1 and len(positions):
+      if positions.start < 0 or positions.stop > len(self):
+        raise IndexError(positions)
+      return list(struct.unpack_from('!{0}I'.format(len(positions)),
+          self.__index_data, positions.start * 4))
+    return [self.getIndex(position) for position in positions]
+
 
 class WraptObjectFile:
   def __init__(self, low_level_file):
     self.__low_level_file = low_level_file
 
   def __getObjectValue(self, type_id, data):
-    if type_id == 'int':
-      return self.__readInt(data),
+    if isinstance(data, WraptLiteralValue):
+      return data.getValue()
+    elif type_id == 'int':
+      return self.__readInt(data)
     elif type_id == 'float':
       return self.__readFloat(data)
     elif type_id == 'string':
@@ -240,28 +1748,44 @@ class WraptObjectFile:
     type_id, data = self.__low_level_file.getObject(index)
     return (type_id, self.__getObjectValue(type_id, data))
 
+  def getObjects(self, indexes):
+    return [(type_id, self.__getObjectValue(type_id, data))
+        for type_id, data in self.__low_level_file.getObjects(indexes)]
+
+  def getPhysicalObject(self, physical_index):
+    type_id, data = self.__low_level_file.getPhysicalObject(physical_index)
+    return (type_id, self.__getObjectValue(type_id, data))
+
+  def getPhysicalObjects(self, physical_indexes):
+    return [(type_id, self.__getObjectValue(type_id, data))
+        for type_id, data
+        in self.__low_level_file.getPhysicalObjects(physical_indexes)]
+
+  def getIndexRanges(self):
+    return self.__low_level_file.getIndexRanges()
+
   def getObjectCount(self):
     return self.__low_level_file.getObjectCount()
   
   def __readInt(self, data):
     if len(data) == 8:
-      return struct.unpack("!q", data)
+      return struct.unpack("!q", data)[0]
     else:
       raise WraptFileFormatException(); # TODO(brianchin): Temporary error. Should calculate long here
 
   def __readFloat(self, data):
     if len(data) == 8:
-      return struct.unpack("!d", data)
+      return struct.unpack("!d", data)[0]
     else:
       raise WraptFileFormatException()
 
   def __readString(self, data):
-    return data.decode("utf-8")
+    return str(data, "utf-8")
 
   def __readBoolean(self, data):
     if len(data) != 8:
       raise WraptFileFormatException()
-    boolean_value = struct.unpack("!Q", data)
+    boolean_value, = struct.unpack("!Q", data)
     if boolean_value == 0:
       return False
     elif boolean_value == 1:
@@ -271,16 +1795,17 @@ class WraptObjectFile:
     
   def __readMap(self, mapData):
     size = len(mapData)
-    num_entries = (size - 16) // 16
+    if size < 16 or (size - 16) % 16 != 0:
+      raise WraptFileFormatException()
 
     tag_index, hash_data_index = struct.unpack("!QQ", mapData[0:16])
-
-    hashData = self.readBlob(hash_data_index)
-    tag = self.readString(tag_index)
-    return WraptBinaryMap(tag, hashData, mapData[16:])
+    return WraptBinaryMap(self, tag_index, hash_data_index, mapData[16:],
+        self.__low_level_file.getStringTable())
 
   def __readArray(self, data):
-    return WrapBinaryArray(data)
+    if len(data) % 4 != 0:
+      raise WraptFileFormatException()
+    return WraptBinaryArray(data)
 
   def __readNull(self, data):
     if len(data) != 0:
@@ -291,10 +1816,242 @@ class WraptObjectFile:
     return data
     
 
+# Resolves virtual object indexes to physical index entry positions using the
+# run-length encoded meta index. The ranges are held in memory as sorted
+# arrays, so each lookup is a single binary search.
+class WraptMetaIndex:
+  ENTRY_FORMAT = struct.Struct('!III')
+
+  def __init__(self, ranges):
+    ranges = sorted(ranges)
+    self.__range_starts = array.array('L', [start for start, _, _ in ranges])
+    self.__physical_starts = array.array(
+        'L', [physical_start for _, physical_start, _ in ranges])
+    self.__range_sizes = array.array('L', [size for _, _, size in ranges])
+    for i in range(1, len(ranges)):
+      if (self.__range_starts[i - 1] + self.__range_sizes[i - 1] >
+          self.__range_starts[i]):
+        raise WraptFileFormatException()
+
+  @classmethod
+  def fromBytes(cls, data, entry_count):
+    return cls([cls.ENTRY_FORMAT.unpack_from(data, i * cls.ENTRY_FORMAT.size)
+        for i in range(entry_count)])
+
+  def findPhysicalIndex(self, index):
+    i = bisect.bisect_right(self.__range_starts, index) - 1
+    if i < 0:
+      return None
+    offset = index - self.__range_starts[i]
+    if offset >= self.__range_sizes[i]:
+      return None
+    return self.__physical_starts[i] + offset
+
+  # Returns (range_start, physical_start, range_size) tuples in virtual order.
+  def getRanges(self):
+    return list(zip(
+        self.__range_starts, self.__physical_starts, self.__range_sizes))
+
+  def getObjectCount(self):
+    if not self.__range_starts:
+      return 0
+    return self.__range_starts[-1] + self.__range_sizes[-1]
+
+
+# Presents a base file and a stack of overlay files as a single object file.
+# Layers are given bottom first; an index is served by the topmost layer whose
+# meta index covers it. The layers' ranges are merged once at construction
+# into a single sorted segment table mapping virtual indexes directly to a
+# (layer, physical index) pair, so lookups are one bisect at any depth.
+class WraptLayeredObjectFile:
+  def __init__(self, layers):
+    self.__layers = list(layers)
+    self.__segment_starts = array.array('L')
+    self.__segment_ends = array.array('L')
+    self.__segment_layers = array.array('L')
+    self.__segment_physical_starts = array.array('L')
+    for segment in self.__mergeLayerRanges():
+      self.__segment_starts.append(segment[0])
+      self.__segment_ends.append(segment[1])
+      self.__segment_layers.append(segment[2])
+      self.__segment_physical_starts.append(segment[3])
+
+  # Returns (start, end, layer_number, physical_start) segments in virtual
+  # order, with each elementary interval between range boundaries assigned to
+  # the topmost layer covering it.
+  def __mergeLayerRanges(self):
+    layer_ranges = [sorted(layer.getIndexRanges()) for layer in self.__layers]
+    boundaries = sorted(set(itertools.chain.from_iterable(
+        (start, start + size)
+        for ranges in layer_ranges for start, _, size in ranges)))
+    range_positions = [0] * len(self.__layers)
+
+    segments = []
+    for segment_start, segment_end in zip(boundaries, boundaries[1:]):
+      for layer_number in reversed(range(len(self.__layers))):
+        ranges = layer_ranges[layer_number]
+        position = range_positions[layer_number]
+        while (position < len(ranges) and
+            ranges[position][0] + ranges[position][2] <= segment_start):
+          position += 1
+        range_positions[layer_number] = position
+        if position < len(ranges) and ranges[position][0] <= segment_start:
+          range_start, physical_start, _ = ranges[position]
+          physical_start += segment_start - range_start
+          previous = segments[-1] if segments else None
+          if (previous is not None and previous[1] == segment_start and
+              previous[2] == layer_number and
+              previous[3] + segment_start - previous[0] == physical_start):
+            previous[1] = segment_end
+          else:
+            segments.append(
+                [segment_start, segment_end, layer_number, physical_start])
+          break
+    return segments
+
+  def __resolve(self, index):
+    i = bisect.bisect_right(self.__segment_starts, index) - 1
+    if i < 0 or index >= self.__segment_ends[i]:
+      raise WraptIndexOutOfBoundsException()
+    return (self.__segment_layers[i],
+        self.__segment_physical_starts[i] + index - self.__segment_starts[i])
+
+  def hasObject(self, index):
+    try:
+      self.__resolve(index)
+      return True
+    except WraptIndexOutOfBoundsException:
+      return False
+
+  # Returns the (range_start, range_size) runs of indexes some layer covers.
+  def getCoveredRanges(self):
+    ranges = []
+    for start, end in zip(self.__segment_starts, self.__segment_ends):
+      if ranges and ranges[-1][0] + ranges[-1][1] == start:
+        ranges[-1][1] += end - start
+      else:
+        ranges.append([start, end - start])
+    return [tuple(covered_range) for covered_range in ranges]
+
+  def getObject(self, index):
+    layer_number, physical_index = self.__resolve(index)
+    return self.__layers[layer_number].getPhysicalObject(physical_index)
+
+  def getObjects(self, indexes):
+    indexes = list(indexes)
+    layer_requests = collections.defaultdict(list)
+    for index in set(indexes):
+      layer_number, physical_index = self.__resolve(index)
+      layer_requests[layer_number].append((index, physical_index))
+
+    objects = {}
+    for layer_number, requests in layer_requests.items():
+      layer_objects = self.__layers[layer_number].getPhysicalObjects(
+          [physical_index for _, physical_index in requests])
+      for (index, _), obj in zip(requests, layer_objects):
+        objects[index] = obj
+    return [objects[index] for index in indexes]
+
+  def getObjectCount(self):
+    if not self.__segment_ends:
+      return 0
+    return self.__segment_ends[-1]
+
+
+# The data section of a compressed file. Data blocks keep their offsets in the
+# uncompressed data, which is stored as independently compressed chunks of
+# chunk_size bytes, so a read decompresses only the chunks it spans. The
+# section starts with a SECTION_HEADER (codec, chunk size, chunk count,
+# uncompressed size and the offset of the chunk table), followed by the
+# chunks and then the chunk table: chunk_count + 1 uint64 offsets of the
+# chunks from the start of the section. The most recently used decompressed
+# chunks are kept, up to cache_chunks of them.
+class WraptCompressedDataSection:
+  SECTION_HEADER = struct.Struct('!IIQQQ')
+  CODEC_IDS = {'zlib': 1, 'lzma': 2}
+  DECOMPRESSORS = {1: zlib.decompress, 2: lzma.decompress}
+  CACHE_CHUNKS = 16
+
+  def __init__(self, binfile, section_offset, cache_chunks=CACHE_CHUNKS):
+    self.__bin_file = binfile
+    self.__section_offset = section_offset
+    (codec_id, self.__chunk_size, chunk_count, self.__data_size,
+        table_offset) = self.SECTION_HEADER.unpack(binfile.readBytes(
+            section_offset, self.SECTION_HEADER.size))
+    if codec_id not in self.DECOMPRESSORS or self.__chunk_size == 0:
+      raise WraptFileFormatException()
+    self.__decompress = self.DECOMPRESSORS[codec_id]
+    self.__chunk_offsets = array.array('Q')
+    self.__chunk_offsets.frombytes(binfile.readBytes(
+        section_offset + table_offset, 8 * (chunk_count + 1)))
+    if sys.byteorder == 'little':
+      self.__chunk_offsets.byteswap()
+    if chunk_count * self.__chunk_size < self.__data_size:
+      raise WraptFileFormatException()
+    self.__cache_chunks = cache_chunks
+    self.__chunk_cache = collections.OrderedDict()
+    self.__cache_lock = threading.Lock()
+
+  def getDataSize(self):
+    return self.__data_size
+
+  def readBytes(self, offset, length):
+    if offset < 0 or offset + length > self.__data_size:
+      raise WraptFileIOError()
+    pieces = []
+    end = offset + length
+    while offset < end:
+      chunk_number, chunk_offset = divmod(offset, self.__chunk_size)
+      chunk = self.__getChunk(chunk_number)
+      piece_end = min(len(chunk), chunk_offset + end - offset)
+      pieces.append(chunk[chunk_offset:piece_end])
+      offset += piece_end - chunk_offset
+    if len(pieces) == 1:
+      return pieces[0]
+    return b''.join(pieces)
+
+  def __getChunk(self, chunk_number):
+    with self.__cache_lock:
+      chunk = self.__chunk_cache.get(chunk_number)
+      if chunk is not None:
+        self.__chunk_cache.move_to_end(chunk_number)
+        return chunk
+    start = self.__chunk_offsets[chunk_number]
+    end = self.__chunk_offsets[chunk_number + 1]
+    try:
+      chunk = self.__decompress(bytes(self.__bin_file.readBytes(
+          self.__section_offset + start, end - start)))
+    except (zlib.error, lzma.LZMAError):
+      raise WraptFileFormatException()
+    with self.__cache_lock:
+      self.__chunk_cache[chunk_number] = chunk
+      while len(self.__chunk_cache) > self.__cache_chunks:
+        self.__chunk_cache.popitem(last=False)
+    return chunk
+
+
 class WraptLowLevelFile:
-  __header_format = struct.Struct('!8cQ')
-  HEADER_SIZE = 16
+  __header_format = struct.Struct('!8sQQ')
+  __index_header_format = struct.Struct('!II')
+  MAGIC_NUMBER = b'WraptDat'
+  COMPRESSED_MAGIC_NUMBER = b'WraptCmp'
+  HEADER_SIZE = 24
   INDEX_ENTRY_SIZE = 8
+  MAX_COALESCE_GAP = 4096
+  OFFSET_MASK = 0x0000fffffffffff8
+  TYPE_MASK = 0x7
+  SIZE_SHIFT = 48
+  SIZE_MASK = 0x7fff
+  LENGTH_PREFIX_SIZE = 8
+
+  LITERAL_FLAG = 1 << 63
+  LITERAL_TYPE_SHIFT = 60
+  LITERAL_PAYLOAD_MASK = (1 << 60) - 1
+  LITERAL_NULL = 0b000
+  LITERAL_INT = 0b001
+  LITERAL_FLOAT = 0b010
+  LITERAL_TRUE = 0b011
+  LITERAL_FALSE = 0b100
 
   INT_TYPE = 0b000
   FLOAT_TYPE = 0b001
@@ -305,160 +2062,1096 @@ class WraptLowLevelFile:
   NULL_TYPE = 0b110
   BLOB_TYPE = 0b111
 
-  def __init__(self, binfile):
+  TYPE_CODES = {
+    'int': INT_TYPE,
+    'float': FLOAT_TYPE,
+    'string': STRING_TYPE,
+    'boolean': BOOLEAN_TYPE,
+    'map': MAP_TYPE,
+    'array': ARRAY_TYPE,
+    'null': NULL_TYPE,
+    'blob': BLOB_TYPE,
+  }
+
+  # The data block typecode reported for each literal type.
+  LITERAL_TYPE_CODES = {
+    LITERAL_NULL: NULL_TYPE,
+    LITERAL_INT: INT_TYPE,
+    LITERAL_FLOAT: FLOAT_TYPE,
+    LITERAL_TRUE: BOOLEAN_TYPE,
+    LITERAL_FALSE: BOOLEAN_TYPE,
+  }
+
+  def __init__(self, binfile, preload_index=False, metrics=None):
     self.__bin_file = binfile; 
     self.__data_offset = None;
-    self.__max_index = None;
+    self.__data_size = None
+    self.__data_section = None
+    self.__string_table_offset = None
+    self.__string_table = None
+    self.__index_offset = None
+    self.__index_size = None
+    self.__meta_index = None
+    self.__preload_index = preload_index
+    self.__index_table = None
+    self.__metrics = metrics
 
   def initialize(self):
-    header_data = self.__bin_file.readBytes(0, HEADER_SIZE)
+    header_data = self.__bin_file.readBytes(0, self.HEADER_SIZE)
     self.__file_size = self.__bin_file.getLength()
-    magic_number, self.__data_offset = self.__header_format.unpack(header_data)
-    if magic_number != 'WraptDat':
+    magic_number, self.__string_table_offset, self.__data_offset = (
+        self.__header_format.unpack(header_data))
+    if magic_number not in (self.MAGIC_NUMBER, self.COMPRESSED_MAGIC_NUMBER):
       raise WraptFileFormatException() 
-    self.__max_index = (self.__data_offset - HEADER_SIZE) // INDEX_ENTRY_SIZE
 
-  def __getIndexEntry(self, index):
-    if index >= self.__max_index:
-      raise WraptIndexOutOfBoundsException()
-    offset = HEADER_SIZE + index * INDEX_ENTRY_SIZE
-    return struct.unpack('!Q', self.__bin_file.readBytes(offset, INDEX_ENTRY_SIZE))
+    metaindex_size, self.__index_size = self.__index_header_format.unpack(
+        self.__bin_file.readBytes(
+            self.HEADER_SIZE, self.__index_header_format.size))
+    metaindex_offset = self.HEADER_SIZE + self.__index_header_format.size
+    metaindex_length = metaindex_size * WraptMetaIndex.ENTRY_FORMAT.size
+    self.__meta_index = WraptMetaIndex.fromBytes(
+        self.__bin_file.readBytes(metaindex_offset, metaindex_length),
+        metaindex_size)
+    self.__index_offset = alignOffset(metaindex_offset + metaindex_length)
+    if (self.__index_offset + self.__index_size * self.INDEX_ENTRY_SIZE >
+        self.__data_offset):
+      raise WraptFileFormatException()
+    if magic_number == self.COMPRESSED_MAGIC_NUMBER:
+      self.__data_section = WraptCompressedDataSection(
+          self.__bin_file, self.__data_offset)
+      self.__data_size = self.__data_section.getDataSize()
+    else:
+      self.__data_size = self.__file_size - self.__data_offset
 
-  def __getIndexInfo(self, index):
-    data = self.__getIndexEntry(index)
-    offset = data & 0xfffffff8
-    typecode = data & 0x7
-    return offset, typecode
+    if self.__preload_index:
+      self.__index_table = self.loadIndexTable()
+
+  # Reads count physical index entries starting at start (by default, the
+  # whole index) into a WraptIndexTable for bulk decoding.
+  def loadIndexTable(self, start=0, count=None):
+    if count is None:
+      count = self.__index_size - start
+    if start < 0 or count < 0 or start + count > self.__index_size:
+      raise WraptIndexOutOfBoundsException()
+    entry_data = self.__bin_file.readBytes(
+        self.__index_offset + start * self.INDEX_ENTRY_SIZE,
+        count * self.INDEX_ENTRY_SIZE)
+    return WraptIndexTable(entry_data, start)
+
+  def countObjectsByType(self):
+    table = self.__index_table or self.loadIndexTable()
+    return dict((self.__toTypeId(typecode), count)
+        for typecode, count in table.countByTypeCode().items())
+
+  # Returns the data size of every physical object; literal entries have size
+  # 0. Blocks too large for the index Size field have their length prefix
+  # read, one read each.
+  def getObjectSizes(self):
+    table = self.__index_table or self.loadIndexTable()
+    sizes = table.getSizes()
+    for position in table.getLengthPrefixedPositions():
+      start, end = self.__getBlockRange(table.getEntry(position))
+      sizes[position - table.getStart()] = end - start
+    return sizes
+
+  def isIndexOrdered(self):
+    table = self.__index_table or self.loadIndexTable()
+    return table.isOrdered()
+
+  def getIndexRanges(self):
+    return self.__meta_index.getRanges()
+
+  # Returns the file's WraptStringTable, read in full on first use, or None
+  # if the file has no string table.
+  def getStringTable(self):
+    if self.__string_table is None and self.__string_table_offset:
+      table_size, = struct.unpack('!I',
+          self.__bin_file.readBytes(self.__string_table_offset, 4))
+      self.__string_table = WraptStringTable(self.__bin_file.readBytes(
+          self.__string_table_offset + 4, table_size))
+    return self.__string_table
+
+  def hasObject(self, index):
+    return self.__meta_index.findPhysicalIndex(index) is not None
+
+  def __getPhysicalIndex(self, index):
+    physical_index = self.__meta_index.findPhysicalIndex(index)
+    if physical_index is None or physical_index >= self.__index_size:
+      raise WraptIndexOutOfBoundsException()
+    return physical_index
 
-  def __toTypeId(typecode):
-    if typecode == INT_TYPE:
+  def __getIndexEntry(self, physical_index):
+    if physical_index >= self.__index_size:
+      raise WraptIndexOutOfBoundsException()
+    if self.__index_table is not None:
+      return self.__index_table.getEntry(physical_index)
+    offset = self.__index_offset + physical_index * self.INDEX_ENTRY_SIZE
+    if self.__metrics is not None:
+      self.__metrics.increment('lowlevel.index_reads')
+    entry, = struct.unpack(
+        '!Q', self.__bin_file.readBytes(offset, self.INDEX_ENTRY_SIZE))
+    return entry
+
+  def __isLiteral(self, entry):
+    return entry & self.LITERAL_FLAG != 0
+
+  # Literal entries carry their value in the index, so no data is read; the
+  # decoded value is returned as a WraptLiteralValue.
+  def __getLiteralObject(self, entry):
+    if self.__metrics is not None:
+      self.__metrics.increment('lowlevel.literal_objects')
+    type_id, value = decodeLiteralEntry(entry)
+    return type_id, WraptLiteralValue(value)
+
+  # Returns the (start, end) data offsets of a block entry's contents. Most
+  # blocks are sized by the entry's Size field; a Size of 0 means the block
+  # starts with a uint64 length, which costs an extra read.
+  def __getBlockRange(self, entry):
+    offset = entry & self.OFFSET_MASK
+    size = (entry >> self.SIZE_SHIFT) & self.SIZE_MASK
+    if size == 0:
+      if self.__metrics is not None:
+        self.__metrics.increment('lowlevel.data_reads')
+      size, = struct.unpack('!Q',
+          self.__readData(offset, self.LENGTH_PREFIX_SIZE))
+      offset += self.LENGTH_PREFIX_SIZE
+    if offset + size > self.__data_size:
+      raise WraptFileFormatException()
+    return offset, offset + size
+
+  # Reads from the data section, by offset within it.
+  def __readData(self, offset, length):
+    if self.__data_section is not None:
+      return self.__data_section.readBytes(offset, length)
+    return self.__bin_file.readBytes(self.__data_offset + offset, length)
+
+  # Reads the index entries for the sorted, unique physical indexes given.
+  # Like data ranges, indexes whose entries lie within MAX_COALESCE_GAP bytes
+  # of each other share a single read, so strided batches stay cheap.
+  def __getIndexEntryRuns(self, sorted_indexes):
+    if self.__index_table is not None:
+      return {index: self.__index_table.getEntry(index)
+          for index in sorted_indexes}
+    index_entries = {}
+    for run in self.__getRuns(sorted_indexes):
+      run_start = run[0]
+      entry_count = run[-1] + 1 - run_start
+      if self.__metrics is not None:
+        self.__metrics.increment('lowlevel.index_reads')
+      entry_data = self.__bin_file.readBytes(
+          self.__index_offset + run_start * self.INDEX_ENTRY_SIZE,
+          entry_count * self.INDEX_ENTRY_SIZE)
+      entries = struct.unpack('!{0}Q'.format(entry_count), entry_data)
+      for index in run:
+        index_entries[index] = entries[index - run_start]
+    return index_entries
+
+  def __getRuns(self, sorted_indexes):
+    max_index_gap = self.MAX_COALESCE_GAP // self.INDEX_ENTRY_SIZE
+    runs = []
+    for index in sorted_indexes:
+      if runs and index - runs[-1][-1] <= max_index_gap:
+        runs[-1].append(index)
+      else:
+        runs.append([index])
+    return runs
+
+  def __toTypeId(self, typecode):
+    if typecode == self.INT_TYPE:
       return 'int'
-    elif typecode == FLOAT_TYPE:
+    elif typecode == self.FLOAT_TYPE:
       return 'float'
-    elif typecode == STRING_TYPE:
+    elif typecode == self.STRING_TYPE:
       return 'string'
-    elif typecode == BOOLEAN_TYPE:
+    elif typecode == self.BOOLEAN_TYPE:
       return 'boolean'
-    elif typecode == MAP_TYPE:
+    elif typecode == self.MAP_TYPE:
       return 'map'
-    elif typecode == ARRAY_TYPE:
+    elif typecode == self.ARRAY_TYPE:
       return 'array'
-    elif typecode == NULL_TYPE:
+    elif typecode == self.NULL_TYPE:
       return 'null'
-    elif typecode == BLOB_TYPE:
+    elif typecode == self.BLOB_TYPE:
       return 'blob'
     else:
       raise WraptFileFormatException()
 
   def getObject(self, index):
-    index_offset, typecode = self.__getIndexInfo(index);
-    type_id = self._toTypeId(typecode)
-
-    try:
-      next_offset, _ = self.__getIndexInfo(index + 1)
-    except WraptIndexOutOfBoundsException:
-      next_offset = self.__file_size - self.__data_offset
-    data_size = next_offset - index_offset
-
-    object_data = self.__bin_file.readBytes(self.__data_offset + index_offset)
-
-    return type_id, object_data
-
+    return self.getPhysicalObject(self.__getPhysicalIndex(index))
+
+  def getPhysicalObject(self, physical_index):
+    if self.__metrics is None:
+      return self.__readPhysicalObject(physical_index)
+    start = time.perf_counter()
+    result = self.__readPhysicalObject(physical_index)
+    self.__metrics.observe(
+        'lowlevel.get_object_seconds', time.perf_counter() - start)
+    return result
+
+  def __readPhysicalObject(self, physical_index):
+    entry = self.__getIndexEntry(physical_index)
+    if self.__isLiteral(entry):
+      return self.__getLiteralObject(entry)
+    type_id = self.__toTypeId(entry & self.TYPE_MASK)
+    start, end = self.__getBlockRange(entry)
+    if self.__metrics is not None:
+      self.__metrics.increment('lowlevel.data_reads')
+    return type_id, self.__readData(start, end - start)
+
+  # Reads many objects at once. Index entries and data ranges closer than
+  # MAX_COALESCE_GAP bytes are merged into single reads, so walking a large container costs a handful of reads.
+  def getObjects(self, indexes):
+    physical_indexes = [self.__getPhysicalIndex(index) for index in indexes]
+    return self.getPhysicalObjects(physical_indexes)
+
+  def getPhysicalObjects(self, physical_indexes):
+    if self.__metrics is None:
+      return self.__readPhysicalObjects(physical_indexes)
+    start = time.perf_counter()
+    result = self.__readPhysicalObjects(physical_indexes)
+    self.__metrics.observe(
+        'lowlevel.get_objects_seconds', time.perf_counter() - start)
+    return result
+
+  def __readPhysicalObjects(self, physical_indexes):
+    physical_indexes = list(physical_indexes)
+    sorted_indexes = sorted(set(physical_indexes))
+    if sorted_indexes and sorted_indexes[-1] >= self.__index_size:
+      raise WraptIndexOutOfBoundsException()
+    index_entries = self.__getIndexEntryRuns(sorted_indexes)
+
+    objects = {}
+    data_ranges = []
+    for index in sorted_indexes:
+      entry = index_entries[index]
+      if self.__isLiteral(entry):
+        objects[index] = self.__getLiteralObject(entry)
+        continue
+      start, end = self.__getBlockRange(entry)
+      data_ranges.append((start, end, index, entry & self.TYPE_MASK))
+    data_ranges.sort()
+
+    range_group = []
+    for data_range in data_ranges:
+      if range_group and (
+          data_range[0] - range_group[-1][1] > self.MAX_COALESCE_GAP):
+        self.__readRangeGroup(range_group, objects)
+        range_group = []
+      range_group.append(data_range)
+    if range_group:
+      self.__readRangeGroup(range_group, objects)
+
+    return [objects[index] for index in physical_indexes]
+
+  def __readRangeGroup(self, range_group, objects):
+    group_start = range_group[0][0]
+    group_end = max(end for _, end, _, _ in range_group)
+    if self.__metrics is not None:
+      self.__metrics.increment('lowlevel.data_reads')
+    group_data = self.__readData(group_start, group_end - group_start)
+    for start, end, index, typecode in range_group:
+      objects[index] = (self.__toTypeId(typecode),
+          group_data[start - group_start:end - group_start])
+
+  # The number of virtual indexes covered by the meta index. In an overlay
+  # file, some of these may be holes that fall through to lower layers.
   def getObjectCount(self):
-    return self.__max_index
-
-# Writes data contained in a store to a writer.
+    return self.__meta_index.getObjectCount()
+
+
+# A decoded window of index entries. Entries are held as a native uint64
+# array and decoded in bulk: with numpy, each operation is a single
+# vectorized pass; otherwise the stdlib array module does the byte swapping
+# and the masking runs in Python.
+class WraptIndexTable:
+  def __init__(self, entry_data, start=0):
+    self.__start = start
+    if numpy is not None:
+      self.__entries = numpy.frombuffer(entry_data, dtype='>u8').astype(
+          numpy.uint64)
+    else:
+      self.__entries = array.array('Q')
+      self.__entries.frombytes(entry_data)
+      if sys.byteorder == 'little':
+        self.__entries.byteswap()
+
+  def getStart(self):
+    return self.__start
+
+  def getEntryCount(self):
+    return len(self.__entries)
+
+  def getEntry(self, index):
+    return int(self.__entries[index - self.__start])
+
+  def __getLiteralMask(self):
+    if numpy is not None:
+      return (self.__entries >> numpy.uint64(63)).astype(bool)
+    return [entry >> 63 == 1 for entry in self.__entries]
+
+  # Data offsets of the entries; literal entries have no data and report 0.
+  def getOffsets(self):
+    mask = WraptLowLevelFile.OFFSET_MASK
+    if numpy is not None:
+      return numpy.where(self.__getLiteralMask(), numpy.uint64(0),
+          self.__entries & numpy.uint64(mask))
+    return array.array('Q', (0 if is_literal else entry & mask
+        for entry, is_literal in zip(self.__entries, self.__getLiteralMask())))
+
+  # Type codes of the entries. Literal entries report the typecode of the
+  # equivalent data block, so counts do not depend on how a value was stored.
+  def getTypeCodes(self):
+    type_mask = WraptLowLevelFile.TYPE_MASK
+    type_shift = WraptLowLevelFile.LITERAL_TYPE_SHIFT
+    literal_codes = WraptLowLevelFile.LITERAL_TYPE_CODES
+    if numpy is not None:
+      literal_lookup = numpy.full(type_mask + 1, 0xff, dtype=numpy.uint8)
+      for literal_type, typecode in literal_codes.items():
+        literal_lookup[literal_type] = typecode
+      literal_types = (self.__entries >> numpy.uint64(type_shift)) & (
+          numpy.uint64(type_mask))
+      return numpy.where(self.__getLiteralMask(),
+          literal_lookup[literal_types.astype(numpy.intp)],
+          (self.__entries & numpy.uint64(type_mask)).astype(numpy.uint8))
+    return array.array('B', (
+        literal_codes.get((entry >> type_shift) & type_mask, 0xff)
+            if is_literal else entry & type_mask
+        for entry, is_literal in zip(self.__entries, self.__getLiteralMask())))
+
+  # Sizes from the entries' Size field. Literal entries, and blocks whose size
+  # is stored as a length prefix in the data, report 0.
+  def getSizes(self):
+    shift = WraptLowLevelFile.SIZE_SHIFT
+    mask = WraptLowLevelFile.SIZE_MASK
+    if numpy is not None:
+      sizes = ((self.__entries >> numpy.uint64(shift)) &
+          numpy.uint64(mask)).astype(numpy.int64)
+      sizes[self.__getLiteralMask()] = 0
+      return sizes
+    return array.array('q', (0 if is_literal else (entry >> shift) & mask
+        for entry, is_literal in zip(self.__entries, self.__getLiteralMask())))
+
+  # Absolute positions of block entries whose size is a length prefix.
+  def getLengthPrefixedPositions(self):
+    sizes = self.getSizes()
+    is_literal = self.__getLiteralMask()
+    return [self.__start + position for position in range(len(sizes))
+        if sizes[position] == 0 and not is_literal[position]]
+
+  def countByTypeCode(self):
+    type_codes = self.getTypeCodes()
+    if numpy is not None:
+      counts = numpy.bincount(type_codes, minlength=0x100)
+      return dict((typecode, int(count))
+          for typecode, count in enumerate(counts) if count)
+    return dict(collections.Counter(type_codes))
+
+  def isOrdered(self):
+    offsets = self.getOffsets()
+    if numpy is not None:
+      offsets = offsets[~self.__getLiteralMask()]
+      return bool(numpy.all(offsets[1:] >= offsets[:-1]))
+    offsets = [offset for offset, is_literal
+        in zip(offsets, self.__getLiteralMask()) if not is_literal]
+    return all(offset <= next_offset for offset, next_offset
+        in zip(offsets, itertools.islice(offsets, 1, None)))
+
+
+# Writes data contained in a store to a writer. If given, progress is passed
+# to the IndexAllocator and then called as progress('write', written, total)
+# as store objects are written.
 class WraptOutputProcessor:
-  def __init__(self, object_store):
+  SHARD_OBJECTS = 4096
+
+  def __init__(self, object_store, order='dfs', access_trace=None,
+      progress=None):
     self.__object_store = object_store    
+    self.__order = order
+    self.__access_trace = access_trace
+    self.__progress = progress
 
+  # Returns the index map from store indexes to output indexes.
   def write(self, writer):
-    index_map = IndexAllocator(self.__object_store).allocate()
+    allocator = self.__createAllocator()
+    index_map = allocator.allocate()
+    self.__write_objects(allocator.getAllocationOrder(), index_map, writer)
+    return index_map
+
+  def __createAllocator(self, use_string_table=False):
+    return IndexAllocator(self.__object_store, self.__order,
+        self.__access_trace, use_string_table, self.__progress)
+
+  # Streams the store to a seekable binary file. Objects are written in
+  # allocation order, which is already output index order, so no global sort
+  # or pair list is built; the index map is a compact integer array. Map tags
+  # and field names go into a shared string table unless use_string_table is
+  # False, in which case they are written as string objects. Small scalars are
+  # stored as literal index entries unless use_literals is False.
+  #
+  # With workers set, data blocks are encoded by a pool of that many
+  # processes. The allocation order is split into shards of SHARD_OBJECTS
+  # store objects, each expanded and encoded as a unit by encodeStoreObjects,
+  # and the shards are stitched together in order, so the output is identical
+  # to a serial write. Only index remapping stays in this process; map hash
+  # tables are built by the workers.
+  #
+  # compression may be 'zlib' or 'lzma' to compress the data section in
+  # independently readable chunks; see WraptCompressedDataSection.
+  def writeFile(self, fileobj, use_string_table=True, use_literals=True,
+      workers=None, compression=None):
+    allocator = self.__createAllocator(use_string_table)
+    index_map = allocator.allocate()
+    string_table = None
+    if use_string_table:
+      string_table = WraptStringTable.fromStrings(allocator.getTableStrings())
+    writer = WraptFileWriter(fileobj, allocator.getObjectCount(), string_table,
+        use_literals, compression=compression)
+    if workers is None:
+      self.__write_objects(allocator.getAllocationOrder(), index_map, writer,
+          string_table)
+    else:
+      self.__write_objects_parallel(allocator.getAllocationOrder(), index_map,
+          writer, string_table, use_literals, workers)
+    writer.finish()
+    return index_map
+
+  def __write_objects(self, allocation_order, index_map, writer,
+      string_table=None):
+    for written_count, store_index in enumerate(allocation_order, 1):
+      type_id, value = self.__object_store.getObject(store_index)
+      self.__write_object(type_id, value, index_map[store_index], index_map,
+          writer, string_table)
+      if written_count % IndexAllocator.PROGRESS_INTERVAL == 0:
+        self.__reportWritten(written_count, len(allocation_order))
+    self.__reportWritten(len(allocation_order), len(allocation_order))
+
+  def __reportWritten(self, written_count, total):
+    if self.__progress is not None:
+      self.__progress('write', written_count, total)
+
+  # At most 2 * workers shards are in flight at once, bounding memory use.
+  def __write_objects_parallel(self, allocation_order, index_map, writer,
+      string_table, use_literals, workers):
+    table_data = None
+    if string_table is not None:
+      table_data = string_table.getTableData()
+    with concurrent.futures.ProcessPoolExecutor(workers,
+        initializer=initEncodeWorker, initargs=(table_data,)) as executor:
+      pending_shards = collections.deque()
+      for shard_start in range(0, len(allocation_order), self.SHARD_OBJECTS):
+        objects = []
+        for store_index in allocation_order[
+            shard_start:shard_start + self.SHARD_OBJECTS]:
+          type_id, value = self.__object_store.getObject(store_index)
+          objects.append((type_id, self.__getShardValue(type_id, value,
+              index_map), index_map[store_index]))
+        pending_shards.append((min(shard_start + self.SHARD_OBJECTS,
+            len(allocation_order)),
+            executor.submit(encodeStoreObjects, objects, use_literals)))
+        if len(pending_shards) > 2 * workers:
+          self.__appendShard(pending_shards.popleft(), writer,
+              len(allocation_order))
+      while pending_shards:
+        self.__appendShard(pending_shards.popleft(), writer,
+            len(allocation_order))
+
+  # Remaps the indexes in maps and arrays, and copies buffers such as
+  # memoryviews, which cannot be sent to worker processes, into bytes.
+  def __getShardValue(self, type_id, value, index_map):
+    if type_id in ('map', 'array'):
+      return value.remapIndexes(index_map)
+    elif type_id not in ('int', 'float', 'string', 'boolean', 'blob', 'null'):
+      raise ValueError("Don't support type '{0}'".format(type_id))
+    elif isinstance(value, (bytearray, memoryview)):
+      return bytes(value)
+    return value
+
+  def __appendShard(self, pending_shard, writer, total):
+    shard_end, encoded_shard = pending_shard
+    writer.appendEncodedBlocks(*encoded_shard.result())
+    self.__reportWritten(shard_end, total)
+
+  def __write_object(self, type_id, value, base_index, index_map, writer,
+      string_table):
+    for new_type_id, new_value in self.__get_base_objects(
+        type_id, value, base_index, index_map, string_table):
+      writer.appendObject(new_type_id, new_value)
+
+  def __get_base_objects(self, type_id, value, base_index, index_map,
+      string_table):
+    if type_id in ('int', 'float', 'string', 'boolean', 'blob', 'null'):
+      return [(type_id, value)]
+    elif type_id in ('map', 'array'):
+      return value.getBaseObjects(base_index, index_map, string_table)
+    else:
+      raise ValueError("Don't support type '{0}'".format(type_id))
 
-    writer_allocations = [(output_index, store_index) 
-        for store_index, output_index in index_map.items()]
 
-    writer_allocations.sort()
+# Writes only the objects a WraptObjectStore holds in memory, that is its
+# overrides and newly allocated indexes, as an overlay file to be stacked on
+# the files the store was read from with WraptLayeredObjectFile. Nothing is
+# read from those files, so the cost is proportional to the patch.
+#
+# Objects keep their store indexes, and the meta index covers just those
+# runs. The extra objects a map is written as (its field hash table, and
+# without a string table its tag and field names) take fresh indexes from
+# the store's next index on.
+class WraptOverlayWriter:
+  def __init__(self, object_store, use_string_table=True, use_literals=True):
+    self.__object_store = object_store
+    self.__use_string_table = use_string_table
+    self.__use_literals = use_literals
+
+  # Returns the (range_start, physical_start, range_size) ranges written.
+  def writeFile(self, fileobj):
+    overrides = self.__object_store.getOverrides()
+    string_table = None
+    if self.__use_string_table:
+      table_strings = set()
+      for _, (type_id, value) in overrides:
+        if type_id == 'map':
+          table_strings.add(value.getTag())
+          table_strings.update(value)
+      string_table = WraptStringTable.fromStrings(table_strings)
+
+    extra_start = self.__object_store.getNextIndex()
+    extra_objects = []
+    objects = [self.__getBaseObject(type_id, value, extra_start, extra_objects,
+        string_table) for _, (type_id, value) in overrides]
+
+    ranges = []
+    for physical_index, (index, _) in enumerate(overrides):
+      if ranges and ranges[-1][0] + ranges[-1][2] == index:
+        ranges[-1][2] += 1
+      else:
+        ranges.append([index, physical_index, 1])
+    if extra_objects:
+      ranges.append([extra_start, len(objects), len(extra_objects)])
+    ranges = [tuple(index_range) for index_range in ranges]
+
+    writer = WraptFileWriter(fileobj, len(objects) + len(extra_objects),
+        string_table, self.__use_literals, ranges)
+    for type_id, value in itertools.chain(objects, extra_objects):
+      writer.appendObject(type_id, value)
+    writer.finish()
+    return ranges
+
+  # Converts an in-memory value to the object written at its index, adding
+  # any extra objects it needs to extra_objects.
+  def __getBaseObject(self, type_id, value, extra_start, extra_objects,
+      string_table):
+    if type_id == 'array':
+      return 'array', array.array('L',
+          (handle.getIndex() for handle in value))
+    elif type_id != 'map':
+      return type_id, value
+
+    keys = [key for key, _ in value.getEntries()]
+    value_indexes = [handle.getIndex() for _, handle in value.getEntries()]
+    hash_data_index = extra_start + len(extra_objects)
+    extra_objects.append(('blob', buildFieldHashTable(keys)))
+    if string_table is not None:
+      return 'map', WraptBaseMap(string_table.findOffset(value.getTag()),
+          hash_data_index, [(string_table.findOffset(key), value_index)
+              for key, value_index in zip(keys, value_indexes)])
+
+    tag_index = extra_start + len(extra_objects)
+    extra_objects.append(('string', value.getTag()))
+    key_start = extra_start + len(extra_objects)
+    extra_objects.extend(('string', key) for key in keys)
+    return 'map', WraptBaseMap(tag_index, hash_data_index,
+        [(key_start + i, value_index)
+            for i, value_index in enumerate(value_indexes)])
+
+
+# Presents the objects of an object file read from disk, or of an object
+# store holding maps and arrays built in memory, in the form the output
+# pipeline writes: maps as WraptRefMap and arrays as WraptRefArray.
+# Objects are converted one at a time as they are fetched, so a file of any
+# size can be rewritten through WraptOutputProcessor.
+class WraptRewriteStore:
+  def __init__(self, object_file):
+    self.__object_file = object_file
 
-    for output_index, store_index in writer_allocations:
-      type_id, value = self.__object_store.getObject(store_index)
-      self.__write_object(type_id, value, output_index, index_map, writer)
+  def getObject(self, index):
+    type_id, value = self.__object_file.getObject(index)
+    if type_id == 'map':
+      if isinstance(value, WraptMap):
+        return type_id, WraptRefMap(value.getTag(), dict(
+            (key, handle.getIndex()) for key, handle in value.getEntries()))
+      return type_id, WraptRefMap(value.getTag(), dict(value.getEntries()))
+    elif type_id == 'array':
+      if not isinstance(value, WraptBinaryArray):
+        return type_id, WraptRefArray(
+            array.array('L', (handle.getIndex() for handle in value)))
+      return type_id, WraptRefArray(value.getIndexes(range(len(value))))
+    return type_id, value
+
+
+# Rolls up a stack of layered object files, given bottom first as for
+# WraptLayeredObjectFile.
+#
+# compactAll writes everything reachable from the root into a new base file
+# through WraptOutputProcessor, dropping unreachable and shadowed objects.
+# compactTop merges only the top layer_count layers into one overlay that can
+# replace them: each index they cover is copied from the topmost layer that
+# has it and keeps its index, so the layers below stay valid. Maps are
+# rewritten against a new string table holding their tags and field names.
+#
+# Objects are streamed; memory is bounded by the allocator's per-index arrays
+# for compactAll and by the set of map strings for compactTop. If given,
+# progress is called as progress(phase, completed, total).
+class WraptCompactor:
+  COPY_CHUNK_OBJECTS = 4096
+
+  def __init__(self, layers, progress=None):
+    self.__layers = list(layers)
+    self.__progress = progress
+
+  # Returns the index map from old indexes to indexes in the new file.
+  def compactAll(self, fileobj, order='dfs', use_string_table=True,
+      use_literals=True, compression=None):
+    store = WraptRewriteStore(WraptLayeredObjectFile(self.__layers))
+    processor = WraptOutputProcessor(store, order, progress=self.__progress)
+    return processor.writeFile(fileobj, use_string_table, use_literals,
+        compression=compression)
+
+  # Returns the (range_start, physical_start, range_size) ranges written.
+  def compactTop(self, fileobj, layer_count, use_literals=True):
+    if not 0 < layer_count <= len(self.__layers):
+      raise ValueError("Cannot compact {0} of {1} layers".format(
+          layer_count, len(self.__layers)))
+    top_file = WraptLayeredObjectFile(self.__layers[-layer_count:])
+    covered_ranges = top_file.getCoveredRanges()
+
+    table_strings = set()
+    for objects in self.__iterObjectChunks(top_file, covered_ranges, 'scan'):
+      for type_id, value in objects:
+        if type_id == 'map':
+          table_strings.add(value.getTag())
+          table_strings.update(key for key, _ in value.getEntries())
+    string_table = WraptStringTable.fromStrings(table_strings)
+
+    ranges = []
+    object_count = 0
+    for start, size in covered_ranges:
+      ranges.append((start, object_count, size))
+      object_count += size
+    writer = WraptFileWriter(fileobj, object_count, string_table, use_literals,
+        ranges)
+    for objects in self.__iterObjectChunks(top_file, covered_ranges, 'copy'):
+      for type_id, value in objects:
+        writer.appendObject(*self.__getCopiedObject(type_id, value,
+            string_table))
+    writer.finish()
+    return ranges
+
+  def __iterObjectChunks(self, object_file, covered_ranges, phase):
+    total = sum(size for _, size in covered_ranges)
+    completed = 0
+    for start, size in covered_ranges:
+      for chunk_start in range(start, start + size, self.COPY_CHUNK_OBJECTS):
+        chunk_end = min(chunk_start + self.COPY_CHUNK_OBJECTS, start + size)
+        yield object_file.getObjects(range(chunk_start, chunk_end))
+        completed += chunk_end - chunk_start
+        if self.__progress is not None:
+          self.__progress(phase, completed, total)
+
+  def __getCopiedObject(self, type_id, value, string_table):
+    if type_id == 'map':
+      return 'map', WraptBaseMap(string_table.findOffset(value.getTag()),
+          value.getHashDataIndex(),
+          [(string_table.findOffset(key), value_index)
+              for key, value_index in value.getEntries()])
+    elif type_id == 'array':
+      return 'array', value.getIndexes(range(len(value)))
+    return type_id, value
 
-  def __write_object(self, type_id, value, base_index, index_map, writer):
-    if type_id == 'int':
-      writer.appendObject('int', value)
-    elif type_id == 'float':
-      writer.appendObject('float', value)
-    elif type_id ==  'map':
-      for new_type_id, value in value.getBaseObjects(base_index, index_map):
-        writer.appendObject(new_type_id, value)
-    elif type_id == 'null':
-      writer.appendObject('null', value)
-    else:
-      raise ValueError("Don't support type '{0}'".format(type_id))
 
+# Writes a WraptCompressedDataSection, compressing data as it fills chunks.
+class WraptCompressedDataWriter:
+  COMPRESSORS = {'zlib': zlib.compress, 'lzma': lzma.compress}
+  CHUNK_SIZE = 65536
+
+  def __init__(self, fileobj, section_offset, codec, chunk_size=CHUNK_SIZE):
+    if codec not in self.COMPRESSORS:
+      raise ValueError("Unknown compression codec '{0}'".format(codec))
+    self.__file = fileobj
+    self.__section_offset = section_offset
+    self.__codec = codec
+    self.__compress = self.COMPRESSORS[codec]
+    self.__chunk_size = chunk_size
+    self.__chunk_buffer = bytearray()
+    self.__chunk_offsets = array.array(
+        'Q', [WraptCompressedDataSection.SECTION_HEADER.size])
+    self.__data_size = 0
+
+  # The file position at which the next compressed chunk will be written.
+  def getFilePosition(self):
+    return self.__section_offset + self.__chunk_offsets[-1]
+
+  def write(self, data):
+    self.__chunk_buffer += data
+    self.__data_size += len(data)
+    while len(self.__chunk_buffer) >= self.__chunk_size:
+      self.__writeChunk(self.__chunk_buffer[:self.__chunk_size])
+      del self.__chunk_buffer[:self.__chunk_size]
+
+  def finish(self):
+    if self.__chunk_buffer:
+      self.__writeChunk(self.__chunk_buffer)
+      self.__chunk_buffer = bytearray()
+    table_offset = self.__chunk_offsets[-1]
+    chunk_offsets = array.array('Q', self.__chunk_offsets)
+    if sys.byteorder == 'little':
+      chunk_offsets.byteswap()
+    self.__file.seek(self.__section_offset + table_offset)
+    self.__file.write(chunk_offsets.tobytes())
+    self.__file.seek(self.__section_offset)
+    self.__file.write(WraptCompressedDataSection.SECTION_HEADER.pack(
+        WraptCompressedDataSection.CODEC_IDS[self.__codec], self.__chunk_size,
+        len(self.__chunk_offsets) - 1, self.__data_size, table_offset))
+
+  def __writeChunk(self, chunk):
+    compressed = self.__compress(bytes(chunk))
+    self.__file.seek(self.getFilePosition())
+    self.__file.write(compressed)
+    self.__chunk_offsets.append(self.__chunk_offsets[-1] + len(compressed))
+
+
+# Writes objects to a seekable binary file in the format read by
+# WraptLowLevelFile. The object count must be known up front so the index can
+# be laid out before the data section; index entries are buffered in a compact
+# array and flushed every INDEX_FLUSH_ENTRIES entries, and data blocks are
+# written as they are appended. Nulls, booleans and numbers that fit are
+# stored as literal index entries with no data block. By default the meta
+# index maps all objects to indexes from 0; ranges may instead give the
+# (range_start, physical_start, range_size) entries of an overlay file. With
+# compression set to 'zlib' or 'lzma', the data section is written as a
+# WraptCompressedDataSection under the compressed file magic number.
+class WraptFileWriter:
+  INDEX_FLUSH_ENTRIES = 4096
+
+  def __init__(self, fileobj, object_count, string_table=None,
+      use_literals=True, ranges=None, compression=None):
+    if ranges is None:
+      ranges = [(0, 0, object_count)]
+    self.__file = fileobj
+    self.__object_count = object_count
+    self.__string_table = string_table
+    self.__use_literals = use_literals
+    self.__ranges = ranges
+    self.__index_offset = alignOffset(WraptLowLevelFile.HEADER_SIZE + 8 +
+        len(ranges) * WraptMetaIndex.ENTRY_FORMAT.size)
+    self.__string_table_offset = (self.__index_offset +
+        object_count * WraptLowLevelFile.INDEX_ENTRY_SIZE)
+    self.__data_offset = self.__string_table_offset
+    if string_table is not None:
+      self.__data_offset = alignOffset(self.__string_table_offset + 4 +
+          len(string_table.getTableData()))
+    self.__data_size = 0
+    self.__entry_count = 0
+    self.__index_buffer = array.array('Q')
+    self.__data_writer = None
+    if compression is not None:
+      self.__data_writer = WraptCompressedDataWriter(
+          fileobj, self.__data_offset, compression)
+    self.__file.seek(self.__getDataEnd())
+
+  def appendObject(self, type_id, value):
+    if self.__entry_count >= self.__object_count:
+      raise ValueError("Appended more objects than were allocated")
+    entry, block = encodeIndexedObject(type_id, value, self.__use_literals)
+    if block:
+      entry |= self.__data_size
+      self.__writeData(block)
+    self.__appendIndexEntry(entry)
+
+  # Appends objects already encoded by encodeObjectBlocks. Entry offsets are
+  # relative to the start of data, and are moved to where data is written.
+  def appendEncodedBlocks(self, entries, data):
+    if self.__entry_count + len(entries) > self.__object_count:
+      raise ValueError("Appended more objects than were allocated")
+    data_start = self.__data_size
+    self.__writeData(data)
+    for entry in entries:
+      if not entry & WraptLowLevelFile.LITERAL_FLAG:
+        entry += data_start
+      self.__appendIndexEntry(entry)
+
+  def __writeData(self, data):
+    if self.__data_writer is None:
+      self.__file.write(data)
+    else:
+      self.__data_writer.write(data)
+    self.__data_size += len(data)
+
+  # The file position just past the data written so far.
+  def __getDataEnd(self):
+    if self.__data_writer is None:
+      return self.__data_offset + self.__data_size
+    return self.__data_writer.getFilePosition()
+
+  def __appendIndexEntry(self, entry):
+    self.__index_buffer.append(entry)
+    self.__entry_count += 1
+    if len(self.__index_buffer) >= self.INDEX_FLUSH_ENTRIES:
+      self.__flushIndex()
+
+  def finish(self):
+    if self.__entry_count != self.__object_count:
+      raise ValueError("Expected {0} objects, but {1} were appended".format(
+          self.__object_count, self.__entry_count))
+    self.__flushIndex()
+    magic_number = WraptLowLevelFile.MAGIC_NUMBER
+    if self.__data_writer is not None:
+      self.__data_writer.finish()
+      magic_number = WraptLowLevelFile.COMPRESSED_MAGIC_NUMBER
+    string_table_offset = 0
+    if self.__string_table is not None:
+      string_table_offset = self.__string_table_offset
+      table_data = self.__string_table.getTableData()
+      self.__file.seek(string_table_offset)
+      self.__file.write(struct.pack('!I', len(table_data)))
+      self.__file.write(table_data)
+    self.__file.seek(0)
+    self.__file.write(struct.pack('!8sQQ', magic_number,
+        string_table_offset, self.__data_offset))
+    self.__file.write(struct.pack('!II', len(self.__ranges),
+        self.__object_count))
+    for index_range in self.__ranges:
+      self.__file.write(WraptMetaIndex.ENTRY_FORMAT.pack(*index_range))
+    self.__file.seek(0, os.SEEK_END)
+
+  def __flushIndex(self):
+    if not self.__index_buffer:
+      return
+    flushed_entries = self.__entry_count - len(self.__index_buffer)
+    if sys.byteorder == 'little':
+      self.__index_buffer.byteswap()
+    self.__file.seek(self.__index_offset +
+        flushed_entries * WraptLowLevelFile.INDEX_ENTRY_SIZE)
+    self.__file.write(self.__index_buffer.tobytes())
+    self.__file.seek(self.__getDataEnd())
+    self.__index_buffer = array.array('Q')
+
+
+# Assigns output indexes to every object reachable from the root. Traversal
+# uses an explicit worklist, so arbitrarily deep graphs do not hit the
+# recursion limit, and all per-object state is held in compact arrays. The
+# order decides the output layout, and so the read locality of the file:
+#
+# - 'dfs' (the default) places each object before its descendants in preorder.
+# - 'bfs' places objects level by level from the root.
+# - 'clustered' places all of a container's direct children right after it,
+#   then descends depth first, so reading a map's fields touches few pages.
+# - 'trace' places the root, then reachable objects in the order they first
+#   appear in access_trace (a sequence of store indexes, for instance
+#   recorded with WraptTracingObjectFile), then the rest in preorder.
+#
+# If given, progress is called as progress('allocate', allocated, total)
+# every PROGRESS_INTERVAL objects, with total None until allocation is done.
 class IndexAllocator:
-  def __init__(self, object_store):
+  UNALLOCATED = -1
+  ORDERS = ('dfs', 'bfs', 'clustered', 'trace')
+  PROGRESS_INTERVAL = 65536
+
+  def __init__(self, object_store, order='dfs', access_trace=None,
+      use_string_table=False, progress=None):
+    if order not in self.ORDERS:
+      raise ValueError("Unknown allocation order '{0}'".format(order))
+    if (order == 'trace') != (access_trace is not None):
+      raise ValueError("An access trace is required by, and only used by, "
+          "the 'trace' order")
     self.__object_store = object_store
-    self.__allocations = {}
+    self.__order = order
+    self.__access_trace = access_trace
+    self.__use_string_table = use_string_table
+    self.__progress = progress
+    self.__table_strings = set()
+    self.__allocations = array.array('q')
+    self.__allocation_order = array.array('Q')
     self.__next_index = 0
 
+  # Returns the index map: an array from store index to output index, holding
+  # UNALLOCATED for unreachable store indexes.
   def allocate(self):
-    self.__allocate_index(0)
+    if self.__order == 'bfs':
+      self.__allocate_breadth_first(0)
+    elif self.__order == 'clustered':
+      self.__allocate_clustered(0)
+    else:
+      self.__allocate_depth_first(0)
+      if self.__order == 'trace':
+        self.__reorder_by_trace()
+    if self.__progress is not None:
+      allocated_count = len(self.__allocation_order)
+      self.__progress('allocate', allocated_count, allocated_count)
     return self.__allocations
 
-  def __allocate_index(self, index):
-    if index in self.__allocations:
-      return self.__allocations[index]
+  # The store indexes that were allocated, in increasing output index order.
+  def getAllocationOrder(self):
+    return self.__allocation_order
+
+  def getObjectCount(self):
+    return self.__next_index
+
+  # The map tags and field names seen while allocating, when allocating for
+  # a file with a string table.
+  def getTableStrings(self):
+    return self.__table_strings
 
+  def __ensure_capacity(self, index):
+    if index >= len(self.__allocations):
+      self.__allocations.extend(array.array('q',
+          [self.UNALLOCATED]) * (index + 1 - len(self.__allocations)))
+
+  def __is_allocated(self, index):
+    return (index < len(self.__allocations) and
+        self.__allocations[index] != self.UNALLOCATED)
+
+  # Allocates the object at index and returns the indexes it refers to.
+  def __allocate_index(self, index):
+    self.__ensure_capacity(index)
     self.__allocations[index] = self.__next_index
+    self.__allocation_order.append(index)
+    if (self.__progress is not None and
+        len(self.__allocation_order) % self.PROGRESS_INTERVAL == 0):
+      self.__progress('allocate', len(self.__allocation_order), None)
     type_id, value = self.__object_store.getObject(index)
     self.__next_index += self.__get_index_size(type_id, value)
-    self.__allocate_contents(type_id, value)
+    return self.__get_contents(type_id, value)
+
+  def __allocate_depth_first(self, root_index):
+    stack = array.array('Q', [root_index])
+    while stack:
+      index = stack.pop()
+      if self.__is_allocated(index):
+        continue
+      contents = array.array('Q', self.__allocate_index(index))
+      contents.reverse()
+      stack.extend(contents)
+
+  def __allocate_clustered(self, root_index):
+    stack = [self.__allocate_index(root_index)]
+    while stack:
+      children = []
+      for index in stack.pop():
+        if not self.__is_allocated(index):
+          children.append(self.__allocate_index(index))
+      children.reverse()
+      stack.extend(children)
+
+  # Rewrites a preorder allocation so that traced objects come first. Index
+  # sizes are recovered from the preorder allocation, so objects are not
+  # fetched again.
+  def __reorder_by_trace(self):
+    preorder = self.__allocation_order
+    sizes = array.array('Q', (
+        (self.__allocations[preorder[i + 1]] if i + 1 < len(preorder)
+            else self.__next_index) - self.__allocations[preorder[i]]
+        for i in range(len(preorder))))
+    positions = array.array('q', [self.UNALLOCATED]) * len(self.__allocations)
+    for position, index in enumerate(preorder):
+      positions[index] = position
+
+    new_order = array.array('Q', preorder[:1])
+    placed = bytearray(len(preorder))
+    placed[0] = 1
+    for index in self.__access_trace:
+      if 0 <= index < len(positions) and positions[index] != self.UNALLOCATED:
+        if not placed[positions[index]]:
+          placed[positions[index]] = 1
+          new_order.append(index)
+    new_order.extend(index for position, index in enumerate(preorder)
+        if not placed[position])
+
+    next_index = 0
+    for index in new_order:
+      self.__allocations[index] = next_index
+      next_index += sizes[positions[index]]
+    self.__allocation_order = new_order
+
+  def __allocate_breadth_first(self, root_index):
+    discovered = bytearray(root_index + 1)
+    discovered[root_index] = 1
+    queue = collections.deque([root_index])
+    while queue:
+      index = queue.popleft()
+      for next_index in self.__allocate_index(index):
+        if next_index >= len(discovered):
+          discovered.extend(bytes(
+              max(next_index + 1 - len(discovered), len(discovered))))
+        if not discovered[next_index]:
+          discovered[next_index] = 1
+          queue.append(next_index)
 
   def __get_index_size(self, type_id, value):
     if type_id == 'map':
+      if self.__use_string_table:
+        self.__table_strings.update(value.getTableStrings())
+      return value.getIndexCount(self.__use_string_table)
+    elif type_id == 'array':
       return value.getIndexCount()
-    elif type_id == 'float':
-      return 1
-    elif type_id == 'int':
-      return 1
-    elif type_id == 'null':
+    elif type_id in ('float', 'int', 'null', 'string', 'boolean', 'blob'):
       return 1
     else:
       raise ValueError("Does not support type '{0}'".format(type_id))
 
-  def __allocate_contents(self, type_id, value):
-    if type_id == 'float':
-      pass
-    elif type_id == 'int':
-      pass
-    elif type_id == 'map':
-      for next_index in value.getContentIndexes():
-        self.__allocate_index(next_index)
-      return
-    elif type_id == 'null':
-      pass
+  def __get_contents(self, type_id, value):
+    if type_id in ('float', 'int', 'null', 'string', 'boolean', 'blob'):
+      return ()
+    elif type_id in ('map', 'array'):
+      return value.getContentIndexes()
     else:
       raise ValueError("Does not support type '{0}'".format(type_id))
 
 
+# A map in an object store, with fields referring to store indexes. When
+# written, a map occupies a run of output indexes: the map itself, its tag,
+# its field hash table and then one string per field name. With a string
+# table, the tag and field names live in the table instead, and only the map
+# and its hash table take indexes.
 class WraptRefMap:
-  def __init__(self, tag, hash_data_index, string_ref_map):
+  def __init__(self, tag, string_ref_map):
     self.__tag = tag
-    self.__hash_data_index = hash_data_index
     self.__string_ref_map = string_ref_map
 
-  def getIndexCount(self):
-    return 2 + len(self.__string_ref_map)
+  def getIndexCount(self, use_string_table=False):
+    if use_string_table:
+      return 2
+    return 3 + len(self.__string_ref_map)
 
   def getContentIndexes(self):
-    return itertools.chain(self.__string_ref_map.values(), [self.__hash_data_index])
+    return self.__string_ref_map.values()
+
+  def getTableStrings(self):
+    return itertools.chain([self.__tag], self.__string_ref_map.keys())
 
-  def getBaseObjects(self, base_index, index_map):
-    field_list = list(self.__string_ref_map.items())
+  def remapIndexes(self, index_map):
+    return WraptRefMap(self.__tag, dict((key, index_map[value_index])
+        for key, value_index in self.__string_ref_map.items()))
 
-    base_field_list = [(base_index + 2 + i, index_map[value_index])
+  # Returns the objects the map is written as from base_index on, with value
+  # indexes translated through index_map, or kept as they are if it is None.
+  def getBaseObjects(self, base_index, index_map, string_table=None):
+    if index_map is None:
+      field_list = list(self.__string_ref_map.items())
+    else:
+      field_list = [(key, index_map[value_index])
+          for key, value_index in self.__string_ref_map.items()]
+    hash_table = buildFieldHashTable([key for key, _ in field_list])
+
+    if string_table is not None:
+      return [
+        ('map', WraptBaseMap(
+          string_table.findOffset(self.__tag),
+          base_index + 1,
+          [(string_table.findOffset(key), value_index)
+              for key, value_index in field_list])),
+        ('blob', hash_table)]
+
+    base_field_list = [(base_index + 3 + i, value_index)
       for i, (key, value_index) in enumerate(field_list)]
 
     field_objects = [('string', key) for (key, _) in field_list]
@@ -466,9 +3159,36 @@ class WraptRefMap:
     return [
       ('map', WraptBaseMap(
         base_index + 1, #tag
-        index_map[self.__hash_data_index],
+        base_index + 2, #hash table
         base_field_list)),
-      ('string', self.__tag)] + field_objects
+      ('string', self.__tag),
+      ('blob', hash_table)
+      ] + field_objects
+
+
+# An array in an object store, with elements referring to store indexes.
+class WraptRefArray:
+  def __init__(self, element_indexes):
+    self.__element_indexes = element_indexes
+
+  def __len__(self):
+    return len(self.__element_indexes)
+
+  def getIndexCount(self):
+    return 1
+
+  def getContentIndexes(self):
+    return self.__element_indexes
+
+  def remapIndexes(self, index_map):
+    return WraptRefArray(array.array('L',
+        (index_map[index] for index in self.__element_indexes)))
+
+  def getBaseObjects(self, base_index, index_map, string_table=None):
+    if index_map is not None:
+      return self.remapIndexes(index_map).getBaseObjects(
+          base_index, None, string_table)
+    return [('array', self.__element_indexes)]
 
 
 class WraptBaseMap: